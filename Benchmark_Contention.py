@@ -0,0 +1,137 @@
+"""
+Ficheiro que mede a latência das consultas e das atualizações da base de dados do FS_Tracker quando são feitas em simultâneo
+sobre os mesmos ficheiros, sem passar pela rede. Várias threads fazem consultas (FS_Nodes que possuem um ficheiro, todos ou
+no máximo MAX_OWNERS, e raridade dos pacotes) e outras threads aplicam atualizações de pacotes (id_mode==2) de FS_Nodes
+aleatórios, durante o mesmo intervalo de tempo. Os pedidos escolhem o ficheiro mais popular com probabilidade --hot, para
+simular um ficheiro muito pedido e muito atualizado ao mesmo tempo.
+
+Para cada tipo de operação é escrito o número de operações por segundo e os percentis da latência, permitindo comparar
+alterações aos locks e às estruturas da base de dados. Os resultados podem ser guardados em JSON (--save).
+
+Formato: python3 Benchmark_Contention.py [--owners N] [--files N] [--packets N] [--readers N] [--writers N] [--hot N]
+         [--duration N] [--save ficheiro.json]
+"""
+
+import json
+import random
+import sys
+import threading
+import time
+from FS_Track_DataBase import FS_Tracker_DataBase
+from Tracker_Metrics import Histogram
+
+
+
+# Valores por omissão das opções
+DEFAULT_OPTIONS = {
+	"--owners": 1000,
+	"--files": 100,
+	"--packets": 256,
+	"--readers": 4,
+	"--writers": 2,
+	"--hot": 0.9,
+	"--duration": 5.0,
+	"--save": None,
+}
+
+# Número máximo de FS_Nodes das consultas limitadas (id_mode==7)
+MAX_OWNERS = 50
+
+
+"""
+Cria a base de dados com 'owners' FS_Nodes em cada ficheiro, metade com o ficheiro completo e os restantes com pacotes
+aleatórios, todos na versão 2 do protocolo.
+"""
+def make_database(options, rng):
+	FS_Tracker_DB = FS_Tracker_DataBase()
+	FS_Tracker_DB.metrics.slow_log = False
+	n_packets = options["--packets"]
+	addrs = [(f"10.{i // 62500}.{i // 250 % 250}.{i % 250 + 1}", 9090) for i in range(options["--owners"])]
+	for addr in addrs:
+		FS_Tracker_DB.set_node_version(addr, 2)
+		files = [[f"file_{j:04d}", n_packets, -1 if rng.random() < 0.5 else rng.getrandbits(n_packets)] for j in range(options["--files"])]
+		FS_Tracker_DB.apply_message(addr, [1, files])
+	return FS_Tracker_DB, addrs
+
+
+def pick_file(options, rng):
+	if rng.random() < options["--hot"]:
+		return "file_0000"
+	return f"file_{rng.randrange(options['--files']):04d}"
+
+
+"""
+Threads que fazem consultas e atualizações até 'deadline', registando a duração de cada operação em microssegundos.
+"""
+def reader(FS_Tracker_DB, options, seed, deadline, histograms):
+	rng = random.Random(seed)
+	n_packets = options["--packets"]
+	while time.perf_counter() < deadline:
+		name = pick_file(options, rng)
+		kind = rng.randrange(3)
+		start = time.perf_counter()
+		if kind == 0:
+			FS_Tracker_DB.get_file_owners_frame(name)
+		elif kind == 1:
+			FS_Tracker_DB.get_file_owners_frame(name, MAX_OWNERS, rng.getrandbits(n_packets))
+		else:
+			FS_Tracker_DB.get_packets_rarity(name)
+		histograms[kind].record((time.perf_counter() - start) * 1000000)
+
+
+def writer(FS_Tracker_DB, options, seed, deadline, addrs, histogram):
+	rng = random.Random(seed)
+	while time.perf_counter() < deadline:
+		message = [2, [pick_file(options, rng), rng.randrange(options["--packets"])]]
+		addr = rng.choice(addrs)
+		start = time.perf_counter()
+		FS_Tracker_DB.apply_message(addr, message)
+		histogram.record((time.perf_counter() - start) * 1000000)
+
+
+def parse_options(arguments):
+	options = dict(DEFAULT_OPTIONS)
+	for option in DEFAULT_OPTIONS:
+		if option in arguments:
+			position = arguments.index(option)
+			value = arguments[position + 1]
+			del arguments[position:position + 2]
+			if option == "--save":
+				options[option] = value
+			elif isinstance(DEFAULT_OPTIONS[option], float):
+				options[option] = float(value)
+			else:
+				options[option] = int(value)
+	return options
+
+
+def Main():
+	options = parse_options(sys.argv[1:])
+	rng = random.Random(0)
+	FS_Tracker_DB, addrs = make_database(options, rng)
+
+	names = ["consulta completa", "consulta limitada", "raridade", "atualização"]
+	histograms = [Histogram() for _ in names]
+	deadline = time.perf_counter() + options["--duration"]
+	threads = [threading.Thread(target=reader, args=(FS_Tracker_DB, options, i, deadline, histograms)) for i in range(options["--readers"])]
+	threads += [threading.Thread(target=writer, args=(FS_Tracker_DB, options, 1000 + i, deadline, addrs, histograms[3])) for i in range(options["--writers"])]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	print(f"{options['--owners']} FS_Nodes, {options['--files']} ficheiros, {options['--readers']} threads de consultas, {options['--writers']} threads de atualizações, {options['--duration']:g} s")
+	print(f"{'operação':<20} {'op/s':>9} {'p50 us':>8} {'p90 us':>8} {'p99 us':>8} {'p99.9 us':>9} {'máx us':>9}")
+	results = {}
+	for name, histogram in zip(names, histograms):
+		state = histogram.snapshot()
+		results[name] = {key: value for key, value in state.items() if key != "buckets"}
+		print(f"{name:<20} {state['count'] / options['--duration']:9.0f} {state['p50']:8d} {state['p90']:8d} {state['p99']:8d} {state['p99.9']:9d} {state['max']:9d}")
+
+	if options["--save"] is not None:
+		with open(options["--save"], "w") as file:
+			json.dump({"options": options, "results": results}, file, indent=1)
+
+
+if __name__ == '__main__':
+	Main()
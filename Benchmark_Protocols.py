@@ -0,0 +1,424 @@
+"""
+Ficheiro que compara o desempenho das versões 1 e 2 do protocolo definido em Message_Protocols e que verifica que as
+mensagens convertidas por send_message_TCP / send_message_UDP são devolvidas iguais por receive_message_TCP /
+receive_message_UDP. As mensagens são enviadas através de um socketpair() e de sockets UDP no localhost, medindo o número de
+mensagens e de bytes por segundo e o número de chamadas ao sistema (envios e receções) por mensagem de cada versão.
+
+Os cenários cobrem anúncios de 1 a 100k ficheiros, respostas com 1 a 1000 FS_Nodes, nomes de ficheiros longos e mapas de
+bits grandes. No fim, um fuzzer envia mensagens aleatórias de todos os tipos, seguidas na mesma conexão, e compara as
+mensagens recebidas com as enviadas, terminando com código 1 caso encontre diferenças.
+
+Os resultados podem ser guardados num ficheiro JSON (--save) e comparados com os de uma execução anterior (--compare),
+servindo de referência para cada alteração ao protocolo.
+
+Formato: python3 Benchmark_Protocols.py [repetições] [--fuzz mensagens] [--save ficheiro.json] [--compare ficheiro.json]
+"""
+
+import json
+import random
+import socket
+import sys
+import threading
+import time
+import Message_Protocols
+
+
+
+"""
+Funções que criam mensagens com conteúdo semelhante ao que circula na rede: um anúncio inicial de um FS_Node com vários
+ficheiros (metade completos e metade incompletos) e a resposta do FS_Tracker a um pedido de um ficheiro com vários FS_Nodes.
+Os nomes dos ficheiros podem ser alongados até 'name_length' caracteres.
+"""
+def make_announcement(n_files, n_packets=64, name_length=None):
+	files = []
+	for i in range(n_files):
+		packets_owned = -1 if i % 2 == 0 else (1 << n_packets) - 1 - (1 << (i % n_packets))
+		name = f"dataset_{i:06d}_sample.txt"
+		if name_length is not None:
+			name = name.rjust(name_length, "d")
+		files.append([name, n_packets, packets_owned])
+	return files
+
+
+def make_owners(n_owners, n_packets=64):
+	owners = [n_packets]
+	for i in range(n_owners):
+		addr = (f"10.0.{i // 250}.{i % 250 + 1}", 9000 + i)
+		if i % 2 == 0:
+			owners.append(addr)
+		else:
+			owners.append([addr, (1 << n_packets) - 1 - (1 << (i % n_packets))])
+	return owners
+
+
+"""
+Envia a mesma mensagem 'repetitions' vezes através de um socketpair() na versão pedida e devolve o tempo total, o número de
+bytes enviados, o número de chamadas ao sistema dos dois lados e a última mensagem recebida. A leitura é feita noutra
+thread para o envio não bloquear quando o buffer do socket enche.
+"""
+def run_TCP(version, message, mode, id_mode, repetitions):
+	a, b = socket.socketpair()
+	sender = Counting_Socket(a)
+	receiver = Counting_Socket(b)
+	Message_Protocols.set_protocol_version(sender, version)
+	Message_Protocols.set_protocol_version(receiver, version)
+	send_lock = threading.Lock()
+	received = []
+
+	def reader():
+		for _ in range(repetitions):
+			received.append(Message_Protocols.receive_message_TCP(receiver, mode))
+
+	thread = threading.Thread(target=reader)
+	start = time.perf_counter()
+	thread.start()
+	for _ in range(repetitions):
+		Message_Protocols.send_message_TCP(sender, send_lock, message, mode, id_mode)
+	thread.join()
+	elapsed = time.perf_counter() - start
+
+	a.close()
+	b.close()
+	return elapsed, sender.bytes_sent, sender.syscalls + receiver.syscalls, received[-1]
+
+
+"""
+Envia pedidos e respostas de pacotes através de sockets UDP no localhost na versão pedida. Caso seja indicado um
+'compressor', as respostas são comprimidas como se o pedido tivesse REQUEST_FLAG_COMPRESS.
+"""
+def run_UDP(version, repetitions, packet=None, compressor=None):
+	a = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	b = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	b.bind(("127.0.0.1", 0))
+	b.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+	destiny = b.getsockname()
+	if packet is None:
+		packet = bytes(range(256)) * 4
+
+	sender = Counting_Socket(a)
+	receiver = Counting_Socket(b)
+	start = time.perf_counter()
+	message = None
+	for i in range(repetitions):
+		Message_Protocols.send_message_UDP(i % 2, sender, "dataset_000001_sample.txt", i % 64, packet, destiny, version, compressor=compressor)
+		message = Message_Protocols.receive_message_UDP(receiver)
+	elapsed = time.perf_counter() - start
+
+	a.close()
+	b.close()
+	return elapsed, sender.bytes_sent, sender.syscalls + receiver.syscalls, message
+
+
+"""
+Socket que conta o número de bytes enviados e o número de chamadas ao sistema de envio e de receção, reencaminhando as
+operações para o socket original.
+"""
+class Counting_Socket():
+
+	def __init__(self, sock):
+		self.sock = sock
+		self.bytes_sent = 0
+		self.syscalls = 0
+
+	def sendall(self, data):
+		self.bytes_sent += len(data)
+		self.syscalls += 1
+		return self.sock.sendall(data)
+
+	def sendto(self, data, destiny):
+		self.bytes_sent += len(data)
+		self.syscalls += 1
+		return self.sock.sendto(data, destiny)
+
+	def recv(self, size):
+		self.syscalls += 1
+		return self.sock.recv(size)
+
+	def recv_into(self, buffer):
+		self.syscalls += 1
+		return self.sock.recv_into(buffer)
+
+	def recvfrom(self, size):
+		self.syscalls += 1
+		return self.sock.recvfrom(size)
+
+	def close(self):
+		self.sock.close()
+
+
+"""
+Imprime o resultado de um cenário e devolve-o num dicionário, para poder ser guardado e comparado com o de outra execução
+('baseline'), caso em que é indicada também a razão entre os dois.
+"""
+def print_result(name, version, repetitions, elapsed, bytes_sent, syscalls, baseline=None):
+	result = {
+		"msg/s": repetitions / elapsed,
+		"MB/s": bytes_sent / elapsed / 1e6,
+		"bytes/msg": bytes_sent / repetitions,
+		"syscalls/msg": syscalls / repetitions,
+	}
+	line = f"{name:<30} v{version}  {result['msg/s']:>11.1f} msg/s  {result['MB/s']:>8.2f} MB/s  {result['bytes/msg']:>10.0f} bytes/msg  {result['syscalls/msg']:>7.2f} syscalls/msg"
+
+	previous = (baseline or {}).get(f"{name} v{version}")
+	if previous:
+		line += f"  ({result['msg/s'] / previous['msg/s']:.2f}x msg/s, {result['bytes/msg'] / previous['bytes/msg']:.2f}x bytes)"
+	print(line)
+
+	return result
+
+
+"""
+Funções do fuzzer. Cada função gera uma mensagem aleatória e devolve os argumentos do envio e a mensagem esperada na
+receção, respeitando as limitações de cada versão: na versão 1 os nomes só podem ter caracteres ASCII, o id_mode==3 só
+transporta inteiros de 4 bytes e não existem manifestos, raridade dos pacotes, pedidos de vários pacotes, pedidos de vários
+ficheiros, subscrições nem tamanhos de bloco.
+"""
+def random_name(rng, version):
+	alphabet = "abcxyz_.-0123456789çãéÜ日本" if version >= 2 else "abcxyz_.-0123456789"
+	return "".join(rng.choice(alphabet) for _ in range(rng.choice((1, 8, 30, 255))))
+
+
+def random_bitmap(rng, n_packets):
+	kind = rng.randrange(4)
+	if kind == 0:
+		bitmap = rng.getrandbits(n_packets)
+	elif kind == 1:
+		bitmap = ((1 << n_packets) - 1) ^ (1 << rng.randrange(n_packets))
+	elif kind == 2:
+		bitmap = 0
+		for _ in range(rng.randint(1, 5)):
+			bitmap |= 1 << rng.randrange(n_packets)
+	else:
+		bitmap = 0
+		for _ in range(rng.randint(1, 5)):
+			start = rng.randrange(n_packets)
+			bitmap |= ((1 << rng.randint(1, n_packets - start)) - 1) << start
+	return bitmap or 1
+
+
+def random_address(rng):
+	return (".".join(str(rng.randrange(256)) for _ in range(4)), rng.randrange(1, 65536))
+
+
+def random_TCP_message(rng, version):
+	id_mode = rng.choice((0, 1, 2, 3, 4, 5, 6, 7, 9, 10, 11, None) if version >= 2 else (0, 1, 2, 3, None))
+	name = random_name(rng, version)
+
+	if id_mode == 0 or id_mode == 5 or id_mode == 6 or id_mode == 11:
+		return (name, True, id_mode), (id_mode, name)
+
+	if id_mode == 1:
+		files = []
+		for _ in range(rng.randint(1, 20)):
+			n_packets = rng.choice((1, 7, 64, 1000, 100000))
+			entry = [random_name(rng, version), n_packets, rng.choice((-1, random_bitmap(rng, n_packets)))]
+			if version >= 2 and rng.random() < 0.3:
+				entry.append(rng.choice((512, 4096, 65536)))
+			files.append(entry)
+		return (files, True, 1), (1, files)
+
+	if id_mode == 2:
+		message = [name, rng.randrange(1 << 31)]
+		return (message, True, 2), (2, message)
+
+	if id_mode == 3:
+		if version >= 2:
+			message = [name, rng.choice((-1, random_bitmap(rng, rng.choice((8, 1000, 100000)))))]
+		else:
+			message = [name, rng.randrange(1 << 32)]
+		return (message, True, 3), (3, message)
+
+	if id_mode == 7:
+		message = [name, rng.randrange(1 << 16), rng.choice((-1, random_bitmap(rng, rng.choice((8, 1000, 100000)))))]
+		return (message, True, 7), (7, message)
+
+	if id_mode == 9 or id_mode == 10:
+		files = [[random_name(rng, version), rng.choice((-1, random_bitmap(rng, rng.choice((8, 1000)))))] for _ in range(rng.randint(0, 20))]
+		message = [rng.randrange(1 << 16), files]
+		return (message, True, id_mode), (id_mode, message)
+
+	if id_mode == 4:
+		message = [name, rng.randbytes(Message_Protocols.PIECE_HASH_SIZE * rng.randint(0, 50))]
+		return (message, True, 4), (4, message)
+
+	# Resposta do FS_Tracker, com o manifesto de um ficheiro, a raridade dos pacotes ou os FS_Nodes que o possuem
+	if version >= 2 and rng.random() < 0.2:
+		manifest = rng.randbytes(Message_Protocols.PIECE_HASH_SIZE * rng.randint(0, 50))
+		return (manifest, False, Message_Protocols.REPLY_FILE_MANIFEST), manifest
+	if version >= 2 and rng.random() < 0.2:
+		maximum = rng.choice((1, 255, 100000))
+		rarity = [rng.choice((0, maximum, rng.randint(0, maximum))) for _ in range(rng.choice((0, 1, 100, 10000)))]
+		return (rarity, False, Message_Protocols.REPLY_FILE_RARITY), rarity
+
+	if version >= 2 and rng.random() < 0.2:
+		message = {}
+		expected = {}
+		for _ in range(rng.randint(0, 10)):
+			fileName = random_name(rng, version)
+			message[fileName], expected[fileName] = random_owners(rng, version) if rng.random() < 0.8 else (None, None)
+		return (message, False, Message_Protocols.REPLY_BULK_OWNERS), expected
+
+	if version >= 2 and rng.random() < 0.2:
+		peers = []
+		for _ in range(rng.randint(0, 20)):
+			peers.append([random_address(rng), rng.choice((None, -1, random_bitmap(rng, rng.choice((8, 1000, 100000)))))])
+		message = [name, peers]
+		return (message, False, Message_Protocols.REPLY_OWNERS_DELTA), [name, [peer + [1] for peer in peers]]
+	if version >= 2 and rng.random() < 0.05:
+		return (None, False, Message_Protocols.REPLY_OWNERS_RESYNC), None
+
+	message, expected = random_owners(rng, version)
+	return (message, False, None), expected
+
+
+def random_owners(rng, version):
+	n_packets = rng.choice((1, 64, 1000, 100000))
+	if version >= 2:
+		message = [(n_packets, rng.choice((Message_Protocols.DEFAULT_BLOCK_SIZE, 4096)))]
+	else:
+		message = [n_packets]
+	expected = list(message)
+	for _ in range(rng.randint(0, 30)):
+		addr = random_address(rng)
+		if rng.random() < 0.5:
+			message.append(addr)
+			expected.append([addr, -1, 1] if version >= 2 else addr)
+		else:
+			bitmap = random_bitmap(rng, n_packets)
+			message.append([addr, bitmap])
+			expected.append([addr, bitmap, 1] if version >= 2 else [addr, bitmap])
+	return message, expected
+
+
+def random_UDP_message(rng, version, source):
+	mode = rng.choice((0, 1, 2) if version >= 2 else (0, 1))
+	name = random_name(rng, version)
+	index = rng.randrange(1 << 20)
+
+	if mode == 0:
+		flags = rng.choice((0, Message_Protocols.REQUEST_FLAG_COMPRESS)) if version >= 2 else 0
+		return (0, name, index, None, None, flags, None), [0, source, name, index, flags, version]
+
+	if mode == 2:
+		indices = sorted(rng.sample(range(rng.choice((10, 100000))), rng.randint(1, 10)))
+		flags = rng.choice((0, Message_Protocols.REQUEST_FLAG_COMPRESS))
+		return (2, name, indices, None, 1400, flags, None), [2, source, name, indices, 1400, flags, version]
+
+	# Resposta com um pacote, sem fragmentos para ser recebida num só datagrama
+	data = rng.choice((rng.randbytes(rng.randint(0, 1024)), b"abc" * rng.randint(0, 340)))
+	compressor = Message_Protocols.Block_Compressor() if version >= 2 and rng.random() < 0.5 else None
+	return (1, name, index, data, 65000, 0, compressor), [1, source, name + str(index), data, version]
+
+
+"""
+Envia 'iterations' mensagens TCP aleatórias de cada versão, seguidas no mesmo socketpair(), e outras tantas mensagens UDP,
+comparando cada mensagem recebida com a esperada. Devolve o número de diferenças encontradas.
+"""
+def fuzz(iterations, seed=0):
+	rng = random.Random(seed)
+	errors = 0
+
+	for version in (1, 2):
+		cases = [random_TCP_message(rng, version) for _ in range(iterations)]
+		a, b = socket.socketpair()
+		Message_Protocols.set_protocol_version(a, version)
+		Message_Protocols.set_protocol_version(b, version)
+		send_lock = threading.Lock()
+		received = []
+
+		def reader():
+			for (_, mode, _), _ in cases:
+				received.append(Message_Protocols.receive_message_TCP(b, mode))
+
+		thread = threading.Thread(target=reader)
+		thread.start()
+		for (message, mode, id_mode), _ in cases:
+			Message_Protocols.send_message_TCP(a, send_lock, message, mode, id_mode)
+		thread.join()
+		a.close()
+		b.close()
+
+		for ((message, mode, id_mode), expected), result in zip(cases, received):
+			if result != expected:
+				errors += 1
+				if errors <= 5:
+					print(f"fuzz TCP v{version} id_mode={id_mode}: enviado {str(message)[:200]} recebido {str(result)[:200]}")
+
+		a = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		b = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		a.bind(("127.0.0.1", 0))
+		b.bind(("127.0.0.1", 0))
+		for _ in range(iterations):
+			(mode, name, index, data, max_datagram, flags, compressor), expected = random_UDP_message(rng, version, a.getsockname())
+			Message_Protocols.send_message_UDP(mode, a, name, index, data, b.getsockname(), version, max_datagram, flags, compressor)
+			result = Message_Protocols.receive_message_UDP(b, 65535)
+			if result != expected:
+				errors += 1
+				if errors <= 5:
+					print(f"fuzz UDP v{version} mode={mode}: esperado {str(expected)[:200]} recebido {str(result)[:200]}")
+		a.close()
+		b.close()
+
+	print(f"fuzz: {iterations} mensagens TCP e {iterations} UDP por versão, {errors} diferenças")
+	return errors
+
+
+def Main():
+	arguments = sys.argv[1:]
+	options = {}
+	for option in ("--fuzz", "--save", "--compare"):
+		if option in arguments:
+			position = arguments.index(option)
+			options[option] = arguments[position + 1]
+			del arguments[position:position + 2]
+	repetitions = int(arguments[0]) if arguments else 200
+
+	baseline = None
+	if "--compare" in options:
+		with open(options["--compare"]) as file:
+			baseline = json.load(file)
+
+	scenarios = [
+		("anúncio 1 ficheiro", make_announcement(1), True, 1, repetitions * 10),
+		("anúncio 1000 ficheiros", make_announcement(1000), True, 1, repetitions // 10 or 1),
+		("anúncio 100k ficheiros", make_announcement(100000), True, 1, 1),
+		("anúncio 100 nomes longos", make_announcement(100, name_length=1000), True, 1, repetitions // 10 or 1),
+		("anúncio 10 ficheiros 100k", make_announcement(10, 100000), True, 1, repetitions // 10 or 1),
+		("pedido de ficheiro", "dataset_000001_sample.txt", True, 0, repetitions * 10),
+		("atualização de pacote", ("dataset_000001_sample.txt", 12), True, 2, repetitions * 10),
+		("resposta 1 FS_Node", make_owners(1), False, None, repetitions * 10),
+		("resposta 500 FS_Nodes", make_owners(500), False, None, repetitions // 10 or 1),
+		("resposta 1000 FS_Nodes", make_owners(1000), False, None, repetitions // 20 or 1),
+		("resposta 100 FS_Nodes 100k", make_owners(100, 100000), False, None, repetitions // 10 or 1),
+	]
+
+	results = {}
+	for name, message, mode, id_mode, reps in scenarios:
+		for version in (1, 2):
+			elapsed, bytes_sent, syscalls, _ = run_TCP(version, message, mode, id_mode, reps)
+			results[f"{name} v{version}"] = print_result(name, version, reps, elapsed, bytes_sent, syscalls, baseline)
+
+	for version in (1, 2):
+		elapsed, bytes_sent, syscalls, _ = run_UDP(version, repetitions * 10)
+		results[f"UDP pedido + pacote 1 KB v{version}"] = print_result("UDP pedido + pacote 1 KB", version, repetitions * 10, elapsed, bytes_sent, syscalls, baseline)
+
+	# Pacote de texto semelhante aos ficheiros .txt da pasta files, enviado sem e com compressão
+	text = b"".join(f"linha {i} do ficheiro dataset_000001_sample.txt com texto repetido\n".encode() for i in range(64))[:1024]
+	elapsed, bytes_sent, syscalls, _ = run_UDP(2, repetitions * 10, text)
+	results["UDP pacote texto v2"] = print_result("UDP pacote texto", 2, repetitions * 10, elapsed, bytes_sent, syscalls, baseline)
+	compressor = Message_Protocols.Block_Compressor()
+	elapsed, bytes_sent, syscalls, _ = run_UDP(2, repetitions * 10, text, compressor)
+	results["UDP pacote texto zlib v2"] = print_result("UDP pacote texto zlib", 2, repetitions * 10, elapsed, bytes_sent, syscalls, baseline)
+	stats = compressor.get_stats()
+	print(f"{'':<30}     {stats['bytes_saved']} bytes poupados, {stats['cache_hits']} acertos na cache, {stats['cpu_seconds']:.4f} s de CPU")
+
+	if "--save" in options:
+		with open(options["--save"], "w") as file:
+			json.dump(results, file, indent=1)
+
+	if fuzz(int(options.get("--fuzz", 500))):
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	Main()
@@ -3,8 +3,10 @@ Ficheiro que executa o FS_Node.
 """
 
 
+import hashlib
 import math
 import socket
+import zlib
 import threading
 import signal
 import sys
@@ -13,11 +15,28 @@ import time
 import FS_Node_DataBase
 import Message_Protocols
 import IntegerInstance
+from Packet_Updates import Packet_Updates
+from Swarm_Subscriptions import Swarm_Subscriptions
 
 
 
-# Tamanho de cada pacote de um ficheiro
-PACKET_SIZE = 1024
+# Tamanho de cada pacote de um ficheiro, quando não é indicado outro na execução do FS_Node
+PACKET_SIZE = Message_Protocols.DEFAULT_BLOCK_SIZE
+
+# Número máximo de pacotes que uma thread pede de uma só vez
+BATCH_SIZE = 32
+
+# Número máximo de FS_Nodes que o FS_Tracker da versão 2 indica por cada ficheiro pedido
+MAX_OWNERS_PER_REQUEST = 50
+
+# Pede aos FS_Nodes da versão 2 que enviem os pacotes comprimidos, cabendo a quem envia decidir se a compressão compensa
+REQUEST_COMPRESSION = True
+
+# Subscreve, no FS_Tracker da versão 2, as alterações dos FS_Nodes de cada ficheiro enquanto este é transferido
+SUBSCRIBE_TO_SWARMS = True
+
+# Número máximo de vezes que os pacotes em falta de um ficheiro são pedidos, quando a lista de FS_Nodes muda durante a transferência
+MAX_DOWNLOAD_PASSES = 3
 
 
 """
@@ -52,14 +71,18 @@ file1.txt		(nome do ficheiro)
 50				(número de pacotes do ficheiro quando completo)
 65763			(pacotes que possuí representado por um inteiro)
 file2.txt
+200 4096		(número de pacotes e tamanho de cada pacote, quando este não é PACKET_SIZE)
 ...
 """
 def write_MTDados(path_to_metadata, FS_Node_DB):
 
 	with open(path_to_metadata, "w") as file:
-		for (name, n_packets, packets) in FS_Node_DB.get_files():
+		for (name, n_packets, packets, block_size) in FS_Node_DB.get_files():
 			file.write(f"{name}\n")
-			file.write(f"{n_packets}\n")
+			if block_size!=PACKET_SIZE:
+				file.write(f"{n_packets} {block_size}\n")
+			else:
+				file.write(f"{n_packets}\n")
 			file.write(f"{packets}\n")
 
 
@@ -73,6 +96,7 @@ file1.txt		(nome do ficheiro)
 50				(número de pacotes do ficheiro quando completo)
 65763			(pacotes que possuí representado por um inteiro)
 file2.txt
+200 4096		(número de pacotes e tamanho de cada pacote, quando este não é PACKET_SIZE)
 ...
 """
 
@@ -85,9 +109,9 @@ def get_file_metadata(meta_file):
 	
     while current_index < len(lines):
         name = lines[current_index].strip()
-        n_packets = int(lines[current_index + 1])
+        n_packets, *block_size = map(int, lines[current_index + 1].split())
         packets = int(lines[current_index + 2])
-        metadata.append([name, n_packets, packets])
+        metadata.append([name, n_packets, packets, block_size[0] if block_size else PACKET_SIZE])
 
         # Passa para a próxima linha onde pode estar o nome de um ficheiro
         current_index += 3
@@ -99,9 +123,10 @@ Função responsável por devolver um dicionário com os ficheiros que o FS_Node
 Primeiro, é verificado se existe um ficheiro de metadados.
 Caso exista, então é lido e o dicionário é populado com os dados do ficheiro.
 De seguida, verifica-se se existem ficheiros que não estão no ficheiro de metadados.
-Caso existam, são adicionados ao dicionário, sendo assumindo que estão completos. 
+Caso existam, são adicionados ao dicionário, sendo assumindo que estão completos e divididos em pacotes de
+'block_size' bytes.
 """
-def fetch_files(files_path, path_to_metadata):
+def fetch_files(files_path, path_to_metadata, block_size=PACKET_SIZE):
 
 	files = []
 
@@ -111,17 +136,16 @@ def fetch_files(files_path, path_to_metadata):
 			if os.path.isfile(path_to_metadata):
 
 				# se existe, popula o dicionário
-				metadata = get_file_metadata(path_to_metadata)
-				for name, n_packets, packets in metadata:
-					files.append([name, n_packets, packets])
+				files = get_file_metadata(path_to_metadata)
 			
 			# vê se existem ficheiros que não estão no ficheiro de metadados
+			names = {file_names[0] for file_names in files}
 			for file_name in os.listdir(files_path):
 				file_path = os.path.join(files_path, file_name)
-				if os.path.isfile(file_path) and file_name not in [file_names[0] for file_names in files]:
+				if os.path.isfile(file_path) and file_name not in names:
 					# Se existirem, adiciona-os ao dicionário, assumindo que estão completos
 					file_size = os.path.getsize(file_path)
-					files.append([file_name, math.ceil(file_size / PACKET_SIZE), -1])
+					files.append([file_name, math.ceil(file_size / block_size), -1, block_size])
 
 	else:
 		print(f"Folder '{files_path}' does not exist.")
@@ -129,6 +153,61 @@ def fetch_files(files_path, path_to_metadata):
 	return files
 
 
+"""
+Funções responsáveis pelos manifestos dos ficheiros, ou seja, pela hash SHA-256 de cada pacote de um ficheiro, concatenadas
+pela ordem dos pacotes. O manifesto de um ficheiro completo é calculado uma única vez e guardado em disco, na pasta
+'path_to_manifests' junto aos metadados, num ficheiro com o nome do ficheiro seguido de ".sha256". O manifesto guardado só é
+reutilizado se for mais recente do que o ficheiro e tiver uma hash por pacote, caso contrário é calculado novamente.
+"""
+def compute_manifest(file_path, block_size):
+	manifest = bytearray()
+	with open(file_path, 'rb') as file:
+		while (packet := file.read(block_size)):
+			manifest += hashlib.sha256(packet).digest()
+	return bytes(manifest)
+
+
+def load_manifest(files_path, path_to_manifests, fileName, n_packets, block_size):
+	file_path = files_path + fileName
+	cache_path = path_to_manifests + fileName + ".sha256"
+
+	if os.path.isfile(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(file_path):
+		with open(cache_path, 'rb') as cache:
+			manifest = cache.read()
+		if len(manifest) == n_packets * Message_Protocols.PIECE_HASH_SIZE:
+			return manifest
+
+	manifest = compute_manifest(file_path, block_size)
+	save_manifest(path_to_manifests, fileName, manifest)
+	return manifest
+
+
+def save_manifest(path_to_manifests, fileName, manifest):
+	os.makedirs(path_to_manifests, exist_ok=True)
+	with open(path_to_manifests + fileName + ".sha256", 'wb') as cache:
+		cache.write(manifest)
+
+
+def remove_manifest(path_to_manifests, fileName):
+	if os.path.isfile(path_to_manifests + fileName + ".sha256"):
+		os.remove(path_to_manifests + fileName + ".sha256")
+
+
+"""
+Função que publica no FS_Tracker os manifestos dos ficheiros completos de uma lista de ficheiros, guardando-os também na base
+de dados do FS_Node. Os manifestos só existem na versão 2 do protocolo, por isso nada é feito se o FS_Tracker for da versão 1.
+"""
+def publish_manifests(s, send_lock_TCP, FS_Node_DB, files_path, path_to_manifests, files):
+	if Message_Protocols.get_protocol_version(s) < 2:
+		return
+
+	for (fileName, n_packets, packets_owned, block_size) in files:
+		if packets_owned==-1:
+			manifest = load_manifest(files_path, path_to_manifests, fileName, n_packets, block_size)
+			FS_Node_DB.set_manifest(fileName, manifest)
+			Message_Protocols.send_message_TCP(s, send_lock_TCP, [fileName, manifest], True, 4)
+
+
 """
 Função que retorna uma lista ordenada por ordem descrescente de prioridade a quem o FS_Node deve pedir o
 pacote que pretende. Esta percorre a lista que possuí a informação sobre os FS_Nodes que não possuem e que
@@ -137,6 +216,9 @@ para tentar escolher o FS_Node que se encontra a responder a uma menor quantidad
 ficheiro que nós pretendemos. Assim, tentamos não sobrecarregar nenhum FS_Node.
 """
 def FS_Nodes_ask_order(list_FS_Nodes_With_Packet):
+
+	if not list_FS_Nodes_With_Packet:
+		return []
 	
 	#Adiciona o primeiro ip da lista no início da lista
 	FS_Nodes_ask_order = [list_FS_Nodes_With_Packet[0]]
@@ -146,7 +228,7 @@ def FS_Nodes_ask_order(list_FS_Nodes_With_Packet):
 	index_start_point = size_list // 2
 
 	# Adiciona o ponto central, caso este contenha um endereço IP
-	if ((ip := list_FS_Nodes_With_Packet[index_start_point])!=0):
+	if ((ip := list_FS_Nodes_With_Packet[index_start_point])!=0 and index_start_point!=0):
 		FS_Nodes_ask_order.append(ip)
 
 	# Verifica se o número de elementos é par ou ímpar
@@ -172,10 +254,11 @@ def FS_Nodes_ask_order(list_FS_Nodes_With_Packet):
 			if ((ip := list_FS_Nodes_With_Packet[index_start_point+i])!=0):
 				FS_Nodes_ask_order.append(ip)
 
-		if ((ip := list_FS_Nodes_With_Packet[size_list-1])!=0):
+		if ((ip := list_FS_Nodes_With_Packet[size_list-1])!=0 and size_list-1!=0):
 				FS_Nodes_ask_order.append(ip)
 	
-	return FS_Nodes_ask_order
+	# Remove as posições dos FS_Nodes que não possuem o pacote
+	return [ip for ip in FS_Nodes_ask_order if ip!=0]
 
 
 
@@ -185,12 +268,15 @@ pacote pretendido e contendo o endereço IP caso contenha o pacote pretendido.
 """
 def FS_Nodes_with_packet(FS_Nodes, packet_to_check):
 
+	# Copia os FS_Nodes de uma só vez, pois a lista pode ser substituída durante a transferência (ver Swarm_Subscriptions)
+	peers = FS_Nodes[1:]
+
 	# Lista com os FS_Nodes que possuem o pacote pretendido, estando a posição igual ao IP caso tenha o pacote e a 0 caso não tenha
-	list = [0] * len(FS_Nodes[1:])
+	list = [0] * len(peers)
 
 	# Percorre todos os FS_Nodes à procura dos que têm o ficheiro
 	index = 0
-	for (address, packets) in FS_Nodes[1:]:
+	for (address, packets) in peers:
 
 		# Verifica se o FS_Node tem o pacote
 		binary_to_compare = 1 << FS_Nodes[0] - packet_to_check - 1
@@ -206,171 +292,329 @@ def FS_Nodes_with_packet(FS_Nodes, packet_to_check):
 """
 Função responsável por converter os elementos da lista de FS_Nodes enviada pelo Tracker aquando de um pedido
 de um ficheiro, do formato ["172.0.0.1", ["168.98.2.1", 7123]] para [["172.0.0.1", 8192], ["168.98.2.1", 7123]]
+
+Na versão 2 do protocolo cada elemento vem no formato [("172.0.0.1", 9090), packets, versão], sendo packets igual
+a -1 quando o ficheiro está completo. A versão de cada FS_Node é guardada no dicionário peers_version, para as
+threads UDP saberem em que versão devem comunicar com esse FS_Node.
 """
-def convert_complete_FS_Nodes(FS_Nodes, cache_DNS):
+def convert_complete_FS_Nodes(FS_Nodes, cache_DNS, peers_version):
 	new_list = [FS_Nodes[0]]
 
 	complete_value = pow(2, FS_Nodes[0]) - 1
 	for file in FS_Nodes[1:]:
-		if not isinstance(file[0], list):
-
-			# Verifica se já está na cache
-			if file[0] in cache_DNS:
-				file_IP = cache_DNS[file[0]]
-			else:
-				file_IP, _, _ = socket.gethostbyaddr(file[0])
-				cache_DNS[file[0]] = file_IP
-			new_list.append([tuple((file_IP, file[1])), complete_value])
+		if len(file)==3:
+			address, packets = convert_FS_Node(file, cache_DNS, peers_version)
+			new_list.append([address, complete_value if packets==-1 else packets])
+		elif not isinstance(file[0], list):
+			new_list.append([tuple((get_FS_Node_name(file[0], cache_DNS), file[1])), complete_value])
 		else:
-			# Verifica se já está na cache
-			if file[0][0] in cache_DNS:
-				file_IP = cache_DNS[file[0]]
-			else:
-				file_IP, _, _ = socket.gethostbyaddr(file[0][0])
-				cache_DNS[file[0][0]] = file_IP
-			new_list.append([tuple((file_IP, file[0][1])), file[1]])
+			new_list.append([tuple((get_FS_Node_name(file[0][0], cache_DNS), file[0][1])), file[1]])
 
 	return new_list
 
 
 """
-Função responsável por obter os pacotes do ficheiro. Esta começa por escolher um pacote para obter, determina
-qual o melhor FS_Node a quem pedir o pacote, tenta obter o pacote e, por fim, atualiza a informação da base de
-dados do FS_Node e atualiza o ficheiro correspondente ao pacote.
+Funções que convertem o endereço IP de um FS_Node para o seu nome, guardando-o na cache DNS, e um FS_Node da versão 2 do
+protocolo, no formato [(ip, port), packets, versão], para [(nome, port), packets], guardando a sua versão em peers_version.
+Caso o IP não tenha nome (sem DNS reverso), é usado o próprio IP, que também fica na cache.
+"""
+def get_FS_Node_name(ip, cache_DNS):
+
+	# Verifica se já está na cache
+	if ip in cache_DNS:
+		return cache_DNS[ip]
+	try:
+		file_IP, _, _ = socket.gethostbyaddr(ip)
+	except (socket.herror, socket.gaierror):
+		file_IP = ip
+	cache_DNS[ip] = file_IP
+	return file_IP
+
+
+def convert_FS_Node(peer, cache_DNS, peers_version):
+	(ip, port), packets, version = peer
+	address = (get_FS_Node_name(ip, cache_DNS), port)
+	peers_version[address] = version
+	return [address, packets]
+
+
+"""
+Função responsável por guardar um pacote recebido de outro FS_Node, escrevendo-o no ficheiro correspondente, atualizando
+a base de dados do FS_Node e registando a atualização para ser enviada ao FS_Tracker (ver Packet_Updates). Caso o pacote
+não corresponda à hash do manifesto do ficheiro, não é guardado e a função devolve False.
+"""
+def store_packet(packet_updates, FS_Node_DB, files_path, fileName, packet_index, packet):
+
+	# Verifica o pacote com o manifesto do ficheiro
+	if not FS_Node_DB.verify_packet(fileName, packet_index, packet):
+		return False
+
+	# Escreve o pacote recebido para o ficheiro correspondente
+	with open(files_path + fileName, 'rb+') as file:
+		file.seek(packet_index*FS_Node_DB.get_block_size(fileName))
+		file.write(packet)
+
+	# Guarda o pacote na base de dados do FS_Node
+	FS_Node_DB.update_packet(fileName, packet_index)
+
+	# Regista a atualização, que é enviada ao FS_Tracker juntamente com as dos outros pacotes
+	packet_updates.add(fileName, FS_Node_DB.get_size_file(fileName), packet_index)
+
+	return True
+
+
+"""
+Função responsável por obter os pacotes do ficheiro. Esta começa por escolher um lote de até BATCH_SIZE pacotes para
+obter, determina qual o melhor FS_Node a quem pedir cada pacote e agrupa os pacotes pelo FS_Node escolhido, enviando um
+único pedido por FS_Node (ver UDP_sender_thread). Os pacotes que chegam são guardados e os que faltam voltam a ser pedidos,
+por isso o número de pedidos depende do número de lotes e não do número de pacotes.
 
 Importnate salientar, que caso o timeout de espera para obter uma resposta de outro FS_Node seja ultrapassado 3
 vezes, é escolhido outro FS_Node a quem pedir o pacote. Caso não consiga obter o pacote de nenhum FS_Node então
 passa para outro pacote e no fim da transferência do ficheiro, avisa o utilizador que não foi possível obter
 o ficheiro completo.
+
+Um pacote que não corresponde ao manifesto do ficheiro é descartado e volta a ser pedido ao FS_Node seguinte.
 """
-def get_file_Thread(s, send_lock_TCP, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock, FS_Node_DB, FS_Nodes, files_path, fileName, priority_queue, index, lock_priority_queue):
-	
-	# Obtem um dos pacotes do ficheiro
-	lock_priority_queue.acquire()
-	while (index.getInt()<len(priority_queue)):
-		packet_to_check = priority_queue[index.getInt()]
-		meu_Index = index.getInt()
-		index.incrementInteger()
-		lock_priority_queue.release()
+def get_file_Thread(packet_updates, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock, FS_Node_DB, FS_Nodes, files_path, fileName, priority_queue, index, lock_priority_queue):
 
-		# Verifica se o FS_Node já possuí esse pacote
-		if (not FS_Node_DB.check_packet_file(fileName, packet_to_check)):
-			
-			packet = None
-			# Verifica se o pacote já não está em cache
-			if not ((response := replies_Dic.get(fileName + str(packet_to_check)))!=None and response[3]!=None and len(response[3])>0):
-
-				# Determina quantos FS_Nodes e que FS_Nodes possuem o pacote
-				list_FS_Nodes_With_Packet = FS_Nodes_with_packet(FS_Nodes, packet_to_check)
-
-				# Determina a que FS_Nodes irá pedir os pacotes
-				FS_Nodes_ask_order_list = FS_Nodes_ask_order(list_FS_Nodes_With_Packet)
-
-				# Cria um lock com uma condição associada para ser alertado de quando a resposta ao seu pedido chegar
-				wake_me_lock = threading.Lock()
-				wake_me_lock_condition = threading.Condition(wake_me_lock)
-
-				# Pede o pacote a outros FS_Nodes
-				found = False
-				for FS_Node_address in FS_Nodes_ask_order_list:
-
-					# Verifica se o pacote já foi encontrado
-					if found:
-						break
-
-					attempts = 0
-					while attempts < 3:
-						# Insere o pedido de ficheiro na queue de pedidos, que serão tratados por outras thread
-						
-						# Caso a thread não seja notificada, esta espera apenas 2 segundos
-						wake_me_lock.acquire()
-						send_queue_UDP_lock.acquire()
-						send_queue_UDP.append([0, wake_me_lock, wake_me_lock_condition, [fileName, packet_to_check, FS_Node_address]])
-						send_queue_UDP_condition.notify()
-						send_queue_UDP_lock.release()
-						wake_me_lock_condition.wait(2.0)
-						wake_me_lock.release()
-						
-						# Verifica se já tem a resposta ao seu pedido no dicionário de respostas a pedidos
-						if (response := replies_Dic.get(fileName + str(packet_to_check)))!=None and response[3]!=None:
-
-							if (len(response[3])>0):
-								packet = response[3]
-								found = True
-							break
-						else:
-							attempts += 1
-			else:
-				response[0] = time.time()
-				packet = response[3]
-
-			if packet!=None:
-				# Cria o ficheiro se ele não existir
-				if not os.path.exists(files_path + fileName):
-					with open(files_path + fileName, 'w') as new_file:
-						pass
-
-				# Escreve o pacote recebido para o ficheiro correspondente
-				with open(files_path + fileName, 'rb+') as file:
-					file.seek((meu_Index)*PACKET_SIZE)
-					file.write(packet)
-				
-				# Guarda o pacote na base de dados do FS_Node
-				FS_Node_DB.update_packet(fileName, meu_Index)
-				
-				# Informa o FS_Tracker da atualização
-				message = (fileName, meu_Index)
-				Message_Protocols.send_message_TCP(s, send_lock_TCP, message, True, 2)
+	# Cria um lock com uma condição associada para ser alertado de quando as respostas aos seus pedidos chegarem
+	wake_me_lock = threading.Lock()
+	wake_me_lock_condition = threading.Condition(wake_me_lock)
+
+	while True:
 
+		# Obtem um lote de pacotes do ficheiro que o FS_Node ainda não possuí
+		batch = []
 		lock_priority_queue.acquire()
-	
-	lock_priority_queue.release()
+		while (index.getInt()<len(priority_queue) and len(batch)<BATCH_SIZE):
+			packet_to_check = priority_queue[index.getInt()]
+			index.incrementInteger()
+			if (not FS_Node_DB.check_packet_file(fileName, packet_to_check)):
+				batch.append(packet_to_check)
+		lock_priority_queue.release()
+
+		if not batch:
+			break
+
+		# Para cada pacote em falta guarda a lista de FS_Nodes a quem o pedir e as tentativas feitas ao primeiro da lista
+		missing = {}
+		for packet_to_check in batch:
+
+			# Verifica se o pacote já está em cache, descartando-o caso não corresponda ao manifesto
+			if (response := replies_Dic.get(fileName + str(packet_to_check)))!=None and response[3]!=None and len(response[3])>0:
+				if store_packet(packet_updates, FS_Node_DB, files_path, fileName, packet_to_check, response[3]):
+					response[0] = time.time()
+					continue
+				replies_Dic.pop(fileName + str(packet_to_check), None)
+
+			# Determina que FS_Nodes possuem o pacote e a ordem pela qual lhes vai pedir o pacote
+			list_FS_Nodes_With_Packet = FS_Nodes_with_packet(FS_Nodes, packet_to_check)
+			missing[packet_to_check] = [FS_Nodes_ask_order(list_FS_Nodes_With_Packet), 0]
+
+		while missing:
+
+			# Agrupa os pacotes em falta pelo FS_Node a quem vão ser pedidos, desistindo dos pacotes que já não têm a quem ser pedidos
+			requests = {}
+			for packet_to_check, info in list(missing.items()):
+				if info[1] == 3:
+					info[0].pop(0)
+					info[1] = 0
+				if not info[0]:
+					del missing[packet_to_check]
+				else:
+					info[1] += 1
+					requests.setdefault(info[0][0], []).append(packet_to_check)
+
+			if not requests:
+				break
+
+			# Insere um pedido por FS_Node na queue de pedidos, que serão tratados por outras threads, e espera no máximo 2
+			# segundos que cheguem as respostas a todos os pacotes pedidos
+			wake_me_lock.acquire()
+			send_queue_UDP_lock.acquire()
+			for FS_Node_address, packets in requests.items():
+				send_queue_UDP.append([2, wake_me_lock, wake_me_lock_condition, [fileName, packets, FS_Node_address]])
+			send_queue_UDP_condition.notify()
+			send_queue_UDP_lock.release()
+
+			deadline = time.time() + 2.0
+			while (remaining := deadline - time.time()) > 0:
+				if all((response := replies_Dic.get(fileName + str(packet_to_check)))!=None and response[3]!=None for packet_to_check in missing):
+					break
+				wake_me_lock_condition.wait(remaining)
+			wake_me_lock.release()
+
+			# Guarda os pacotes que chegaram e passa para o FS_Node seguinte nos pacotes que o FS_Node não tinha
+			for packet_to_check, info in list(missing.items()):
+				if (response := replies_Dic.get(fileName + str(packet_to_check)))!=None and response[3]!=None:
+					if (len(response[3])>0) and store_packet(packet_updates, FS_Node_DB, files_path, fileName, packet_to_check, response[3]):
+						del missing[packet_to_check]
+					else:
+						# Descarta a resposta para o pacote poder ser pedido novamente
+						if len(response[3])>0:
+							replies_Dic.pop(fileName + str(packet_to_check), None)
+						info[1] = 3
 
 
 """
 Função responsável por fazer download de um ficheiro. Começa por pedir ao FS_Tracker os FS_Nodes que possuem pacotes
 do ficheiro que pretende obter e depois cria uma lista ordenada por ordem crescente dos pacotes mais comuns na rede.
 Por fim, cria X threads responsáveis por fazer o download do ficheiro.
+
+Na versão 2 pede também o manifesto do ficheiro, para verificar cada pacote recebido, e guarda-o em disco quando o
+ficheiro fica completo, evitando que tenha de ser calculado quando o FS_Node voltar a ser iniciado. Pede ainda ao FS_Tracker
+o número de FS_Nodes que possuem cada pacote, que este mantém atualizado, em vez de calcular a raridade dos pacotes, e pede
+apenas MAX_OWNERS_PER_REQUEST FS_Nodes, dos que possuem os pacotes que ainda lhe faltam.
+
+Também na versão 2, o FS_Node subscreve as alterações dos FS_Nodes do ficheiro no mesmo pedido (ver get_files_owners), pelo
+que os FS_Nodes que entram na rede, obtêm novos pacotes ou saem durante a transferência são aplicados à lista de FS_Nodes
+usada pelas threads (ver Swarm_Subscriptions), sem voltar a perguntar ao FS_Tracker. A subscrição termina com a transferência.
+
+No fim da transferência, as atualizações dos pacotes do ficheiro que ainda não foram enviadas ao FS_Tracker são enviadas.
+"""
+def downloadFile(s, send_lock_TCP, subscriptions, packet_updates, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock, write_lock, threads_per_request, FS_Node_DB, files_path, path_to_manifests, fileName, cache_DNS, peers_version):
+
+	# Pede ao FS_Tracker os FS_Nodes que possuem informação sobre o ficheiro, na versão 2 apenas MAX_OWNERS_PER_REQUEST FS_Nodes
+	# e apenas os que possuem pacotes que ainda não tem
+	FS_Nodes = get_files_owners(s, send_lock_TCP, subscriptions, FS_Node_DB, [fileName]).get(fileName)
+
+	transferFile(s, send_lock_TCP, subscriptions, packet_updates, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock, write_lock, threads_per_request, FS_Node_DB, files_path, path_to_manifests, fileName, FS_Nodes, cache_DNS, peers_version)
+
+
+"""
+Função equivalente a downloadFile para vários ficheiros. Os FS_Nodes que possuem cada ficheiro são pedidos ao FS_Tracker
+de uma só vez (ver get_files_owners) e os ficheiros são depois transferidos um a um, pela ordem indicada.
+"""
+def downloadFiles(s, send_lock_TCP, subscriptions, packet_updates, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock, write_lock, threads_per_request, FS_Node_DB, files_path, path_to_manifests, fileNames, cache_DNS, peers_version):
+	fileNames = list(dict.fromkeys(fileNames))
+	owners = get_files_owners(s, send_lock_TCP, subscriptions, FS_Node_DB, fileNames)
+	for fileName in fileNames:
+		transferFile(s, send_lock_TCP, subscriptions, packet_updates, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock, write_lock, threads_per_request, FS_Node_DB, files_path, path_to_manifests, fileName, owners.get(fileName), cache_DNS, peers_version)
+
+
+"""
+Função que devolve os pacotes de um ficheiro que o FS_Node ainda não possuí, no formato de packets_Needed dos pedidos ao
+FS_Tracker (-1 caso ainda não tenha nenhum pacote).
+"""
+def get_packets_needed(FS_Node_DB, fileName):
+	if (packets_owned := FS_Node_DB.get_packets_file(fileName)) is None:
+		return -1
+	return 0 if packets_owned==-1 else ((1 << FS_Node_DB.get_size_file(fileName)) - 1) ^ packets_owned
+
+
+"""
+Função que pede ao FS_Tracker os FS_Nodes que possuem cada um dos ficheiros 'fileNames', devolvendo um dicionário com a
+resposta de cada ficheiro, no formato de receive_message_TCP, ou None caso o FS_Tracker não conheça o ficheiro. Na versão 2
+todos os ficheiros são pedidos numa só trama (id_mode==9), com as mesmas regras de downloadFile para cada ficheiro, em vez
+de um pedido por ficheiro, e, caso SUBSCRIBE_TO_SWARMS, o mesmo pedido subscreve as alterações dos FS_Nodes de cada ficheiro
+(id_mode==10). Na versão 1 é feito um pedido por ficheiro.
+
+As respostas são lidas pela thread que lê o socket TCP (ver Tracker_listener_thread) e entregues por 'subscriptions'.
+"""
+def get_files_owners(s, send_lock_TCP, subscriptions, FS_Node_DB, fileNames):
+	with send_lock_TCP:
+		if Message_Protocols.get_protocol_version(s) >= 2:
+			files = [[fileName, get_packets_needed(FS_Node_DB, fileName)] for fileName in fileNames]
+			if SUBSCRIBE_TO_SWARMS:
+				for fileName in fileNames:
+					subscriptions.add(fileName)
+			Message_Protocols.send_message_TCP(s, send_lock_TCP, [MAX_OWNERS_PER_REQUEST, files], True, 10 if SUBSCRIBE_TO_SWARMS else 9)
+			owners = subscriptions.receive_reply()
+			return owners if isinstance(owners, dict) else {}
+
+		owners = {}
+		for fileName in fileNames:
+			Message_Protocols.send_message_TCP(s, send_lock_TCP, fileName, True, 0)
+			owners[fileName] = subscriptions.receive_reply()
+		return owners
+
+
+"""
+Função que transfere um ficheiro a partir da resposta do FS_Tracker com os FS_Nodes que o possuem ('FS_Nodes'), pedindo
+antes, na versão 2, o manifesto e a raridade dos pacotes do ficheiro (ver downloadFile).
+
+Caso o ficheiro tenha sido subscrito, a lista de FS_Nodes passa a receber as alterações enviadas pelo FS_Tracker. Quando as
+threads terminam sem o ficheiro completo e a lista mudou entretanto, os pacotes em falta voltam a ser pedidos, no máximo
+MAX_DOWNLOAD_PASSES vezes, pois os pacotes de que as threads desistiram podem ter passado a existir noutros FS_Nodes.
 """
-def downloadFile(s, send_lock_TCP, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock, write_lock, threads_per_request, FS_Node_DB, files_path, fileName, cache_DNS):
+def transferFile(s, send_lock_TCP, subscriptions, packet_updates, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock, write_lock, threads_per_request, FS_Node_DB, files_path, path_to_manifests, fileName, FS_Nodes, cache_DNS, peers_version):
 
-	# Pede ao FS_Tracker os FS_Nodes que possuem informação sobre o ficheiro
+	manifest = b''
+	rarity = []
 	send_lock_TCP.acquire()
-	Message_Protocols.send_message_TCP(s, send_lock_TCP, fileName, True, 0)
-	FS_Nodes = Message_Protocols.receive_message_TCP(s, False)
+	if FS_Nodes and FS_Nodes!=-1 and Message_Protocols.get_protocol_version(s) >= 2:
+		Message_Protocols.send_message_TCP(s, send_lock_TCP, fileName, True, 5)
+		manifest = subscriptions.receive_reply()
+		Message_Protocols.send_message_TCP(s, send_lock_TCP, fileName, True, 6)
+		rarity = subscriptions.receive_reply()
 	send_lock_TCP.release()
 
-	# Cria uma lista para guardar as threads
-	threads = []
-	if FS_Nodes!=None:
+	if FS_Nodes!=None and FS_Nodes!=-1:
+
+		# Na versão 2, o FS_Tracker indica também o tamanho dos pacotes do ficheiro
+		block_size = PACKET_SIZE
+		if isinstance(FS_Nodes[0], tuple):
+			FS_Nodes[0], block_size = FS_Nodes[0]
+
 		# Adiciona o ficheiro à lista de ficheiros, mas com 0 pacotes
-		FS_Node_DB.add_files([[fileName, FS_Nodes[0], 0]])
+		FS_Node_DB.add_files([[fileName, FS_Nodes[0], 0, block_size]])
+		if manifest!=-1:
+			FS_Node_DB.set_manifest(fileName, manifest)
+
+		# Cria o ficheiro se ele não existir
+		if not os.path.exists(files_path + fileName):
+			with open(files_path + fileName, 'w') as new_file:
+				pass
 
 		# Converte as posições onde apenas tem um endereço IP, pois o ficheiro está completo, para um tuplo do mesmo formato se o ficheiro fosse completo (IP_address, packets)
-		FS_Nodes = convert_complete_FS_Nodes(FS_Nodes, cache_DNS)
+		FS_Nodes = convert_complete_FS_Nodes(FS_Nodes, cache_DNS, peers_version)
+
+		# Aplica à lista de FS_Nodes as alterações recebidas do FS_Tracker, caso o ficheiro tenha sido subscrito
+		subscriptions.attach(fileName, FS_Nodes)
 
 		# Organiza a informação recebida pelos pacotes mais raros, sendo estes pedidos primeiro
-		priority_queue = FS_Node_DB.get_rarest_packets(FS_Nodes)
+		if rarity!=-1 and rarity and len(rarity)==FS_Nodes[0]:
+			priority_queue = FS_Node_DB.sort_packets_by_rarity(rarity)
+		else:
+			priority_queue = FS_Node_DB.get_rarest_packets(FS_Nodes)
 
-		# Cria um lock para assegurar que cada thread só acede a uma posição
-		index = IntegerInstance.IntegerInstance(0)
-		lock_priority_queue = threading.RLock()
+		for download_pass in range(MAX_DOWNLOAD_PASSES):
+			changes = subscriptions.get_changes(fileName)
 
-		# Vai buscar os pacotes e guarda-os na base de dados do próprio FS_Node e atualiza os ficheiros do mesmo
-		for i in range(threads_per_request):
-			thread = threading.Thread(target=get_file_Thread, args=(s, send_lock_TCP, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock, FS_Node_DB, FS_Nodes, files_path, fileName, priority_queue, index, lock_priority_queue))
-			thread.start()
-			threads.append(thread)
-		
-		# Espera que todas as threads terminem de ir buscar os pacotes
-		for thread in threads:
-			thread.join()
+			# Cria um lock para assegurar que cada thread só acede a uma posição
+			index = IntegerInstance.IntegerInstance(0)
+			lock_priority_queue = threading.RLock()
+
+			# Vai buscar os pacotes e guarda-os na base de dados do próprio FS_Node e atualiza os ficheiros do mesmo, guardando as threads numa lista
+			threads = []
+			for i in range(threads_per_request):
+				thread = threading.Thread(target=get_file_Thread, args=(packet_updates, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock, FS_Node_DB, FS_Nodes, files_path, fileName, priority_queue, index, lock_priority_queue))
+				thread.start()
+				threads.append(thread)
+
+			# Espera que todas as threads terminem de ir buscar os pacotes
+			for thread in threads:
+				thread.join()
+
+			# Volta a pedir os pacotes em falta apenas se a lista de FS_Nodes mudou durante a transferência
+			priority_queue = [packet for packet in priority_queue if not FS_Node_DB.check_packet_file(fileName, packet)]
+			if not priority_queue or subscriptions.get_changes(fileName) == changes:
+				break
+
+		# Termina a subscrição do ficheiro
+		subscriptions.remove(fileName)
+
+		# Envia ao FS_Tracker as atualizações dos pacotes do ficheiro que ainda não foram enviadas
+		packet_updates.flush(fileName)
 		
 		
 		# Verifica se foi possível transferir o ficheiro completo
 		progress = FS_Node_DB.get_number_packets_completed(fileName)
 		if progress!=-1:
 			if (progress[0]==progress[1]):
+				if manifest and manifest!=-1:
+					save_manifest(path_to_manifests, fileName, manifest)
 				write_lock.acquire()
 				print(f"O ficheiro {fileName} já está completo.")
 				write_lock.release()
@@ -382,6 +626,7 @@ def downloadFile(s, send_lock_TCP, send_queue_UDP, send_queue_UDP_lock, send_que
 				write_lock.release()
 
 	else:
+		subscriptions.remove(fileName)
 		write_lock.acquire()
 		print(f"Nenhum FS_Node possuí o ficheiro {fileName}.")
 		write_lock.release()
@@ -392,15 +637,18 @@ Função responsável por fazer parsing do pedido do utilizador e executar o ped
 "ls" então a thread imprime no ecrã os nomes de todos os ficheiros completos e incompletos que o FS_Node possuí. Caso
 o utilizador acrscente a flag -c, imprime apenas o nome dos ficheiros completos e se a flag acrescentada for -i,
 imprime apenas os incompletos. Se o utilizador fizer o pedido "check" então será imprimida a percentagem de um ficheiro
-à sua escolha ou então de todos os ficheiros, se pretender. Por fim, caso o pedido seja "get" a função chamará outra
-função responsável por obter o ficheiro pretendido.
+à sua escolha ou então de todos os ficheiros, se pretender. Caso o pedido seja "get" a função chamará outra
+função responsável por obter o ficheiro pretendido, ou os ficheiros pretendidos caso seja indicado mais do que um nome. Por fim, o pedido "stats" imprime os contadores da compressão dos
+pacotes enviados a outros FS_Nodes.
 
 Importante salientar que as escritas no ecrã são controladas por um lock de forma a não misturar escritas.
 """
-def requests_handler_thread(s, send_lock_TCP, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock, write_lock, threads_per_request, FS_Node_DB, files_path, user_input, cache_DNS):
+def requests_handler_thread(s, send_lock_TCP, subscriptions, packet_updates, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock, write_lock, threads_per_request, FS_Node_DB, files_path, path_to_manifests, user_input, cache_DNS, peers_version, block_size, block_compressor):
 	if (command := user_input.strip().split())[0].lower() == "get" and len(command)==2:
 		fileName = command[1]
-		downloadFile(s, send_lock_TCP, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock, write_lock, threads_per_request, FS_Node_DB, files_path, fileName, cache_DNS)
+		downloadFile(s, send_lock_TCP, subscriptions, packet_updates, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock, write_lock, threads_per_request, FS_Node_DB, files_path, path_to_manifests, fileName, cache_DNS, peers_version)
+	elif command[0].lower() == "get" and len(command)>2:
+		downloadFiles(s, send_lock_TCP, subscriptions, packet_updates, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock, write_lock, threads_per_request, FS_Node_DB, files_path, path_to_manifests, command[1:], cache_DNS, peers_version)
 	elif (user_input.lower().strip()=="ls"):
 		name_files = FS_Node_DB.get_files_names(0)
 		write_lock.acquire()
@@ -449,20 +697,23 @@ def requests_handler_thread(s, send_lock_TCP, send_queue_UDP, send_queue_UDP_loc
 				print(f"{command[1]} -> [{progress_bar}] {progress} out of {progress[1]}")
 				write_lock.release()
 	elif (command := user_input.lower().strip().split())[0] == "delete" and ((command[1] == "-all" and len(command)==2) or (command[1] == "-f" and len(command)==3) or (command[1] == "-p" and len(command)==4)):
+
+		# A remoção de cada ficheiro é enviada depois das suas atualizações de pacotes pendentes (ver Packet_Updates.remove)
 		if command[1]=="-all":
 			files = FS_Node_DB.get_files()
-			for file in files:
-				packets = FS_Node_DB.get_packets_file(file)
-				Message_Protocols.send_message_TCP(s, send_lock_TCP, [file, packets], True, 3)
+			for file, _, packets, _ in files:
+				packet_updates.remove(file, packets)
 				FS_Node_DB.remove_file(file)
 				os.remove(files_path + file)
+				remove_manifest(path_to_manifests, file)
 		elif command[1] == "-f":
 			file = command[2]
 			packets = FS_Node_DB.get_packets_file(file)
 			if packets!=None:
-				Message_Protocols.send_message_TCP(s, send_lock_TCP, [file, packets], True, 3)
+				packet_updates.remove(file, packets)
 				FS_Node_DB.remove_file(file)
 				os.remove(files_path + file)
+				remove_manifest(path_to_manifests, file)
 			else:
 				print("You don't have that file.")
 		elif command[1] == "-p":
@@ -474,9 +725,10 @@ def requests_handler_thread(s, send_lock_TCP, send_queue_UDP, send_queue_UDP_loc
 					Message_Protocols.send_message_TCP(s, send_lock_TCP, [file, packet], True, 2)
 
 					# Apaga o pacote do ficheiro respetivo
+					file_block_size = FS_Node_DB.get_block_size(file)
 					with open(files_path + file, 'r+b') as file:
-						file.seek(packet * PACKET_SIZE)
-						file.write(b'\0' * PACKET_SIZE)
+						file.seek(packet * file_block_size)
+						file.write(b'\0' * file_block_size)
 				else:
 					print("You don't have that packet.")
 			else:
@@ -489,14 +741,26 @@ def requests_handler_thread(s, send_lock_TCP, send_queue_UDP, send_queue_UDP_loc
 		if os.path.exists(files_path) and os.path.isdir(files_path):
 
 			# Percorre os ficheiros à procura de novos
-			files_owned = FS_Node_DB.get_files_names(0)
+			files_owned = set(FS_Node_DB.get_files_names(0))
+			new_files = []
 			for file_name in os.listdir(files_path):
 				file_path = os.path.join(files_path, file_name)
 				if os.path.isfile(file_path) and file_name not in files_owned:
 					file_size = os.path.getsize(file_path)
-					n_packets_file = math.ceil(file_size / PACKET_SIZE)
-					FS_Node_DB.add_files([[file_name, n_packets_file, -1]])
-					Message_Protocols.send_message_TCP(s, send_lock_TCP, [[file_name, n_packets_file, -1]], True, 1)
+					n_packets_file = math.ceil(file_size / block_size)
+					new_files.append([file_name, n_packets_file, -1, block_size])
+
+			# Informa o FS_Tracker de todos os ficheiros novos num único anúncio
+			if new_files:
+				FS_Node_DB.add_files(new_files)
+				Message_Protocols.send_announcement_TCP(s, send_lock_TCP, new_files)
+				publish_manifests(s, send_lock_TCP, FS_Node_DB, files_path, path_to_manifests, new_files)
+	elif (user_input.lower().strip()=="stats"):
+		stats = block_compressor.get_stats()
+		write_lock.acquire()
+		print(f"Pacotes comprimidos: {stats['compressed']} | Enviados sem compressão: {stats['skipped']} | Acertos na cache: {stats['cache_hits']}")
+		print(f"Bytes poupados: {stats['bytes_saved']} de {stats['bytes_in']} | Tempo de CPU: {stats['cpu_seconds']:.3f} s")
+		write_lock.release()
 	else:
 
 		# Executa caso o comando introduzido pelo utilizador não exista, informando o mesmo que o comando não existe
@@ -506,70 +770,136 @@ def requests_handler_thread(s, send_lock_TCP, send_queue_UDP, send_queue_UDP_loc
 
 
 """
+Função que entrega um pacote recebido à thread que o pediu, guardando-o no dicionário de respostas e acordando a thread.
+Os pacotes que não foram pedidos ou cuja entrada já expirou são ignorados.
+"""
+def deliver_packet(replies_Dic, fileName_packetNumber, data):
+
+	# Atualiza o dicionário de pacotes recebidos e acorda a thread que estava à espera do pacote correspondente
+	value = replies_Dic.get(fileName_packetNumber)
+	if value==None:
+		return
+
+	# Verifica se o pacote não foi recebido anteriormente
+	if (value[3]==None or len(value[3])==0):
+		value[0] = time.time()
+		value[3] = data
+	
+	# Avisa a thread caso esta já não tenha sido avisada
+	value[1].acquire()
+	value[2].notify()
+	value[1].release()
+
+
+"""
+Thread que recebe os datagramas de outros FS_Nodes. Os pedidos de pacotes são lidos do ficheiro correspondente, com o
+tamanho de pacote do ficheiro, e colocados na fila de envio. As respostas são entregues às threads que as pediram e os
+fragmentos de pacotes maiores do que um datagrama são juntos até o pacote estar completo.
 
+O argumento 'max_datagram' é o tamanho máximo dos datagramas que o FS_Node aceita, que é também o tamanho do buffer de
+receção (nunca inferior ao tamanho dos datagramas da versão 1).
 """
-def UDP_listener_thread(socket_UDP, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, files_path):
+def UDP_listener_thread(socket_UDP, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, files_path, FS_Node_DB, max_datagram):
+
+	# Pacotes que estão a ser reconstruídos a partir de fragmentos -> {fileName_packetNumber: [dados, posições recebidas, bytes recebidos]}
+	fragments = {}
+	buffer_size = max(max_datagram, Message_Protocols.V1_DATAGRAM_SIZE)
 
 	# Recebe os pacotes pedidos e recebe ainda pedidos de pacotes de outros FS_Nodes
 	while (True):
 
 		# Recebe um pedido
-		message = Message_Protocols.receive_message_UDP(socket_UDP)
+		message = Message_Protocols.receive_message_UDP(socket_UDP, buffer_size)
 
 		if message!=-1:
 			# Verifica se é um pedido de pacote ou uma resposta a um pedido de pacote (0 se for um pedido, 1 se for uma resposta)
 			if message[0]==0:
-				destiny, fileName, packet_index = message[1:]
-			
-				# Verifica se o pacote pedido está no dicionário de pacotes
-				if (packet := replies_Dic.get(files_path + fileName))!=None and packet[3]!=None and len(packet[3])>0:
-
-					# Atualiza o timestamp associado ao pacote
-					packet[0] = time.time()
-					
-					# Adiciona o pacote à lista de mensagens a enviar para outros FS_Nodes
-					send_queue_UDP_lock.acquire()
-					send_queue_UDP.append([1, fileName, packet_index, packet, destiny])
-					send_queue_UDP_condition.notify()
-					send_queue_UDP_lock.release()
+				destiny, fileName, packet_index, flags, version = message[1:]
 
 				# Verifica se o ficheiro existe
-				elif (os.path.exists(files_path + fileName)):
+				if (os.path.exists(files_path + fileName)):
 					
 					# Lê um pacote de um ficheiro
+					block_size = FS_Node_DB.get_block_size(fileName)
 					with open(files_path + fileName, 'rb') as file:
-						file.seek(packet_index * PACKET_SIZE)
-						packet = file.read(PACKET_SIZE)
+						file.seek(packet_index * block_size)
+						packet = file.read(block_size)
 					
 					# Adiciona o pacote à lista de mensagens a enviar para outros FS_Nodes
 					send_queue_UDP_lock.acquire()
-					send_queue_UDP.append([1, fileName, packet_index, packet, destiny])
+					send_queue_UDP.append([1, fileName, packet_index, packet, destiny, version, flags])
 					send_queue_UDP_condition.notify()
 					send_queue_UDP_lock.release()
 
-			elif message[0]==1:
+			# Pedido de vários pacotes, ao qual responde com um datagrama por cada pacote
+			elif message[0]==2:
+				destiny, fileName, packets_index, requester_max_datagram, flags, version = message[1:]
 
-				fileName_packetNumber, data = message[2:]
+				if (os.path.exists(files_path + fileName)):
 
-				# Atualiza o dicionário de pacotes recebidos e acorda a thread que estava à espera do pacote correspondente
-				value = replies_Dic.get(fileName_packetNumber)
-				
-				# Verifica se o pacote não foi recebido anteriormente
-				if (value!=None and (value[3]==None or len(value[3])==0)):
-					value[0] = time.time()
-					value[3] = data
-				
-				# Avisa a thread caso esta já não tenha sido avisada
-				value[1].acquire()
-				value[2].notify()
-				value[1].release()
+					# Lê todos os pacotes pedidos de uma só vez
+					block_size = FS_Node_DB.get_block_size(fileName)
+					burst = []
+					with open(files_path + fileName, 'rb') as file:
+						for packet_index in packets_index:
+							file.seek(packet_index * block_size)
+							burst.append((packet_index, file.read(block_size)))
+
+					# Adiciona os pacotes à lista de mensagens a enviar para outros FS_Nodes
+					send_queue_UDP_lock.acquire()
+					send_queue_UDP.append([3, fileName, burst, destiny, version, requester_max_datagram, flags])
+					send_queue_UDP_condition.notify()
+					send_queue_UDP_lock.release()
+
+			elif message[0]==1:
+				deliver_packet(replies_Dic, message[2], message[3])
+
+			# Fragmento de um pacote maior do que um datagrama, que pode estar comprimido
+			elif message[0]==3:
+				fileName_packetNumber, (offset, block_length, data, compressed) = message[2:4]
+
+				if (entry := fragments.get(fileName_packetNumber))==None or len(entry[0])!=block_length or entry[3]!=compressed:
+					# Limita o número de pacotes incompletos, descartando os fragmentos de pacotes que nunca foram completados
+					if len(fragments) > 1024:
+						fragments.clear()
+					entry = fragments[fileName_packetNumber] = [bytearray(block_length), set(), 0, compressed]
+
+				if offset not in entry[1] and offset + len(data) <= block_length:
+					entry[0][offset:offset+len(data)] = data
+					entry[1].add(offset)
+					entry[2] += len(data)
+
+					if entry[2]==block_length:
+						del fragments[fileName_packetNumber]
+						packet = bytes(entry[0])
+						if compressed:
+							try:
+								packet = zlib.decompress(packet)
+							except zlib.error:
+								continue
+						deliver_packet(replies_Dic, fileName_packetNumber, packet)
 
 
 """
 Tipo 0 -> [0, RWLock, RWLock_Condition, [fileName, packet_to_check, FS_Node_address]]
-Tipo 1 -> [1, fileName, packet_index, packet_data, destiny]
+Tipo 1 -> [1, fileName, packet_index, packet_data, destiny, version, flags]
+Tipo 2 -> [2, RWLock, RWLock_Condition, [fileName, [packet_to_check, ...], FS_Node_address]]
+Tipo 3 -> [3, fileName, [(packet_index, packet_data), ...], destiny, version, max_datagram, flags]
+
+Os pedidos são enviados na versão do protocolo que o FS_Tracker indicou para o FS_Node de destino e as respostas na
+versão em que o pedido foi recebido. Os pedidos de vários pacotes (tipo 2) são enviados num único datagrama aos FS_Nodes
+da versão 2 e num datagrama por pacote aos FS_Nodes da versão 1. As respostas a esses pedidos (tipo 3) são enviadas em
+rajada, um datagrama por pacote.
+
+Na versão 2, os pacotes são fragmentados de forma a que nenhum datagrama ultrapasse o menor entre o tamanho máximo que o
+FS_Node que pediu aceita e o MTU do caminho até ele. Nos pedidos é enviado o tamanho máximo que este FS_Node aceita
+('max_datagram') e, se REQUEST_COMPRESSION estiver ativo, o pedido para os pacotes virem comprimidos. As respostas aos
+FS_Nodes que pediram pacotes comprimidos passam pelo 'block_compressor', que decide pacote a pacote se a compressão compensa.
 """
-def UDP_sender_thread(socket_UDP, my_address, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock):
+def UDP_sender_thread(socket_UDP, my_address, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock, peers_version, max_datagram, block_compressor):
+
+	request_flags = Message_Protocols.REQUEST_FLAG_COMPRESS if REQUEST_COMPRESSION else 0
+
 
 	# Envia os pedidos de pacotes e as respostas a pedidos de pacotes de outros FS_Nodes
 	while True:
@@ -594,7 +924,7 @@ def UDP_sender_thread(socket_UDP, my_address, send_queue_UDP, send_queue_UDP_loc
 				replies_Dic_lock.acquire()
 				replies_Dic[entry] =  [timestamp, message[1], message[2], None]
 				replies_Dic_lock.release()
-				Message_Protocols.send_message_UDP(0, socket_UDP, fileName, packet, None, destiny)
+				Message_Protocols.send_message_UDP(0, socket_UDP, fileName, packet, None, destiny, peers_version.get(destiny, 1), max_datagram, request_flags)
 			elif (response[3]==None):
 
 				# Verifica se o lock e condition associada à entrada é o da thread que está a pedir o pacote
@@ -602,10 +932,42 @@ def UDP_sender_thread(socket_UDP, my_address, send_queue_UDP, send_queue_UDP_loc
 					response[1] = message[1]
 					response[2] = message[2]
 				response[0] = timestamp
-				Message_Protocols.send_message_UDP(0, socket_UDP, fileName, packet, None, destiny)
+				Message_Protocols.send_message_UDP(0, socket_UDP, fileName, packet, None, destiny, peers_version.get(destiny, 1), max_datagram, request_flags)
 		
 		elif message[0] == 1:
-			Message_Protocols.send_message_UDP(1, socket_UDP, message[1], message[2], message[3], message[4])
+			datagram_size = Message_Protocols.probe_path_MTU(message[4]) - Message_Protocols.UDP_IP_OVERHEAD
+			compressor = block_compressor if message[6] & Message_Protocols.REQUEST_FLAG_COMPRESS else None
+			Message_Protocols.send_message_UDP(1, socket_UDP, message[1], message[2], message[3], message[4], message[5], datagram_size, compressor=compressor)
+
+		elif message[0] == 2:
+			timestamp = time.time()
+			fileName, packets, destiny = message[3]
+
+			# Cria ou atualiza as entradas de todos os pacotes do pedido, associando-as à thread que está a pedir os pacotes
+			replies_Dic_lock.acquire()
+			for packet in packets:
+				entry = fileName + str(packet)
+				if (response := replies_Dic.get(entry))==None:
+					replies_Dic[entry] = [timestamp, message[1], message[2], None]
+				elif (response[3]==None):
+					response[0] = timestamp
+					response[1] = message[1]
+					response[2] = message[2]
+			replies_Dic_lock.release()
+
+			version = peers_version.get(destiny, 1)
+			if version >= 2:
+				Message_Protocols.send_message_UDP(2, socket_UDP, fileName, packets, None, destiny, version, max_datagram, request_flags)
+			else:
+				for packet in packets:
+					Message_Protocols.send_message_UDP(0, socket_UDP, fileName, packet, None, destiny, version)
+
+		elif message[0] == 3:
+			datagram_size = Message_Protocols.probe_path_MTU(message[3]) - Message_Protocols.UDP_IP_OVERHEAD
+			datagram_size = min(datagram_size, message[5])
+			compressor = block_compressor if message[6] & Message_Protocols.REQUEST_FLAG_COMPRESS else None
+			for packet_index, packet_data in message[2]:
+				Message_Protocols.send_message_UDP(1, socket_UDP, message[1], packet_index, packet_data, message[3], message[4], datagram_size, compressor=compressor)
 
 
 """
@@ -621,24 +983,107 @@ def Cache_cleaner_thread(replies_Dic, replies_Dic_lock, expire_time):
 
 		# Percorre todas as entradas do dicionário e remove as que já existem há mais de X tempo
 		replies_Dic_lock.acquire()
-		for key, info in replies_Dic.items():
+		for key, info in list(replies_Dic.items()):
 			if ((timestamp - info[0]) > expire_time):
 				del replies_Dic[key]
 		replies_Dic_lock.release()
 
 
+"""
+Thread responsável por enviar ao FS_Tracker as atualizações de pacotes que estão por enviar há mais de MAX_PENDING_TIME
+segundos, para o FS_Tracker não ficar desatualizado quando o FS_Node recebe poucos pacotes.
+"""
+def Packet_Updates_thread(packet_updates):
+
+	while True:
+		packet_updates.wait_expired()
+		packet_updates.flush()
+
+
+"""
+Thread responsável por ler todas as mensagens que o FS_Tracker envia na conexão TCP, depois de negociada a versão do protocolo.
+As respostas aos pedidos são entregues, pela ordem de chegada, às threads que as esperam (ver Swarm_Subscriptions) e as
+alterações dos FS_Nodes dos ficheiros subscritos (REPLY_OWNERS_DELTA), que o FS_Tracker envia sem pedido, são aplicadas às
+listas de FS_Nodes das transferências, com os endereços convertidos da mesma forma que a resposta do FS_Tracker. Quando o
+FS_Tracker indica que descartou alterações (REPLY_OWNERS_RESYNC), é iniciada a thread que volta a pedir os ficheiros
+subscritos (ver Swarm_resync_thread), pois esta thread não pode esperar pela resposta que ela própria lê.
+
+Quando a conexão é fechada, os pedidos à espera de resposta, e os seguintes, recebem -1 e a thread termina.
+"""
+def Tracker_listener_thread(s, subscriptions, FS_Node_DB, cache_DNS, peers_version):
+
+	while True:
+		frame = None
+		try:
+			if Message_Protocols.get_protocol_version(s) < 2:
+				reply = Message_Protocols.receive_message_TCP(s, False)
+			elif (frame := Message_Protocols.receive_frame_TCP(s)) is None:
+				reply = -1
+		except OSError:
+			frame = None
+			reply = -1
+
+		# Apenas os erros do socket terminam a thread, pelo que as tramas são convertidas fora do bloco anterior
+		if frame is not None:
+			if frame[0]==Message_Protocols.REPLY_OWNERS_DELTA:
+				fileName, peers = Message_Protocols.decode_message_TCP_v2(frame, False)
+				subscriptions.apply(fileName, [convert_FS_Node(peer, cache_DNS, peers_version) for peer in peers])
+				continue
+			elif frame[0]==Message_Protocols.REPLY_OWNERS_RESYNC:
+				if subscriptions.request_resync():
+					thread = threading.Thread(target=Swarm_resync_thread, args=(s, subscriptions, FS_Node_DB, cache_DNS, peers_version))
+					thread.start()
+				continue
+			reply = Message_Protocols.decode_message_TCP_v2(frame, False)
+
+		subscriptions.deliver_reply(reply)
+		if reply == -1:
+			return
+
+
+"""
+Thread que volta a pedir ao FS_Tracker os FS_Nodes de todos os ficheiros subscritos (id_mode==10, com as mesmas regras de
+get_files_owners), depois de o FS_Tracker ter descartado alterações, e substitui a lista de FS_Nodes de cada ficheiro pela
+resposta (ver Swarm_Subscriptions.reset). Os ficheiros cuja subscrição terminou entretanto voltam a ser removidos no
+FS_Tracker, pois o pedido voltou a subscrevê-los. Repete enquanto houver ressincronizações pedidas.
+"""
+def Swarm_resync_thread(s, subscriptions, FS_Node_DB, cache_DNS, peers_version):
+	send_lock_TCP = subscriptions.send_lock_TCP
+	while True:
+		with send_lock_TCP:
+			if (fileNames := subscriptions.take_resync()) is None:
+				return
+			if not fileNames:
+				continue
+			files = [[fileName, get_packets_needed(FS_Node_DB, fileName)] for fileName in fileNames]
+			Message_Protocols.send_message_TCP(s, send_lock_TCP, [MAX_OWNERS_PER_REQUEST, files], True, 10)
+			owners = subscriptions.receive_reply()
+		if not isinstance(owners, dict):
+			return
+
+		for fileName, FS_Nodes in owners.items():
+			peers = [convert_FS_Node(peer, cache_DNS, peers_version) for peer in FS_Nodes[1:]] if FS_Nodes else []
+			if not subscriptions.reset(fileName, peers):
+				Message_Protocols.send_message_TCP(s, send_lock_TCP, fileName, True, 11)
+
+
 """
 
 """
 def Main():
 
 	# Vai buscar os argumentos fornecidos pelo cliente
-	if len(sys.argv) != 9:
+	if len(sys.argv) not in (9, 10, 11):
 		print("Argumentos introduzidos errados.")
-		print("Formato Correto: python3 FS_Node.py Node_IP Node_Port Tracker_Name Tracker_Port threads_per_request files_path metadados_path")
+		print("Formato Correto: python3 FS_Node.py Node_IP Node_Port Tracker_Name Tracker_Port threads_per_request files_path metadados_path expire_time [block_size] [mtu]")
 		return
 
-	Node_Name, Node_Port, Tracker_Name, Tracker_Port, threads_per_request, files_path, metadados_path, expire_time = sys.argv[1:]
+	Node_Name, Node_Port, Tracker_Name, Tracker_Port, threads_per_request, files_path, metadados_path, expire_time = sys.argv[1:9]
+
+	# Tamanho dos pacotes dos ficheiros novos e MTU da rede, opcionais
+	block_size = int(sys.argv[9]) if len(sys.argv) > 9 else PACKET_SIZE
+	mtu = int(sys.argv[10]) if len(sys.argv) > 10 else Message_Protocols.DEFAULT_MTU
+	max_datagram = mtu - Message_Protocols.UDP_IP_OVERHEAD
 
 	# Vai buscar o Nome do node ao servidor DNS
 	Node_IP = socket.gethostbyname(Node_Name)
@@ -649,6 +1094,9 @@ def Main():
 	# Caminho para os metadados caso estes existam
 	path_to_metadata = metadados_path + "metadata" + Node_IP + Node_Port + ".txt"
 
+	# Pasta onde são guardados os manifestos dos ficheiros
+	path_to_manifests = metadados_path + "manifests" + Node_IP + Node_Port + "/"
+
 	# Lock para escrever no terminal
 	write_lock = threading.RLock()
 
@@ -682,20 +1130,46 @@ def Main():
 	# Cria a cache responsável por guardar os mapeamentos Nome->IP de pedidos ao servidor DNS anteriores
 	cache_DNS = {}
 
+	# Cria o dicionário com a versão do protocolo suportada por cada FS_Node, de acordo com o FS_Tracker
+	peers_version = {}
+
+	# Cria o compressor dos pacotes enviados aos FS_Nodes que os pedem comprimidos
+	block_compressor = Message_Protocols.Block_Compressor()
+
 	# Cria as threads que serão responsáveis por gerir o socket UDP, uma para enviar, outra para receber dados e outra para limpar a cache de pacotes
-	thread = threading.Thread(target=UDP_sender_thread, args=(socket_UDP, my_address, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock))
+	thread = threading.Thread(target=UDP_sender_thread, args=(socket_UDP, my_address, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock, peers_version, max_datagram, block_compressor))
 	thread.start()
-	thread = threading.Thread(target=UDP_listener_thread, args=(socket_UDP, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, files_path))
+	thread = threading.Thread(target=UDP_listener_thread, args=(socket_UDP, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, files_path, FS_Node_DB, max_datagram))
 	thread.start()
 	thread = threading.Thread(target=Cache_cleaner_thread, args=(replies_Dic, replies_Dic_lock, expire_time))
 	thread.start()
 
+	# Negoceia com o FS_Tracker a versão do protocolo a usar na conexão
+	version = Message_Protocols.negotiate_protocol_version(s, send_lock_TCP)
+
+	# Cria a estrutura que entrega as respostas do FS_Tracker e as alterações dos ficheiros subscritos e a thread que lê o socket TCP
+	subscriptions = Swarm_Subscriptions(s, send_lock_TCP)
+	thread = threading.Thread(target=Tracker_listener_thread, args=(s, subscriptions, FS_Node_DB, cache_DNS, peers_version))
+	thread.start()
+
+	# Cria a estrutura que junta as atualizações de pacotes enviadas ao FS_Tracker e a thread que as envia periodicamente
+	packet_updates = Packet_Updates(s, send_lock_TCP)
+	thread = threading.Thread(target=Packet_Updates_thread, args=(packet_updates,))
+	thread.start()
+
+	# Um FS_Tracker da versão 1 só conhece pacotes com o tamanho original
+	if version < 2:
+		block_size = PACKET_SIZE
+
 	# Popula a base de dados do FS_Node com os ficheiros que este possuí
-	initial_files = fetch_files(files_path, path_to_metadata)
+	initial_files = fetch_files(files_path, path_to_metadata, block_size)
 	FS_Node_DB.add_files(initial_files)
 
-	# Envia para o FS_Tracker os ficheiros ou partes de ficheiros que possuí
-	Message_Protocols.send_message_TCP(s, send_lock_TCP, initial_files, True, 1)
+	# Envia para o FS_Tracker os ficheiros ou partes de ficheiros que possuí, dividindo o anúncio em várias tramas se necessário
+	Message_Protocols.send_announcement_TCP(s, send_lock_TCP, initial_files)
+
+	# Publica no FS_Tracker os manifestos dos ficheiros completos
+	publish_manifests(s, send_lock_TCP, FS_Node_DB, files_path, path_to_manifests, initial_files)
 
 	# Sinal ativado quando o clinte termina o programa premindo ctrl+c
 	signal.signal(signal.SIGINT, lambda signum, frame: signal_handler(signum, frame, path_to_metadata, FS_Node_DB))
@@ -706,7 +1180,7 @@ def Main():
 		if (user_input.lower().strip()!="exit"):
 
 			# Cria uma thread que será responsável por executar um pedido do utilizador
-			thread = threading.Thread(target=requests_handler_thread, args=(s, send_lock_TCP, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock, write_lock, threads_per_request, FS_Node_DB, files_path, user_input, cache_DNS))
+			thread = threading.Thread(target=requests_handler_thread, args=(s, send_lock_TCP, subscriptions, packet_updates, send_queue_UDP, send_queue_UDP_lock, send_queue_UDP_condition, replies_Dic, replies_Dic_lock, write_lock, threads_per_request, FS_Node_DB, files_path, path_to_manifests, user_input, cache_DNS, peers_version, block_size, block_compressor))
 			thread.start()
 		else:
 
@@ -4,8 +4,10 @@ os ficheiros que o mesmo possuí. A esta classe temos associadas funções de ad
 de forma, a fazer uma gestão da base de dados.
 """
 
+import hashlib
 import threading
 from ReentrantRWLock import ReentrantRWLock
+from Message_Protocols import DEFAULT_BLOCK_SIZE, PIECE_HASH_SIZE
 
 
 
@@ -13,43 +15,52 @@ class FS_Node_DataBase():
 
 	"""
 	Estrutura que guarda a informação relativa aos ficheiros ou partes de ficheiros que o FS_Node possuí. Contem um
-	dicionário em que cada key corresponde o nome do ficheiro e cada value associada à key é uma lista de 3 elementos.
+	dicionário em que cada key corresponde o nome do ficheiro e cada value associada à key é uma lista de 4 elementos.
 	O primeiro elemento é um RWLock, para prevenir que duas threads alterem os dados relativos a um ficheiro em simultâneo,
-	gerando resultados, errados. O segundo elemento é o número de pacotes em que o ficheiro está dividido e o terceiro é um
-	inteiro representante dos pacotes que o FS_Node possuí.
+	gerando resultados, errados. O segundo elemento é o número de pacotes em que o ficheiro está dividido, o terceiro é um
+	inteiro representante dos pacotes que o FS_Node possuí e o quarto é o tamanho em bytes de cada pacote.
 
-	Exemplo da estrutura: {file1: [LOCK, 20, 74215]}
+	Exemplo da estrutura: {file1: [LOCK, 20, 74215, 1024]}
 
 	Importante salientar que há ainda um lock associado de forma a prevenir que duas threads alterem a estrutura em simultâneo
+
+	É guardado ainda, para os ficheiros de que o FS_Node conhece o manifesto, a hash SHA-256 de cada pacote concatenadas pela
+	ordem dos pacotes.
+
+	Exemplo da estrutura: {file1: b'...'}
 	"""
 	def __init__(self):
 		self.files = {}
+		self.manifests = {}
 		self.lock = threading.Lock()
 
 
 	"""
-	Função que retorna a informação de todos os ficheiros que o FS_Node possuí, sob a forma de uma lista de tuplos com 3
-	elementos cada. O primeiro elemnto é o nome do ficheiro, o segundo o número de pacotes em que o ficheiro está dividido
-	e o terceiro o inteiro correspondente aos pacotes que o FS_Node possuí do ficheiro correspondente.
+	Função que retorna a informação de todos os ficheiros que o FS_Node possuí, sob a forma de uma lista de tuplos com 4
+	elementos cada. O primeiro elemnto é o nome do ficheiro, o segundo o número de pacotes em que o ficheiro está dividido,
+	o terceiro o inteiro correspondente aos pacotes que o FS_Node possuí do ficheiro correspondente e o quarto o tamanho
+	de cada pacote.
 
-	Exemplo: (file1, 50, 65763)
+	Exemplo: (file1, 50, 65763, 1024)
 	"""
 	def get_files(self):
 		files = []
 		for file, info in self.files.items():
-			files.append((file, info[1], info[2]))
+			files.append((file, info[1], info[2], info[3]))
 		
 		return files
 
 
 	"""
-	Função que adiciona uma lista de ficheiros ao dicionário relativo aos ficheiros que o FS_Node possuí.
+	Função que adiciona uma lista de ficheiros ao dicionário relativo aos ficheiros que o FS_Node possuí. Cada ficheiro é
+	uma lista [nome, número de pacotes, pacotes que possuí] e pode ter um quarto elemento com o tamanho dos pacotes, sendo
+	usado DEFAULT_BLOCK_SIZE caso não tenha.
 	"""
 	def add_files(self, files):
-		for (file, num_packets, packets_owned) in files:
+		for (file, num_packets, packets_owned, *block_size) in files:
 			self.lock.acquire()
 			if self.files.get(file)==None:
-				self.files[file] = [ReentrantRWLock(), num_packets, packets_owned]
+				self.files[file] = [ReentrantRWLock(), num_packets, packets_owned, block_size[0] if block_size else DEFAULT_BLOCK_SIZE]
 			self.lock.release()
 
 	"""
@@ -58,6 +69,7 @@ class FS_Node_DataBase():
 	def remove_file(self, file):
 		self.lock.acquire()
 		del self.files[file]
+		self.manifests.pop(file, None)
 		self.lock.release()
 	
 
@@ -171,6 +183,35 @@ class FS_Node_DataBase():
 		return self.files.get(file)[1]
 
 
+	"""
+	Função que devolve o tamanho em bytes dos pacotes de determinado ficheiro, ou DEFAULT_BLOCK_SIZE se o FS_Node não tiver
+	o ficheiro
+	"""
+	def get_block_size(self, file):
+		info = self.files.get(file)
+		return info[3] if info else DEFAULT_BLOCK_SIZE
+
+
+	"""
+	Função que guarda o manifesto de um ficheiro. Os manifestos vazios (o FS_Tracker não conhece o manifesto) são ignorados.
+	"""
+	def set_manifest(self, file, manifest):
+		if manifest:
+			self.manifests[file] = manifest
+
+
+	"""
+	Função que verifica se um pacote recebido corresponde à hash do pacote no manifesto do ficheiro. Caso o FS_Node não conheça
+	o manifesto do ficheiro, o pacote é aceite.
+	"""
+	def verify_packet(self, file, packet_index, packet):
+		manifest = self.manifests.get(file)
+		if not manifest:
+			return True
+		start = packet_index * PIECE_HASH_SIZE
+		return hashlib.sha256(packet).digest() == manifest[start:start + PIECE_HASH_SIZE]
+
+
 	""""
 	Função associada a quando um cliente pede um ficheiro. Esta recebe uma lista em que o primeiro elemento é o número
 	de pacotes em que o ficheiro está dividido e os restantes elementos correspondem a FS_Nodes que possuem o ficheiro ou
@@ -199,9 +240,13 @@ class FS_Node_DataBase():
 		# Inverte a ordem do array, porque está ao contrário
 		packets = packets[::-1]
 
-		# Cria um array auxiliar com os índices do array, para ordenar
-		packet_indices = list(range(len(packets)))
+		return self.sort_packets_by_rarity(packets)
 
-		sorted_indices = sorted(packet_indices, key=lambda x: packets[x])
 
-		return sorted_indices
+	"""
+	Função que recebe o número de FS_Nodes que possuem cada pacote de um ficheiro, pela ordem dos pacotes, e devolve os índices
+	dos pacotes ordenados por ordem crescente dos pacotes mais comuns. Os pacotes com o mesmo número de cópias ficam pela ordem
+	dos índices, pelo que a mesma lista dá sempre a mesma ordem. Na versão 2 a lista é enviada pelo FS_Tracker.
+	"""
+	def sort_packets_by_rarity(self, packets):
+		return sorted(range(len(packets)), key=packets.__getitem__)
@@ -6,41 +6,181 @@ a fazer uma gestão da base de dados.
 """
 
 import threading
-from ReentrantRWLock import ReentrantRWLock
+from File_Owners import File_Owners
+from Tracker_Metrics import Tracker_Metrics
+from Message_Protocols import DEFAULT_BLOCK_SIZE, PIECE_HASH_SIZE, REPLY_OWNERS_DELTA, encode_owners_reply_v2, encode_message_TCP_v2
 
 
 
 class FS_Tracker_DataBase():
 
 	"""
-	Estrutura f_complete = {F1: [LOCK, 0, 20, 172.0.0.1, 193.0.1.2]}
-	A key corresponde ao nome do ficheiro (exemplo: file1.txt) e o value corresponde a uma lista, onde, a partir do
-	4 indíce, os elementos correspondem todos a endereços IPv4 dos FS_Nodes que possuem esse ficheiro completo. Relativamente
-	aos restantes elementos da lista, o primeiro corresponde a um RWLOCK que previne que duas threads escrevam simultaneamente
-	na informação deste ficheiro, ou que haja leituras em simultâneo com escritas. Por sua vez, o segundo elemento corresponde
-	ao indíce do endereço IP que será enviado em primeiro lugar quando um FS_Node requesitar informação sobre que FS_Nodes
-	possuem determinado ficheiro, por exemplo, para a lista acima, se for igual a 1, a lista dos IPs será, [193.0.1.2, 172.0.1].
-	Depois, o terceiro elemento é o número de pacotes que o ficheiro possuí.
-
-	
-	Estrutura f_incomplete = {F1: [LOCK, 1, 20, [172.0.1, 61253], [193.0.1.2, 5723]]}
-	Semelhante ao dicionário dos ficheiros completos, a key corresponde ao nome do ficheiro e o value a uma lista, onde, a partir
-	da terceira posição todos os elementos correspondem a listas de dois elementos, onde o primeiro é um endereço IP e o segundo
-	os pacotes que o FS_Node com esse endereço IP possuí daquele ficheiro. De salientar que neste dicionário não temos informação
-	sobre o número de bytes do último pacote, logo temos de ir buscar essa informação ao dicionário dos ficheiros completos.
-	
-	Realçamos que os inteiros associados aos endereços IPv4 correspondem aos pacotes que cada FS_Node possuí quando convertidos
-	para binário. Por exemplo, 61253 corresponde a 1110111101000101 em binário e, sabendo que o ficheiro está dividido em 20 pacotes
-	no total, acrescentamos 0s à esquerda até termos 20 dígitos, resultando no número 00001110111101000101. Desta forma, concluímos
-	que faltam 10 pacotes (contar os 0s) para o correspondente FS_Node ter o ficheiro completo.
-
-	Uma instância desta classe tem ainda associado um LOCK da biblioteca threading de forma a controlar as alterações nos dicionários
-	de ficheiros completos e incompletos, por exemplo, quando queremos adicionar um novo ficheiro.
+	Estrutura files = {F1: File_Owners}
+	A key corresponde ao nome do ficheiro (exemplo: file1.txt) e o value à instância de File_Owners com os FS_Nodes que possuem
+	o ficheiro ou partes do mesmo, o número de pacotes do ficheiro, o RWLOCK que previne que duas threads escrevam
+	simultaneamente na informação deste ficheiro (ou que haja leituras em simultâneo com escritas) e a rotação usada nas
+	respostas aos pedidos do ficheiro. Cada FS_Node é guardado num dicionário com o endereço como key, pelo que consultar,
+	atualizar ou remover um FS_Node não depende do número de FS_Nodes que possuem o ficheiro.
+
+	Os pacotes que um FS_Node possuí são guardados como um inteiro, igual a -1 caso o FS_Node tenha o ficheiro completo.
+	Realçamos que estes inteiros correspondem aos pacotes que cada FS_Node possuí quando convertidos para binário. Por exemplo,
+	61253 corresponde a 1110111101000101 em binário e, sabendo que o ficheiro está dividido em 20 pacotes no total, acrescentamos
+	0s à esquerda até termos 20 dígitos, resultando no número 00001110111101000101. Desta forma, concluímos que faltam 10 pacotes
+	(contar os 0s) para o correspondente FS_Node ter o ficheiro completo.
+
+	Uma instância desta classe tem ainda associado um LOCK da biblioteca threading de forma a controlar as alterações no dicionário
+	de ficheiros, por exemplo, quando queremos adicionar um novo ficheiro.
+
+	Estrutura files_block_size = {F1: 4096}
+	Guarda o tamanho em bytes dos pacotes de cada ficheiro, indicado pelo primeiro FS_Node que anunciou o ficheiro. Os ficheiros
+	anunciados sem tamanho (por exemplo, por FS_Nodes da versão 1) usam pacotes de DEFAULT_BLOCK_SIZE bytes.
+
+	Estrutura files_manifest = {F1: b'...'}
+	Guarda o manifesto de cada ficheiro, ou seja, a hash SHA-256 de cada pacote concatenadas pela ordem dos pacotes, publicado
+	pelo primeiro FS_Node da versão 2 que tinha o ficheiro completo. Os FS_Nodes que descarregam o ficheiro usam-no para
+	verificar cada pacote recebido.
+
+	Estrutura nodes_version = {(172.0.0.1, 9090): 2}
+	Guarda a versão do protocolo negociada com cada FS_Node, para o FS_Tracker indicar nas respostas quais os FS_Nodes que
+	suportam a versão 2. Os FS_Nodes que não negociaram usam a versão 1 e não aparecem no dicionário.
+
+	Estrutura nodes_files = {(172.0.0.1, 9090): {F1, F2}}
+	Índice inverso do dicionário files, com os ficheiros de que cada FS_Node possuí pacotes, para que a remoção de um FS_Node
+	apenas percorra os ficheiros que este possuía. É atualizado, com o lock do FS_Tracker, sempre que a informação de um
+	FS_Node sobre um ficheiro é alterada.
+
+	Estrutura subscribers = {F1: {(172.0.0.1, 9090): push}}
+	FS_Nodes que subscreveram as alterações de cada ficheiro (id_mode==10) e a função, dada pelo servidor da conexão do FS_Node,
+	que lhe envia uma trama. Cada alteração dos FS_Nodes de um ficheiro com subscrições é convertida uma única vez numa trama
+	REPLY_OWNERS_DELTA, enviada a todos os FS_Nodes que o subscreveram, exceto ao FS_Node que a fez. O índice inverso
+	nodes_subscriptions = {(172.0.0.1, 9090): {F1}} permite terminar as subscrições de um FS_Node quando este é removido.
+	Ambos são alterados com o lock do FS_Tracker.
+
+	Caso o FS_Tracker guarde o seu estado em disco, wal é a instância de Tracker_WAL onde são registadas todas as alterações
+	(mensagens dos FS_Nodes, versões e remoções de FS_Nodes). Os FS_Nodes carregados do disco ao iniciar ficam no conjunto
+	provisional até voltarem a ligar-se ao FS_Tracker: enquanto isso, continuam a ser indicados nas respostas, para que as
+	transferências possam continuar logo após o arranque.
+
+	A variável metrics é o registo de métricas do FS_Tracker (ver Tracker_Metrics), com a duração de cada escrita
+	(store.<id_mode>) e de cada remoção de FS_Nodes (remove_nodes), o tempo de espera pelos locks dos ficheiros (lock_wait) e
+	o estado da cache de FS_Nodes convertidos, assim como o número de subscrições (subscriptions) e de tramas de alterações
+	enviadas (push.frames).
 	"""
 	def __init__(self):
-		self.f_complete = {}
-		self.f_incomplete = {}
+		self.files = {}
+		self.nodes_files = {}
+		self.files_block_size = {}
+		self.files_manifest = {}
+		self.nodes_version = {}
+		self.subscribers = {}
+		self.nodes_subscriptions = {}
 		self.lock = threading.Lock()
+		self.wal = None
+		self.provisional = set()
+		self.metrics = Tracker_Metrics()
+		self.metrics.gauge("files", lambda: len(self.files))
+		self.metrics.gauge("nodes", lambda: len(self.nodes_files))
+		self.metrics.gauge("owners_cache.hits", lambda: self.get_cache_stats()["hits"])
+		self.metrics.gauge("owners_cache.misses", lambda: self.get_cache_stats()["misses"])
+		self.metrics.gauge("owners_cache.patches", lambda: self.get_cache_stats()["patches"])
+		self.metrics.gauge("subscriptions", lambda: sum(len(files) for files in list(self.nodes_subscriptions.values())))
+
+
+	"""
+	Função que aplica na base de dados uma mensagem de um FS_Node que envolve uma escrita em memória: o anúncio dos ficheiros
+	(1), a atualização de um pacote (2) ou de vários pacotes (3) de um ficheiro e a publicação do manifesto de um ficheiro (4).
+	Caso o estado seja guardado em disco, a mensagem é também escrita no registo, com o lock de leitura do registo, para não
+	ser tirado um snapshot entre as duas operações.
+
+	O fim da subscrição de um ficheiro (11) chega pela mesma fila das escritas, para ser aplicado depois das mensagens
+	anteriores do FS_Node, mas não é guardado no registo, pois as subscrições terminam com a conexão.
+
+	As atualizações de pacotes (2 e 3) de um ficheiro que o FS_Tracker não conhece são ignoradas e contadas em
+	store.unknown_file, pois sem o número de pacotes do ficheiro não é possível aplicá-las.
+	"""
+	def apply_message(self, addr, message):
+		if message[0]==11:
+			self.unsubscribe(message[1], addr)
+			return
+		if (message[0]==2 or message[0]==3) and self.get_size_file(message[1][0]) is None:
+			self.metrics.add("store.unknown_file")
+			return
+
+		with self.metrics.timed(f"store.{message[0]}", message[1][0] if message[0] in (2, 3, 4) else None, addr):
+			if self.wal is None:
+				self._apply_message(addr, message)
+				return
+
+			with self.wal.lock.r_locked():
+				self._apply_message(addr, message)
+				self.wal.append_message(addr, message)
+
+
+	"""
+	Função que aplica, pela ordem de chegada, várias mensagens de escrita do mesmo FS_Node (as mensagens em espera de
+	thread_for_store). As atualizações de pacotes (2 e 3) de cada ficheiro são juntas numa só máscara, com XOR, e aplicadas
+	numa única escrita (uma aquisição do lock do ficheiro e um registo no WAL). Como File_Owners.update aplica estas
+	atualizações com XOR sobre os pacotes que o FS_Node possuí, sendo o ficheiro completo o mesmo que todos os pacotes, aplicar
+	a máscara dá o mesmo resultado que aplicar as mensagens uma a uma.
+
+	As mensagens que não são um XOR, ou seja, as atualizações -1 e 0 e os anúncios (1), funcionam como barreiras: as
+	atualizações juntas dos ficheiros que envolvem são aplicadas antes delas, pelo que a ordem das alterações de cada ficheiro
+	é mantida. As alterações de ficheiros diferentes não dependem umas das outras. O número de mensagens de cada chamada é
+	registado em store.batch_size e o número de mensagens juntas a outras em store.coalesced.
+	"""
+	def apply_messages(self, addr, messages):
+		self.metrics.histogram("store.batch_size").record(len(messages))
+		pending = {}
+		for message in messages:
+			if message[0]==2 or message[0]==3:
+				name = message[1][0]
+				number_packets_file = self.get_size_file(name)
+				if number_packets_file is not None:
+					delta = 1 << number_packets_file - message[1][1] - 1 if message[0]==2 else message[1][1]
+					if delta != -1 and delta != 0:
+						if name in pending:
+							pending[name][0] ^= delta
+							pending[name][1] = None
+							self.metrics.add("store.coalesced")
+						else:
+							pending[name] = [delta, message]
+						continue
+				if name in pending:
+					self._apply_pending(addr, name, pending.pop(name))
+			elif message[0]==1:
+				for file in message[1]:
+					if file[0] in pending:
+						self._apply_pending(addr, file[0], pending.pop(file[0]))
+			self.apply_message(addr, message)
+
+		for name, update in pending.items():
+			self._apply_pending(addr, name, update)
+
+
+	"""
+	Aplica as atualizações juntas de um ficheiro: a mensagem original, caso seja apenas uma, ou uma atualização de vários
+	pacotes (3) com a máscara. Uma máscara 0 indica que as mensagens se anularam, pelo que não há nada a aplicar.
+	"""
+	def _apply_pending(self, addr, name, update):
+		delta, message = update
+		if message is not None:
+			self.apply_message(addr, message)
+		elif delta != 0:
+			self.apply_message(addr, [3, [name, delta]])
+
+
+	def _apply_message(self, addr, message):
+		if (message[0]==1):
+			self.update_information(addr, message[1])
+		elif (message[0]==2):
+			number_packets_file = self.get_size_file(message[1][0])
+			packet_update_index = 1 << number_packets_file - message[1][1] - 1
+			self.update_information(addr, [[message[1][0], number_packets_file, packet_update_index]])
+		elif (message[0]==3):
+			number_packets_file = self.get_size_file(message[1][0])
+			self.update_information(addr, [[message[1][0], number_packets_file, message[1][1]]])
+		elif (message[0]==4):
+			self.set_manifest(message[1][0], message[1][1])
 
 
 	"""
@@ -56,15 +196,15 @@ class FS_Tracker_DataBase():
 
 	Se o ficheiro for completo -> [(file_name, 10, -1),...],
 	Se for incompleto -> [(file_name, 15, 12345),...]
+	Se indicar o tamanho dos pacotes -> [(file_name, 15, 12345, 4096),...]
 
 
 	Caso o FS_Node já estivesse registado como detentor daquele pacote, o FS_Tracker assume que o FS_Node apagou esse pacote.
 	Por outro lado, caso o FS_Tracker tivesse registado que o FS_Node ainda não possuía esse pacote, então atualiza os 	pacotes que o
-	FS_Node possuí desse ficheiro e, caso o ficheiro fique completo, passa o FS_Node para o dicionário de ficheiros completos e remove
-	a informação no dicionário de ficheiros incompletos.
+	FS_Node possuí desse ficheiro e, caso o ficheiro fique completo, passa a registar o FS_Node com o ficheiro completo (-1).
 
-	Caso o FS_Node já possuí-se o ficheiro completo e apaga-se um dos pacotes ou vários pacotes, então o FS_Tracker remove o FS_Node
-	da lista dos FS_Nodes com o correspondente ficheiro completo e volta a passá-lo, para o dicionário de ficheiros incompletos.
+	Caso o FS_Node já possuí-se o ficheiro completo e apaga-se um dos pacotes ou vários pacotes, então o FS_Tracker volta a registar
+	apenas os pacotes que o FS_Node possuí. As regras são aplicadas pela função File_Owners.update.
 
 	
 	O XOR aqui é utilizado para fazer as operações de adição e remoção de pacotes de um ficheiro. Mas a informação que ele está à espera
@@ -75,79 +215,43 @@ class FS_Tracker_DataBase():
 
 	
 	Em relação aos locks, o lock do FS_Tracker é usado para evitar que dois ou mais FS_Nodes tentem criar o mesmo ficheiro ao mesmo
-	tempo quando este ainda não existia no FS_Tracker. Por sua vez, os locks de escrita, que cada key do dicionário tem associado asseguram
-	que não resultam informações falsas provenientes de múltiplas escritas em simultâneo.
+	tempo quando este ainda não existia no FS_Tracker, sendo apenas adquirido quando o ficheiro não existe ou quando nodes_files
+	muda. Por sua vez, os locks de escrita, que cada ficheiro tem associado asseguram que não resultam informações falsas
+	provenientes de múltiplas escritas em simultâneo. Nenhum lock é adquirido dentro de outro.
+
+	Caso o ficheiro tenha subscrições, o novo estado do FS_Node é enviado aos FS_Nodes que o subscreveram (ver _push), depois
+	de libertar o lock do ficheiro.
 	"""
 	def update_information(self, addr, data):
 		for file in data:
-			
-			self.lock.acquire()
-			if file[0] in self.f_complete:
-				self.lock.release()
-				
-				# Verifica se o FS_Node já possuía alguma informação relativa aquele ficheiro
-				if addr not in self.f_complete[file[0]]:
-					
-					with self.f_incomplete[file[0]][0].w_locked():
-						index = self.addr_has_packets(file[0], addr)
-						if index == -1:
-							# Verifica se o ficheiro está completo
-							if (file[2] == -1) or (file[1]==1):
-								with self.f_complete[file[0]][0].w_locked():
-									self.f_complete[file[0]].insert(self.f_complete[file[0]][1] + 3, addr)
-							else:
-								self.f_incomplete[file[0]].insert(self.f_incomplete[file[0]][1] + 3, [addr, file[2]])
-						else:
-							# Realizar a operação de ou exclusivo para fazer as adições e/ou deleções de pacotes de um ficheiro
-							xor = self.f_incomplete[file[0]][index][1] ^ file[2]
-							if (xor==0):
-								del self.f_incomplete[file[0]][index]
-							elif (xor==pow(2, file[1]) - 1):
-								del self.f_incomplete[file[0]][index]
-								with self.f_complete[file[0]][0].w_locked():
-									self.f_complete[file[0]].insert(self.f_complete[file[0]][1] + 3, addr)
-							else:
-								self.f_incomplete[file[0]][index][1] = xor
-				else:
-					if file[2] == -1:
-						with self.f_complete[file[0]][0].w_locked():
-							self.f_complete[file[0]].remove(addr)
-					else:
-						# Realizar a operação de ou exclusivo para fazer as deleções de pacotes de um ficheiro completo
-						file_complete = pow(2, file[1]) - 1
-						xor = file_complete ^ file[2]
-
-						# Passar para o dicionário de ficheiros incompletos
-						with self.f_complete[file[0]][0].w_locked():
-							self.f_complete[file[0]].remove(addr)
-							with self.f_incomplete[file[0]][0].w_locked():
-								self.f_incomplete[file[0]].insert(self.f_incomplete[file[0]][1] + 3, [addr, xor])
-
-			# Adicionar a informação caso o FS_Node não tivesse nada relativo aquele ficheiro
-			else:
-				self.f_complete[file[0]] = [ReentrantRWLock(), 0, file[1]]
-				self.f_incomplete[file[0]] = [ReentrantRWLock(), 0, file[1]]
-				self.lock.release()
-
-				# Verifica se o Node possuí o ficheiro completo
-				if file[2] == -1:
-					with self.f_complete[file[0]][0].w_locked():
-						self.f_complete[file[0]].insert(self.f_complete[file[0]][1] + 3, addr)
-				# Adiciona um novo ficheiro incompleto caso contrário
-				else:
-					with self.f_incomplete[file[0]][0].w_locked():
-						self.f_incomplete[file[0]].insert(self.f_incomplete[file[0]][1] + 3, [addr, file[2]])
-
-
-	"""
-	Função auxiliar que verifica se o FS_Node já tem pacotes de um determinado ficheiro e, em caso afirmativo, devolve a posição
-	onde se encontra a informação relativa aos pacotes que o mesmo possuí.
-	"""
-	def addr_has_packets(self, file, addr):
-		for i in range(len(self.f_incomplete[file])-3):
-			if (self.f_incomplete[file][i+3][0] == addr):
-				return i+3
-		return -1
+
+			# Adicionar o ficheiro caso ainda não existisse no FS_Tracker
+			owners = self.files.get(file[0])
+			if owners is None:
+				with self.lock:
+					owners = self.files.get(file[0])
+					if owners is None:
+						self.files_block_size[file[0]] = file[3] if len(file) > 3 else DEFAULT_BLOCK_SIZE
+						owners = self.files[file[0]] = File_Owners(file[1], self.metrics.histogram("lock_wait"))
+
+			with owners.lock.w_locked():
+				previous = owners.packets.get(addr)
+				owners.update(addr, file[2])
+				current = owners.packets.get(addr)
+			has_file = current is not None
+
+			if previous != current and file[0] in self.subscribers:
+				self._push(file[0], [[addr, current]], addr)
+
+			# O índice nodes_files apenas muda quando o FS_Node passa a ter ou deixa de ter pacotes do ficheiro
+			if has_file == (file[0] in self.nodes_files.get(addr, ())):
+				continue
+
+			with self.lock:
+				if has_file:
+					self.nodes_files.setdefault(addr, set()).add(file[0])
+				elif addr in self.nodes_files:
+					self.nodes_files[addr].discard(file[0])
 
 
 	"""
@@ -156,85 +260,274 @@ class FS_Tracker_DataBase():
 	ficheiro solicitado e o segundo argumento são os pacotes correspondentes que possuí. Quando o campo dos pacotes que possuí for igual a -1,
 	significa que o FS_Node contem o ficheiro completo.
 
-	Os locks de leitura, servem para impedir que funções que alterem as informações dos ficheiros, alterem essa informação enquanto estamos a ler,
-	prevenindo que apareça resultados errados.
-
-
 	Importante realçar que em vez de enviarmos sempre os FS_Nodes que possuem determinado ficheiro pela ordem que os temos na nossa base de dados,
 	vamos rodando essa lista. Este mecanismo em conjunto com um outro mecanismo executado pelos FS_Nodes (estratégia dos pacotes raros) serve para
 	balancear a rede e prevenir que os FS_Nodes sejam sobrecarregados com pedidos.
 
-	Desta forma, a cada pedido, é atualizada uma variável na base de dados, informando que no próximo pedido a lista terá de rodar mais uma unidade.
-	Salientamos que quando adicionamos um novo FS_Node a um dos dicionários este é sempre adicionado no indíce indicado pela variável de rotação
-	assegurando que no próximo pedido este é o primeiro elemento da lista. Fazemos isto, para quando o FS_Node for novo na rede, este ser o primeiro
-	a ser requisitado quando alguém quer pacotes de um ficheiro que ele possuí.
+	Desta forma, a cada pedido, a lista circular de File_Owners avança uma posição, informando que no próximo pedido a lista terá de rodar mais uma
+	unidade. Salientamos que quando adicionamos um novo FS_Node este é sempre adicionado na posição da rotação assegurando que no próximo pedido este
+	é o primeiro elemento da lista. Fazemos isto, para quando o FS_Node for novo na rede, este ser o primeiro a ser requisitado quando alguém quer
+	pacotes de um ficheiro que ele possuí. Os pedidos são respondidos a partir do snapshot imutável de cada ficheiro (ver
+	File_Owners.snapshot), sem adquirir o lock do ficheiro nem o lock do FS_Tracker, pelo que não esperam pelas escritas.
+
+	Caso seja indicado 'max_owners', são devolvidos no máximo 'max_owners' FS_Nodes, apenas dos que possuem algum dos pacotes
+	de 'packets_needed' (ver File_Owners.select), o que mantém o tamanho da resposta e o custo do pedido independentes do
+	número de FS_Nodes que possuem o ficheiro.
 	"""
-	def get_file_owners(self, file):
+	def get_file_owners(self, file, max_owners=None, packets_needed=-1):
 
 		# Verificar se o ficheiro já existiu na rede
-		if file not in self.f_complete:
+		owners = self.files.get(file)
+		if owners is None:
 			return []
+
+		# Devolve a lista dos FS Nodes que possuem os ficheiros ou partes do mesmo rodando esta lista a cada pedido
+		if max_owners is None:
+			lista = owners.rotate()
 		else:
+			lista = owners.select(max_owners, packets_needed)
 
-			# Devolve a lista dos FS Nodes que possuem os ficheiros ou partes do mesmo rodando esta lista a cada pedido
-			with self.f_incomplete[file][0].r_locked():
-				with self.f_complete[file][0].r_locked():
-
-					list1 = self.f_complete[file][3:]
-					list2 = self.f_incomplete[file][3:]
-					rotations_l1 = self.f_complete[file][1]
-					rotations_l2 = self.f_incomplete[file][1]
-
-					if (rotations_l1<len(list1)):
-						lista = list1[rotations_l1:] + list2 +  list1[:rotations_l1]
-					else:
-						lista = list2[rotations_l2:] + list1 +  list2[:rotations_l2]
-
-					if (rotations_l1<len(list1)):
-						self.f_complete[file][1] += 1
-					elif (rotations_l2<len(list2)-1):
-						self.f_incomplete[file][1] += 1
-					else:
-						self.f_complete[file][1] = 0
-						self.f_incomplete[file][1] = 0
-		
-		return [self.f_complete[file][2]] + lista
+		return [owners.n_packets] + lista
+
+
+	"""
+	Função equivalente a get_file_owners que devolve a resposta já convertida para a versão 2 do protocolo, construída a partir
+	dos FS_Nodes já convertidos de cada ficheiro (ver Owners_Snapshot.encoded), ou None caso o ficheiro não exista. Os pedidos
+	consecutivos do mesmo ficheiro, sem alterações entre eles, não voltam a converter os FS_Nodes.
+	"""
+	def get_file_owners_frame(self, file, max_owners=None, packets_needed=-1):
+
+		owners = self.files.get(file)
+		if owners is None:
+			return None
+
+		if max_owners is None:
+			peers = owners.rotate_encoded(self.nodes_version)
+		else:
+			peers = owners.select_encoded(max_owners, packets_needed, self.nodes_version)
+
+		return encode_owners_reply_v2(owners.n_packets, self.get_block_size(file), peers)
+
+
+	"""
+	Devolve o número de pedidos de FS_Nodes respondidos a partir da cache de FS_Nodes convertidos (hits), o número de vezes que
+	a cache foi construída (misses) e alterada por uma escrita (patches), somados em todos os ficheiros, e a proporção de hits.
+	"""
+	def get_cache_stats(self):
+		hits = misses = patches = 0
+		for owners in list(self.files.values()):
+			hits += owners.hits
+			misses += owners.misses
+			patches += owners.patches
+		requests = hits + misses
+		return {"hits": hits, "misses": misses, "patches": patches, "hit_rate": hits / requests if requests else 0.0}
+
+
+	"""
+	Devolve o número de FS_Nodes que possuem cada pacote de um ficheiro, pela ordem dos pacotes, ou uma lista vazia caso o
+	ficheiro não exista. Os valores são mantidos a cada atualização, pelo que o FS_Node que pede o ficheiro não tem de os
+	calcular a partir dos pacotes de cada FS_Node e todos os FS_Nodes obtêm a mesma ordem de raridade.
+	"""
+	def get_packets_rarity(self, file):
+
+		owners = self.files.get(file)
+		if owners is None:
+			return []
+
+		return owners.get_counts()
 
 
 	"""
 	Função que remove os dados relacionados a um FS_Node, por exemplo, quando este se disconecta da rede.
 
-	Quando a informação relativa ao FS_Node é removida é tido em conta qual o indíce de rotação associado ao ficheiro. Caso o indíce da informação
-	seja inferior ao indíce da rotação, então a informação é removida e o indíce de rotação é decrementado uma unidade, assegurando que o endereço
-	que tinha sido enviado em primeiro lugar no pedido anterior, não é enviado em primeiro lugar novamente. Caso contrário, o indíce de rotação não
-	é alterado.
+	Quando a informação relativa ao FS_Node é removida é tida em conta a rotação associada ao ficheiro. Caso o FS_Node fosse o próximo a ser enviado
+	em primeiro lugar, passa a sê-lo o FS_Node seguinte, assegurando que o endereço que tinha sido enviado em primeiro lugar no pedido anterior, não
+	é enviado em primeiro lugar novamente.
 	"""
 	def remove_FS_node(self, addr):
+		self.remove_FS_nodes([addr])
 
-		for file in self.f_complete:
-			with self.f_complete[file][0].w_locked():
 
-				if addr in self.f_complete[file]:
-					index_addr = self.f_complete[file].index(addr) - 3
-					self.f_complete[file].remove(addr)
+	"""
+	Função que remove os dados de vários FS_Nodes de uma só vez, por exemplo, quando uma parte da rede deixa de estar acessível.
+	Os FS_Nodes são agrupados por ficheiro usando o índice nodes_files, pelo que o lock de escrita de cada ficheiro é adquirido
+	apenas uma vez e os ficheiros que nenhum destes FS_Nodes possuía não são percorridos. As subscrições dos FS_Nodes removidos
+	terminam e os FS_Nodes que subscreveram os seus ficheiros recebem uma única trama por ficheiro com todas as remoções.
+	"""
+	def remove_FS_nodes(self, addrs):
+		with self.metrics.timed("remove_nodes", None, addrs[0] if len(addrs) == 1 else f"{len(addrs)} FS_Nodes"):
+			if self.wal is None:
+				self._remove_FS_nodes(addrs)
+				return
 
-					if (index_addr<self.f_complete[file][1]):
-						self.f_complete[file][1] -= 1
-		
-		for file in self.f_incomplete:
-			with self.f_incomplete[file][0].w_locked():
-				index = self.addr_has_packets(file, addr)
-				if index != -1:
-					del self.f_incomplete[file][index]
-
-					if (index-3<self.f_incomplete[file][1]):
-						self.f_incomplete[file][1] -= 1
+			with self.wal.lock.r_locked():
+				self._remove_FS_nodes(addrs)
+				for addr in addrs:
+					self.wal.append_remove_node(addr)
+
+
+	def _remove_FS_nodes(self, addrs):
+
+		files_nodes = {}
+		with self.lock:
+			for addr in addrs:
+				for file in self.nodes_files.pop(addr, ()):
+					files_nodes.setdefault(file, []).append(addr)
+				self.nodes_version.pop(addr, None)
+				self._unsubscribe_all(addr)
+
+		for file, nodes in files_nodes.items():
+			owners = self.files[file]
+			with owners.lock.w_locked():
+				for addr in nodes:
+					owners.remove(addr)
+			if file in self.subscribers:
+				self._push(file, [[addr, None] for addr in nodes])
+
+
+	"""
+	Funções que gerem as subscrições das alterações dos FS_Nodes de um ficheiro (ver subscribers). 'push' é a função que envia
+	uma trama ao FS_Node 'addr', chamada pela thread que aplica cada alteração, pelo que não deve bloquear. Um FS_Node pode
+	subscrever um ficheiro que o FS_Tracker ainda não conhece, passando a receber os FS_Nodes que o anunciem.
+
+	A subscrição é registada antes de ser construída a resposta com os FS_Nodes do ficheiro, pelo que uma alteração aplicada
+	entre as duas operações pode ser recebida duas vezes (na resposta e numa trama de alterações), mas nunca é perdida.
+
+	Como a subscrição só existe na versão 2, o FS_Node tem sempre a versão registada em nodes_version enquanto está ligado,
+	e a remoção do FS_Node apaga-a com o lock do FS_Tracker. Um pedido de subscrição respondido depois de a conexão terminar
+	(e o FS_Node ser removido) não é registado, pois a função 'push' enviaria as alterações para uma conexão fechada até ao
+	fim do FS_Tracker. Devolve True caso a subscrição seja registada.
+	"""
+	def subscribe(self, file, addr, push):
+		with self.lock:
+			if addr not in self.nodes_version:
+				return False
+			self.subscribers.setdefault(file, {})[addr] = push
+			self.nodes_subscriptions.setdefault(addr, set()).add(file)
+			return True
+
+
+	def unsubscribe(self, file, addr):
+		with self.lock:
+			files = self.nodes_subscriptions.get(addr)
+			if files is None or file not in files:
+				return
+			files.discard(file)
+			if not files:
+				del self.nodes_subscriptions[addr]
+			self._remove_subscriber(file, addr)
+
+
+	def _unsubscribe_all(self, addr):
+		for file in self.nodes_subscriptions.pop(addr, ()):
+			self._remove_subscriber(file, addr)
+
+
+	def _remove_subscriber(self, file, addr):
+		subscribers = self.subscribers[file]
+		subscribers.pop(addr, None)
+		if not subscribers:
+			del self.subscribers[file]
+
+
+	"""
+	Função que envia aos FS_Nodes que subscreveram 'file' o novo estado dos FS_Nodes de 'changes' ([[endereço, pacotes], ...],
+	com pacotes igual a None caso o FS_Node tenha sido removido), exceto ao FS_Node 'source', que fez a alteração. A trama é
+	convertida apenas uma vez, para todos os FS_Nodes.
+	"""
+	def _push(self, file, changes, source=None):
+		subscribers = [push for addr, push in list(self.subscribers.get(file, {}).items()) if addr != source]
+		if not subscribers:
+			return
+
+		frame = bytes(encode_message_TCP_v2([file, changes], False, REPLY_OWNERS_DELTA, self.nodes_version))
+		for push in subscribers:
+			push(frame)
+		self.metrics.add("push.frames", len(subscribers))
+
+
+	"""
+	Função que guarda a versão do protocolo negociada com um FS_Node. Como a versão é indicada nas respostas, o FS_Node volta a
+	ser convertido na cache dos ficheiros que já possuí (ver File_Owners.refresh).
+	"""
+	def set_node_version(self, addr, version):
+		if self.wal is None:
+			self._set_node_version(addr, version)
+			return
+
+		with self.wal.lock.r_locked():
+			self._set_node_version(addr, version)
+			self.wal.append_node_version(addr, version)
+
+
+	def _set_node_version(self, addr, version):
+		if self.nodes_version.get(addr) == version:
+			return
+		self.nodes_version[addr] = version
+		with self.lock:
+			names = list(self.nodes_files.get(addr, ()))
+		for name in names:
+			owners = self.files[name]
+			with owners.lock.w_locked():
+				owners.refresh(addr)
+
+
+	"""
+	Funções que gerem os FS_Nodes carregados do disco. Ao iniciar, todos os FS_Nodes carregados ficam provisórios. Quando um
+	FS_Node provisório volta a ligar-se ao FS_Tracker, a informação carregada é removida, pois o FS_Node volta a anunciar os
+	seus ficheiros e o anúncio de um FS_Node já conhecido seria aplicado como alterações (XOR). Os FS_Nodes que não voltam a
+	ligar-se são removidos de uma só vez por expire_provisional.
+	"""
+	def mark_provisional(self):
+		with self.lock:
+			self.provisional = set(self.nodes_files) | set(self.nodes_version)
+
+
+	def confirm_FS_node(self, addr):
+		with self.lock:
+			if addr not in self.provisional:
+				return
+			self.provisional.discard(addr)
+		self.remove_FS_node(addr)
+
+
+	def expire_provisional(self):
+		with self.lock:
+			addrs = list(self.provisional)
+			self.provisional = set()
+		self.remove_FS_nodes(addrs)
 	
 	"""
 	Função que devolve o número de pacotes que compõem determinado ficheiro
 	"""
 	def get_size_file(self, file):
-		return self.f_complete.get(file)[2]
+		owners = self.files.get(file)
+		return owners.n_packets if owners is not None else None
+
+
+	"""
+	Função que devolve o tamanho em bytes dos pacotes de determinado ficheiro
+	"""
+	def get_block_size(self, file):
+		return self.files_block_size.get(file, DEFAULT_BLOCK_SIZE)
+
+
+	"""
+	Função que guarda o manifesto de um ficheiro, caso o ficheiro exista e ainda não tenha manifesto. Um manifesto com um número
+	de hashes diferente do número de pacotes do ficheiro é ignorado.
+	"""
+	def set_manifest(self, file, manifest):
+		with self.lock:
+			if file in self.files and file not in self.files_manifest:
+				if len(manifest) == self.files[file].n_packets * PIECE_HASH_SIZE:
+					self.files_manifest[file] = manifest
+
+
+	"""
+	Função que devolve o manifesto de um ficheiro, ou um manifesto vazio caso o FS_Tracker não o conheça
+	"""
+	def get_manifest(self, file):
+		return self.files_manifest.get(file, b'')
 
 
 
@@ -242,12 +535,8 @@ class FS_Tracker_DataBase():
 
 	def print_dic(self):
 		
-		print("----------Completos----------")
-		for file  in self.f_complete:
-			print(file)
-			print(self.f_complete[file])
-		print("----------Incompletos----------")
-		for file  in self.f_incomplete:
+		for file, owners in self.files.items():
 			print(file)
-			print(self.f_incomplete[file])
-		print("")
\ No newline at end of file
+			print(owners.n_packets, owners.packets)
+		print(self.get_cache_stats())
+		print("")
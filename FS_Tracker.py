@@ -2,11 +2,38 @@
 Ficheiro que executa o FS_Tracker.
 """
 
+import collections
+import queue
 import socket
 import sys
 import threading
+import time
 import Message_Protocols
 from FS_Track_DataBase import FS_Tracker_DataBase
+from Tracker_WAL import Tracker_WAL, SNAPSHOT_INTERVAL
+from Tracker_Metrics import METRICS_INTERVAL, dump_snapshot
+
+
+
+# Tempo, em segundos, que os FS_Nodes carregados do disco têm para voltar a ligar-se ao FS_Tracker
+PROVISIONAL_TIMEOUT = 120
+
+# id_modes dos pedidos de leitura, respondidos pelas threads de Request_Pool
+READ_MODES = (0, 5, 6, 7, 8, 9, 10)
+
+# Número de threads que respondem aos pedidos de leitura, por omissão (opção --workers)
+POOL_WORKERS = 16
+
+# Número máximo de mensagens de cada FS_Node à espera de serem respondidas ou guardadas, antes de o FS_Tracker deixar de ler
+# a sua conexão
+INBOX_SIZE = 64
+
+# Número máximo de tramas de alterações das subscrições de um FS_Node à espera de serem enviadas, a partir do qual as
+# tramas em espera são descartadas e substituídas por uma trama REPLY_OWNERS_RESYNC
+MAX_PENDING_PUSHES = 1024
+
+# Trama que indica ao FS_Node que as alterações das suas subscrições foram descartadas
+RESYNC_FRAME = bytes(Message_Protocols.encode_message_TCP_v2(None, False, Message_Protocols.REPLY_OWNERS_RESYNC))
 
 
 
@@ -20,26 +47,168 @@ poderia acontecer de executar primeiro a thread que apagou os dados todos e só
 ficheiro. O resultado disto seria errado, pois em vez do FS_Tracker ficar sem informações do FS_Node, este
 iria ter guardado informações do FS_Node relativamente a ficheiros que este na realidade não contem.
 
-Importante realçar que a thread lê de uma lista que é partilhada com as threads que realizam os pedidos.
-Desta forma, as threads que realizam os pedidos escrevem para esta lista partilhada caso o pedido do FS_Node
-envolva uma escrita na memória.
+Importante realçar que a thread lê de uma fila (deque) que é partilhada com as threads que realizam os pedidos.
+Desta forma, as threads que realizam os pedidos escrevem para esta fila partilhada caso o pedido do FS_Node
+envolva uma escrita na memória. A cada vez que acorda, a thread retira todas as mensagens em espera e aplica-as
+de uma só vez (ver FS_Tracker_DataBase.apply_messages), juntando as atualizações de pacotes de cada ficheiro, pelo
+que uma rajada de atualizações de um FS_Node não é aplicada mensagem a mensagem.
+
+Cada mensagem ocupa um lugar de 'inbox_slots' (ver Client_Inbox), libertado depois de a mensagem ser guardada, mesmo que
+a escrita falhe: um erro ao aplicar as mensagens é contado em store.errors e a thread continua com as seguintes, pois
+client_thread deixaria de ler a conexão à espera dos lugares e o FS_Node nunca seria removido. Quando o FS_Node se
+desliga, client_thread coloca None na fila e a thread termina depois de guardar as mensagens anteriores. Só depois disso o
+FS_Node é removido da base de dados, pois uma mensagem guardada depois da remoção voltaria a registar o FS_Node.
 """
-def thread_for_store(FS_Tracker_DB, data_to_store_lock, condition, data_to_store, addr):
+def thread_for_store(FS_Tracker_DB, data_to_store_lock, condition, data_to_store, addr, inbox_slots):
 
     while True:
         with data_to_store_lock:
             while (len(data_to_store) == 0):
                 condition.wait()
-            message = data_to_store.pop(0)
-        if (message[0]==1):
-            FS_Tracker_DB.update_information(addr, message[1])
-        elif (message[0]==2):
-            number_packets_file = FS_Tracker_DB.get_size_file(message[1][0])
-            packet_update_index = 1 << number_packets_file - message[1][1] - 1
-            FS_Tracker_DB.update_information(addr, [[message[1][0], number_packets_file, packet_update_index]])
-        elif (message[0]==3):
-            number_packets_file = FS_Tracker_DB.get_size_file(message[1][0])
-            FS_Tracker_DB.update_information(addr, [[message[1][0], number_packets_file, message[1][1]]])
+            messages = list(data_to_store)
+            data_to_store.clear()
+        closed = messages[-1] is None
+        if closed:
+            messages.pop()
+        if messages:
+            try:
+                FS_Tracker_DB.apply_messages(addr, messages)
+            except Exception as error:
+                FS_Tracker_DB.metrics.add("store.errors")
+                sys.stderr.write(f"Erro ao guardar as mensagens de {addr}: {error!r}\n")
+            finally:
+                inbox_slots.release(len(messages))
+        if closed:
+            return
+
+
+"""
+Pedidos de leitura de uma conexão à espera de resposta (requests), pela ordem de chegada, e o semáforo slots, com INBOX_SIZE
+lugares, cada um ocupado por uma mensagem da conexão (de leitura ou de escrita) até esta ser respondida ou guardada. A
+variável scheduled indica se a conexão já está na fila de Request_Pool.
+
+As tramas de alterações das subscrições do FS_Node (ver Request_Pool.push) entram na mesma fila, como (None, trama), sem
+ocuparem lugares de slots, e pushes conta as que estão em espera. A função push, que as coloca na fila, é a que é dada à
+base de dados quando o FS_Node subscreve um ficheiro.
+
+A variável closed indica que a conexão foi fechada (o FS_Node desligou-se ou um envio falhou). A partir daí, as respostas e
+as tramas de alterações em espera são descartadas em vez de enviadas, sem deixar de libertar os lugares de slots.
+"""
+class Client_Inbox():
+
+    __slots__ = ("c", "addr", "send_lock", "requests", "slots", "scheduled", "pushes", "push", "closed")
+
+    def __init__(self, c, addr, send_lock):
+        self.c = c
+        self.addr = addr
+        self.send_lock = send_lock
+        self.requests = collections.deque()
+        self.slots = threading.Semaphore(INBOX_SIZE)
+        self.scheduled = False
+        self.pushes = 0
+        self.push = None
+        self.closed = False
+
+
+"""
+Conjunto fixo de 'n_workers' threads, partilhado por todas as conexões, que responde aos pedidos de leitura dos FS_Nodes
+(ver answer_request), em vez de ser criada uma thread por mensagem. A fila partilhada tasks guarda as conexões com pedidos
+em espera e cada conexão está no máximo uma vez na fila: a thread que a retira responde a um pedido e, caso ainda haja
+pedidos, volta a colocá-la no fim da fila. Assim, as conexões são servidas alternadamente, os pedidos de cada conexão são
+respondidos pela ordem de chegada e um FS_Node que não lê as respostas apenas ocupa uma das threads.
+
+As tramas de alterações das subscrições são enviadas pelas mesmas threads (ver push), pela mesma fila de cada conexão: como
+a subscrição é registada ao responder ao pedido, as alterações seguintes são sempre enviadas depois da resposta.
+
+O número de threads, de threads ocupadas e de pedidos em espera são indicados nas métricas do FS_Tracker (gauges
+workers.size, workers.busy e workers.queue).
+"""
+class Request_Pool():
+
+    def __init__(self, FS_Tracker_DB, n_workers):
+        self.FS_Tracker_DB = FS_Tracker_DB
+        self.n_workers = n_workers
+        self.tasks = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.pending = 0
+        FS_Tracker_DB.metrics.gauge("workers.size", lambda: self.n_workers)
+        FS_Tracker_DB.metrics.gauge("workers.busy", lambda: self.busy)
+        FS_Tracker_DB.metrics.gauge("workers.queue", lambda: self.pending)
+        for _ in range(n_workers):
+            thread = threading.Thread(target=self._worker, daemon=True)
+            thread.start()
+
+
+    def submit(self, inbox, message):
+        with self.lock:
+            inbox.requests.append(message)
+            self.pending += 1
+            if inbox.scheduled:
+                return
+            inbox.scheduled = True
+        self.tasks.put(inbox)
+
+
+    """
+    Coloca uma trama de alterações na fila da conexão, sem bloquear, pois é chamada pela thread que aplica a alteração (de
+    outro FS_Node). Um FS_Node que não lê as tramas acumularia alterações em memória, pelo que, com MAX_PENDING_PUSHES em
+    espera, as tramas em espera e a nova são descartadas (push.dropped) e substituídas por uma única trama RESYNC_FRAME
+    (push.resyncs), depois da qual as alterações seguintes voltam a ser colocadas na fila. Ao recebê-la, o FS_Node volta a
+    pedir os FS_Nodes dos ficheiros subscritos, pelo que não fica com uma lista desatualizada até ao fim da transferência.
+    """
+    def push(self, inbox, frame):
+        with self.lock:
+            if inbox.closed:
+                return
+            if inbox.pushes >= MAX_PENDING_PUSHES:
+                requests = collections.deque(message for message in inbox.requests if message[0] is not None)
+                dropped = len(inbox.requests) - len(requests)
+                inbox.requests = requests
+                self.pending -= dropped
+                inbox.pushes = 0
+                self.FS_Tracker_DB.metrics.add("push.dropped", dropped + 1)
+                self.FS_Tracker_DB.metrics.add("push.resyncs")
+                frame = RESYNC_FRAME
+            inbox.requests.append((None, frame))
+            inbox.pushes += 1
+            self.pending += 1
+            if inbox.scheduled:
+                return
+            inbox.scheduled = True
+        self.tasks.put(inbox)
+
+
+    """
+    Ciclo de cada thread. Uma conexão fechada enquanto o pedido espera apenas faz falhar o envio da resposta, sem terminar
+    a thread, e marca o inbox como fechado, pelo que as mensagens seguintes da conexão são descartadas sem serem enviadas.
+    """
+    def _worker(self):
+        while True:
+            inbox = self.tasks.get()
+            with self.lock:
+                message = inbox.requests.popleft()
+                self.pending -= 1
+                self.busy += 1
+                if message[0] is None:
+                    inbox.pushes -= 1
+            try:
+                if not inbox.closed:
+                    if message[0] is None:
+                        Message_Protocols.send_frame_TCP(inbox.c, inbox.send_lock, message[1])
+                    else:
+                        answer_request(inbox.c, inbox.addr, self.FS_Tracker_DB, message, inbox.send_lock, inbox.push)
+                    inbox.closed = inbox.c.fileno() == -1
+            except OSError:
+                inbox.closed = True
+            finally:
+                if message[0] is not None:
+                    inbox.slots.release()
+                with self.lock:
+                    self.busy -= 1
+                    inbox.scheduled = len(inbox.requests) > 0
+                if inbox.scheduled:
+                    self.tasks.put(inbox)
 
 
 """
@@ -53,41 +222,173 @@ No caso de o cliente fazer 2 pedidos ou mais consecutivamente, chegando a primei
 de outras ao buffer do socket antes que a thread as consiga ler, é importante termos em atenção o tamanho das
 mensagens, assegurando que não misturamos mensagens. Desta forma, os primeiros 4 bytes de todas as mensagens
 correspondem sempre a 1 inteiro de 4 bytes, que indica o tamanho da mensagem.
+
+Na versão 2 a resposta a um pedido de ficheiro indica também o tamanho dos pacotes do ficheiro. Como os FS_Nodes da versão
+1 assumem sempre pacotes de DEFAULT_BLOCK_SIZE bytes, os ficheiros com outro tamanho não lhes são anunciados. Também apenas
+na versão 2, o FS_Node pode pedir o manifesto de um ficheiro (5), com a hash de cada pacote, e o número de FS_Nodes que
+possuem cada pacote de um ficheiro (6), assim como um número limitado de FS_Nodes que possuem os pacotes que lhe faltam (7)
+e o estado das métricas do FS_Tracker (8). O pedido 9 junta numa só trama os FS_Nodes de vários ficheiros e o pedido 10 faz
+o mesmo, subscrevendo as alterações dos FS_Nodes desses ficheiros, que passam a ser enviadas com a função 'push', até o
+FS_Node terminar a subscrição (11) ou a conexão.
+
+Esta função é executada pelas threads de Request_Pool, para cada pedido de leitura.
 """
-def request_Thread(c, FS_Tracker_DB, message, send_lock, data_to_store, data_to_store_lock, condition):
-    if (message[0]==0):
-        response = FS_Tracker_DB.get_file_owners(message[1])
-        Message_Protocols.send_message_TCP(c, send_lock, response, False)
+def answer_request(c, addr, FS_Tracker_DB, message, send_lock, push=None):
+    reply = get_reply_frame(FS_Tracker_DB, message, Message_Protocols.get_protocol_version(c), addr, push)
+    if reply is not None:
+        Message_Protocols.send_frame_TCP(c, send_lock, reply)
+
+
+"""
+Função que responde a um pedido de leitura de um FS_Node na versão do protocolo 'version', devolvendo a trama da resposta já
+convertida. Caso a mensagem não seja um pedido de leitura devolve None.
+
+Na versão 2, a resposta com os FS_Nodes que possuem um ficheiro é construída pela base de dados a partir dos FS_Nodes já
+convertidos (ver FS_Tracker_DataBase.get_file_owners_frame), evitando converter todos os FS_Nodes a cada pedido.
+
+A duração de cada pedido é registada nas métricas (request.<id_mode>), com o ficheiro e o FS_Node 'addr' caso seja lento,
+assim como o tamanho das respostas (bytes_out.<id_mode>).
+
+No pedido de subscrição (10), 'push' é a função que envia as alterações ao FS_Node 'addr' (ver FS_Tracker_DataBase.subscribe).
+Sem 'push', o pedido é respondido como o pedido 9, sem subscrever os ficheiros.
+"""
+def get_reply_frame(FS_Tracker_DB, message, version, addr=None, push=None):
+    if message[0] not in READ_MODES or (message[0] >= 8 and version < 2):
+        return None
+
+    metrics = FS_Tracker_DB.metrics
+    if message[0]==9 or message[0]==10:
+        fileName = f"{len(message[1][1])} ficheiros"
     else:
-        with data_to_store_lock:
-            data_to_store.append(message)
-            condition.notify()
+        fileName = message[1][0] if message[0]==7 else message[1]
+    with metrics.timed(f"request.{message[0]}", fileName, addr):
+        if message[0]==10 and push is not None:
+            for file in message[1][1]:
+                FS_Tracker_DB.subscribe(file[0], addr, push)
+        frame = _get_reply_frame(FS_Tracker_DB, message, version)
+    metrics.add(f"bytes_out.{message[0]}", len(frame))
+    return frame
+
+
+def _get_reply_frame(FS_Tracker_DB, message, version):
+    if (message[0]==0 or message[0]==7):
+        if message[0]==0:
+            fileName = message[1]
+            arguments = ()
+        else:
+            fileName = message[1][0]
+            arguments = (message[1][1], message[1][2])
+        if version >= 2:
+            frame = FS_Tracker_DB.get_file_owners_frame(fileName, *arguments)
+            if frame is not None:
+                return frame
+            return Message_Protocols.encode_message_TCP([], False, Message_Protocols.REPLY_FILE_OWNERS, version=version)
+        response = FS_Tracker_DB.get_file_owners(fileName, *arguments)
+        if FS_Tracker_DB.get_block_size(fileName) != Message_Protocols.DEFAULT_BLOCK_SIZE:
+            response = []
+        return Message_Protocols.encode_message_TCP(response, False, Message_Protocols.REPLY_FILE_OWNERS, version=version)
+    elif (message[0]==5):
+        return Message_Protocols.encode_message_TCP(FS_Tracker_DB.get_manifest(message[1]), False, Message_Protocols.REPLY_FILE_MANIFEST, version=version)
+    elif (message[0]==6):
+        return Message_Protocols.encode_message_TCP(FS_Tracker_DB.get_packets_rarity(message[1]), False, Message_Protocols.REPLY_FILE_RARITY, version=version)
+    elif (message[0]==9 or message[0]==10):
+        return get_bulk_owners_frame(FS_Tracker_DB, *message[1])
+    return Message_Protocols.encode_message_TCP(FS_Tracker_DB.metrics.snapshot(), False, Message_Protocols.REPLY_STATS, version=2)
+
+
+"""
+Função que responde ao pedido dos FS_Nodes de vários ficheiros (id_mode==9 e id_mode==10), juntando as respostas de cada ficheiro, pela
+ordem do pedido, numa trama REPLY_BULK_OWNERS. Cada resposta é construída a partir do snapshot do ficheiro (ver
+FS_Tracker_DataBase.get_file_owners_frame), sem adquirir nenhum lock global, e os ficheiros que o FS_Tracker não conhece
+são indicados sem FS_Nodes, sem fazer falhar o pedido.
+"""
+def get_bulk_owners_frame(FS_Tracker_DB, max_owners, files):
+    replies = []
+    for fileName, packets_needed in files:
+        if max_owners == 0:
+            frame = FS_Tracker_DB.get_file_owners_frame(fileName)
+        else:
+            frame = FS_Tracker_DB.get_file_owners_frame(fileName, max_owners, packets_needed)
+        replies.append((fileName, frame[5:] if frame is not None else None))
+    return Message_Protocols.encode_bulk_owners_reply_v2(replies)
 
 
 """
-Função responsável por gerir os pedidos e as respostas de um FS_Node, criando uma thread por cada mensagem completa
-recebida pelo FS_Tracker de um determinado FS_Node.
+Função responsável por gerir os pedidos e as respostas de um FS_Node. Os pedidos de leitura de cada mensagem completa recebida
+são entregues às threads de 'pool' (ver Request_Pool) e as mensagens que envolvem escritas são colocadas, pela ordem de
+chegada, na fila de thread_for_store.
+
+Cada mensagem ocupa um lugar do inbox da conexão (ver Client_Inbox) até ser respondida ou guardada. Com o inbox cheio, a
+thread deixa de ler o socket até haver um lugar livre, pelo que o buffer de receção enche e o controlo de fluxo do TCP
+abranda o FS_Node, em vez de o FS_Tracker acumular mensagens em memória. O número de vezes que isto acontece é contado em
+inbox.pushback e o tempo de espera registado em inbox.pushback_wait.
+
+O pedido de negociação da versão do protocolo é respondido nesta thread, antes de ler a mensagem seguinte, pois as
+mensagens que o FS_Node envia depois da resposta já seguem a versão acordada.
+
+Quando o FS_Node se desliga (ou a conexão falha), o inbox é marcado como fechado, para que os pedidos de leitura em espera
+sejam descartados, e a thread espera que thread_for_store guarde as mensagens em espera e que as threads de 'pool' retirem
+os pedidos de leitura (todos os lugares do inbox livres), e só depois remove o FS_Node e as suas subscrições. Caso
+contrário, uma escrita guardada ou uma subscrição (10) respondida depois da remoção voltaria a registar o FS_Node, que
+ficaria na base de dados sem conexão.
 """
-def client_thread(c, addr, FS_Tracker_DB):
+def client_thread(c, addr, FS_Tracker_DB, pool):
+
+    # Caso a informação do FS_Node tenha sido carregada do disco, esta é substituída pelo anúncio que o FS_Node vai enviar
+    FS_Tracker_DB.confirm_FS_node(addr)
 
     # Lock para impedir duas escritas consecutivas no mesmo socket buffer
     send_lock = threading.Lock()
 
     # Inicía a thread que será responsável por escrever as mensagens na base de dados do FS_Tracker e as variáveis necessárias
-    data_to_store = []
+    data_to_store = collections.deque()
     data_to_store_lock = threading.Lock()
     condition = threading.Condition(data_to_store_lock)
-    thread = threading.Thread(target=thread_for_store, args=(FS_Tracker_DB, data_to_store_lock, condition, data_to_store, addr))
+    inbox = Client_Inbox(c, addr, send_lock)
+    inbox.push = lambda frame: pool.push(inbox, frame)
+    thread = threading.Thread(target=thread_for_store, args=(FS_Tracker_DB, data_to_store_lock, condition, data_to_store, addr, inbox.slots))
     thread.start()
+    FS_Tracker_DB.metrics.register_store_queue(addr, data_to_store)
 
     while True:
 
-        message = Message_Protocols.receive_message_TCP(c, True)
+        try:
+            frame = Message_Protocols.receive_frame_TCP(c)
+        except OSError:
+            frame = None
 
-        if (message!=-1):
-            thread = threading.Thread(target=request_Thread, args=(c, FS_Tracker_DB, message, send_lock, data_to_store, data_to_store_lock, condition))
-            thread.start()
+        if (frame is not None):
+            message = Message_Protocols.decode_request_TCP(frame, Message_Protocols.get_protocol_version(c))
+            FS_Tracker_DB.metrics.add(f"bytes_in.{message[0]}", len(frame) + 4)
+
+            if message[0]==0 and (version := Message_Protocols.parse_protocol_probe(message[1])) is not None:
+                version = min(version, Message_Protocols.PROTOCOL_VERSION)
+                Message_Protocols.send_message_TCP(c, send_lock, [version], False)
+                Message_Protocols.set_protocol_version(c, version)
+                FS_Tracker_DB.set_node_version(addr, version)
+                continue
+
+            if not inbox.slots.acquire(False):
+                FS_Tracker_DB.metrics.add("inbox.pushback")
+                start = time.perf_counter()
+                inbox.slots.acquire()
+                FS_Tracker_DB.metrics.histogram("inbox.pushback_wait").record((time.perf_counter() - start) * 1000000)
+
+            if message[0] in READ_MODES:
+                pool.submit(inbox, message)
+            else:
+                with data_to_store_lock:
+                    data_to_store.append(message)
+                    condition.notify()
         else:
+            inbox.closed = True
+            with data_to_store_lock:
+                data_to_store.append(None)
+                condition.notify()
+            thread.join()
+            for _ in range(INBOX_SIZE):
+                inbox.slots.acquire()
+            FS_Tracker_DB.metrics.unregister_store_queue(addr)
             FS_Tracker_DB.remove_FS_node(addr)
             break
 
@@ -95,35 +396,126 @@ def client_thread(c, addr, FS_Tracker_DB):
     c.close()
 
 
+"""
+Thread que escreve periodicamente um snapshot do estado do FS_Tracker e que, passados PROVISIONAL_TIMEOUT segundos do
+arranque, remove os FS_Nodes carregados do disco que não voltaram a ligar-se.
+"""
+def Snapshot_thread(FS_Tracker_DB, wal):
+    started = time.time()
+    expired = False
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL if expired else min(SNAPSHOT_INTERVAL, PROVISIONAL_TIMEOUT))
+        if not expired and time.time() - started >= PROVISIONAL_TIMEOUT:
+            FS_Tracker_DB.expire_provisional()
+            expired = True
+        wal.snapshot(FS_Tracker_DB)
+
+
+"""
+Thread que escreve periodicamente o estado das métricas do FS_Tracker no ficheiro 'path', em JSON.
+"""
+def Metrics_thread(FS_Tracker_DB, path):
+    while True:
+        time.sleep(METRICS_INTERVAL)
+        dump_snapshot(FS_Tracker_DB.metrics.snapshot(), path)
+
+
+"""
+Função que carrega na base de dados o estado guardado na pasta 'state_path' (ver Tracker_WAL), passa a registar nessa pasta
+todas as alterações e inicia a thread que escreve os snapshots. Os FS_Nodes carregados ficam provisórios até voltarem a
+ligar-se.
+"""
+def load_state(FS_Tracker_DB, state_path):
+    wal = Tracker_WAL(state_path)
+    start = time.time()
+    applied = wal.load(FS_Tracker_DB)
+    FS_Tracker_DB.mark_provisional()
+    FS_Tracker_DB.wal = wal
+    print(f"Estado carregado de {state_path}: {applied} registos, {len(FS_Tracker_DB.files)} ficheiros, {len(FS_Tracker_DB.provisional)} FS_Nodes provisórios em {time.time() - start:.3f} s")
+    thread = threading.Thread(target=Snapshot_thread, args=(FS_Tracker_DB, wal), daemon=True)
+    thread.start()
+
+
+"""
+Função que remove de 'arguments' a opção 'option' e o seu valor, devolvendo o valor, ou None caso a opção não exista.
+"""
+def pop_option(arguments, option):
+    if option not in arguments or arguments.index(option) + 1 >= len(arguments):
+        return None
+    position = arguments.index(option)
+    value = arguments[position + 1]
+    del arguments[position:position + 2]
+    return value
+
+
+"""
+Com a flag --async o FS_Tracker usa o servidor de FS_Tracker_Async, que gere todas as conexões com asyncio numa única thread.
+Sem a flag usa o servidor com uma thread por conexão, permitindo comparar os dois com os mesmos FS_Nodes.
+
+Com a opção --state pasta, o FS_Tracker guarda o seu estado nessa pasta (ver Tracker_WAL) e, ao iniciar, carrega o estado
+guardado, ficando os FS_Nodes carregados provisórios até voltarem a ligar-se.
+
+Com a opção --shards N, o FS_Tracker divide os ficheiros por N processos (ver FS_Tracker_Sharded), para usar vários cores.
+
+Com a opção --metrics ficheiro, o estado das métricas do FS_Tracker (ver Tracker_Metrics) é escrito nesse ficheiro a cada
+METRICS_INTERVAL segundos.
+
+Com a opção --workers N, o servidor com threads responde aos pedidos de leitura com N threads (por omissão POOL_WORKERS).
+"""
 def Main():
 
     # Vai buscar os argumentos fornecidos pelo cliente
-    if len(sys.argv) != 3:
+    arguments = sys.argv[1:]
+    use_async = "--async" in arguments
+    if use_async:
+        arguments.remove("--async")
+    state_path = pop_option(arguments, "--state")
+    n_shards = pop_option(arguments, "--shards")
+    metrics_path = pop_option(arguments, "--metrics")
+    n_workers = pop_option(arguments, "--workers")
+    if len(arguments) != 2 or any(option is not None and (not option.isdigit() or int(option) < 1) for option in (n_shards, n_workers)):
         print("Argumentos introduzidos errados.")
-        print("Formato Correto: python3 FS_Tracker.py Tracker_Name Tracker_Port")
+        print("Formato Correto: python3 FS_Tracker.py Tracker_Name Tracker_Port [--async] [--shards N] [--workers N] [--state pasta] [--metrics ficheiro]")
         return
 
-    host_Name, port = sys.argv[1:]
+    host_Name, port = arguments
 
     FS_Tracker_IP = socket.gethostbyname(host_Name)
     Tracker_Port = int(port)
 
+    if n_shards is not None:
+        import FS_Tracker_Sharded
+        FS_Tracker_Sharded.serve_forever(FS_Tracker_IP, Tracker_Port, int(n_shards), state_path, metrics_path)
+        return
+
+    # Inicía a base de dados do FS_Tracker, carregando o estado guardado em disco caso exista
+    FS_Tracker_DB = FS_Tracker_DataBase()
+    if state_path is not None:
+        load_state(FS_Tracker_DB, state_path)
+    if metrics_path is not None:
+        thread = threading.Thread(target=Metrics_thread, args=(FS_Tracker_DB, metrics_path), daemon=True)
+        thread.start()
+
+    if use_async:
+        import FS_Tracker_Async
+        FS_Tracker_Async.serve_forever(FS_Tracker_IP, Tracker_Port, FS_Tracker_DB)
+        return
+
     # Cria o socket na porta correspondente para aceitar conexões de FS_Nodes
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.bind((FS_Tracker_IP, Tracker_Port))
     s.listen(5)
 
-    # Inicía a base de dados do FS_Tracker
-    FS_Tracker_DB = FS_Tracker_DataBase()
+    # Threads que respondem aos pedidos de leitura de todos os FS_Nodes
+    pool = Request_Pool(FS_Tracker_DB, POOL_WORKERS if n_workers is None else int(n_workers))
 
     while True:
 
         # Espera que os clientes se conectem
         c, addr = s.accept()
-        addr[1], _, _ = socket.gethostbyaddr(addr[1])
 
         # Cria uma thread que será responsável por gerrir a comunicação entre o FS_Tracker e um FS_Node
-        thread = threading.Thread(target=client_thread, args=(c, addr, FS_Tracker_DB))
+        thread = threading.Thread(target=client_thread, args=(c, addr, FS_Tracker_DB, pool))
         thread.start()
     
     s.close()
@@ -131,4 +523,3 @@ def Main():
 
 if __name__ == '__main__':
 	Main()
-
@@ -0,0 +1,150 @@
+"""
+Ficheiro com o servidor do FS_Tracker baseado em asyncio, escolhido com a flag --async do FS_Tracker.py. Usa o mesmo
+protocolo e a mesma base de dados que o servidor com threads, mas todas as conexões são geridas por uma única thread, sem
+criar uma thread por conexão nem por FS_Node (thread_for_store) e sem o conjunto de threads que responde aos pedidos
+(Request_Pool).
+
+As chamadas à base de dados (e ao registo em disco, com a opção --state) adquirem os locks da base de dados, que podem
+estar ocupados por outras threads, como a dos snapshots ou a das métricas. Para uma dessas threads não parar todas as
+conexões, as chamadas são executadas nas threads do executor do ciclo de eventos (run_in_executor), e o ciclo continua a
+ler e a escrever nas restantes conexões enquanto esperam.
+"""
+
+import asyncio
+import Message_Protocols
+from FS_Tracker import RESYNC_FRAME, get_reply_frame
+
+
+
+# Número máximo de bytes por enviar a um FS_Node a partir do qual as tramas de alterações das suas subscrições são descartadas
+MAX_PENDING_PUSH_BYTES = 1 << 20
+
+
+
+"""
+Envio das tramas de alterações das subscrições de um FS_Node para o stream da sua conexão, usado pelo servidor asyncio e
+pelo processo principal do servidor com shards. Deve ser criado no ciclo de eventos do servidor.
+
+As alterações aplicadas na thread do ciclo de eventos (no processo principal do servidor com shards) são escritas de
+imediato. As restantes são aplicadas noutras threads (as do executor, no servidor asyncio, e a thread dos snapshots, que
+remove os FS_Nodes provisórios com a opção --state) e, como os streams do asyncio não podem ser usados fora do ciclo de
+eventos, a escrita é agendada no ciclo (call_soon_threadsafe).
+
+Como push não pode esperar pelo drain, quando há mais de MAX_PENDING_PUSH_BYTES bytes por enviar ao FS_Node a conexão fica
+atrasada (lagging): a trama e as seguintes são descartadas (push.dropped) até o buffer de envio esvaziar, altura em que é
+escrita uma única trama RESYNC_FRAME (push.resyncs), para o FS_Node voltar a pedir os FS_Nodes dos ficheiros subscritos, e
+as alterações seguintes voltam a ser escritas.
+"""
+class Push_Stream():
+
+    def __init__(self, writer, metrics):
+        self.writer = writer
+        self.metrics = metrics
+        self.loop = asyncio.get_running_loop()
+        self.lagging = False
+
+
+    def push(self, frame):
+        if in_loop_thread(self.loop):
+            self._write(frame)
+        else:
+            self.loop.call_soon_threadsafe(self._write, frame)
+
+
+    def _write(self, frame):
+        if self.writer.is_closing():
+            return
+        if self.lagging or self.writer.transport.get_write_buffer_size() > MAX_PENDING_PUSH_BYTES:
+            self.metrics.add("push.dropped")
+            if not self.lagging:
+                self.lagging = True
+                self.loop.create_task(self._resync())
+            return
+        self.writer.write(frame)
+
+
+    async def _resync(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            return
+        self.lagging = False
+        if not self.writer.is_closing():
+            self.metrics.add("push.resyncs")
+            self.writer.write(RESYNC_FRAME)
+
+
+"""
+Corrotina que gere a conexão com um FS_Node. Cada trama é lida com o tamanho indicado no campo size_packet e convertida com
+as mesmas funções do servidor com threads.
+
+Cada mensagem é aplicada na base de dados, ou respondida, numa thread do executor (ver o início do ficheiro), e a corrotina
+espera pelo resultado antes de ler a mensagem seguinte da conexão. Assim, as mensagens que envolvem escritas em memória são
+aplicadas pela ordem em que chegam, o que dá a mesma garantia que thread_for_store: as informações de um FS_Node enviadas
+primeiro são guardadas antes das que são enviadas depois. Como cada conexão é uma corrotina, os pedidos de FS_Nodes
+diferentes são servidos de forma intercalada, mesmo quando um deles espera por um lock. A escrita de cada resposta espera
+que o buffer de envio tenha espaço (drain), para um FS_Node lento não acumular respostas em memória.
+
+As tramas de alterações das subscrições do FS_Node (id_mode==10) são escritas no stream por Push_Stream. Como a subscrição
+é registada no executor, uma alteração aplicada entretanto por outra conexão pode chegar ao FS_Node antes da resposta à
+subscrição, o que o FS_Node tem em conta (ver Swarm_Subscriptions).
+"""
+async def client_connection(reader, writer, FS_Tracker_DB):
+    addr = writer.get_extra_info('peername')[:2]
+    version = 1
+    push = Push_Stream(writer, FS_Tracker_DB.metrics).push
+    loop = asyncio.get_running_loop()
+
+    # Caso a informação do FS_Node tenha sido carregada do disco, esta é substituída pelo anúncio que o FS_Node vai enviar
+    await loop.run_in_executor(None, FS_Tracker_DB.confirm_FS_node, addr)
+
+    try:
+        while True:
+            size_packet = int.from_bytes(await reader.readexactly(4), byteorder='big')
+            frame = await reader.readexactly(size_packet)
+            message = Message_Protocols.decode_request_TCP(frame, version)
+            FS_Tracker_DB.metrics.add(f"bytes_in.{message[0]}", size_packet + 4)
+
+            if message[0]==0 and (probe := Message_Protocols.parse_protocol_probe(message[1])) is not None:
+                # A resposta ainda segue a versão 1, as mensagens seguintes já seguem a versão acordada
+                writer.write(Message_Protocols.encode_message_TCP([min(probe, Message_Protocols.PROTOCOL_VERSION)], False))
+                version = min(probe, Message_Protocols.PROTOCOL_VERSION)
+                await loop.run_in_executor(None, FS_Tracker_DB.set_node_version, addr, version)
+                await writer.drain()
+                continue
+
+            reply = await loop.run_in_executor(None, get_reply_frame, FS_Tracker_DB, message, version, addr, push)
+            if reply is not None:
+                writer.write(reply)
+                await writer.drain()
+            else:
+                await loop.run_in_executor(None, FS_Tracker_DB.apply_message, addr, message)
+
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        await loop.run_in_executor(None, FS_Tracker_DB.remove_FS_node, addr)
+        writer.close()
+
+
+"""
+Devolve True caso seja chamada na thread do ciclo de eventos 'loop'.
+"""
+def in_loop_thread(loop):
+    try:
+        return asyncio.get_running_loop() is loop
+    except RuntimeError:
+        return False
+
+
+"""
+Função que inicia o servidor no endereço e porta indicados e aceita conexões até o processo terminar.
+"""
+def serve_forever(FS_Tracker_IP, Tracker_Port, FS_Tracker_DB):
+
+    async def serve():
+        server = await asyncio.start_server(lambda reader, writer: client_connection(reader, writer, FS_Tracker_DB), FS_Tracker_IP, Tracker_Port, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
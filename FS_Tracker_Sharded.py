@@ -0,0 +1,444 @@
+"""
+Ficheiro com o servidor do FS_Tracker dividido em vários processos, escolhido com a opção --shards N do FS_Tracker.py. Um
+processo principal aceita as conexões dos FS_Nodes, com asyncio, e N processos (shards) guardam cada um a sua
+FS_Tracker_DataBase, com os ficheiros cujo nome lhes é atribuído por shard_of. Como cada shard é um processo separado, as
+escritas e as respostas aos pedidos de ficheiros diferentes são executadas em paralelo, em cores diferentes, sem partilhar
+o GIL.
+
+As alterações das subscrições dos FS_Nodes (id_mode==10) são enviadas pelos shards ao processo principal, no mesmo socket das
+respostas, com o identificador SHARD_PUSH, e o processo principal escreve-as na conexão do FS_Node que subscreveu o ficheiro.
+"""
+
+import asyncio
+import itertools
+import multiprocessing
+import socket
+import struct
+import sys
+import time
+import zlib
+import Message_Protocols
+from FS_Track_DataBase import FS_Tracker_DataBase
+from FS_Tracker import READ_MODES, get_reply_frame, load_state
+from FS_Tracker_Async import Push_Stream
+from Tracker_Metrics import Tracker_Metrics, METRICS_INTERVAL, merge_snapshots, dump_snapshot
+
+
+
+# Tipos de registo enviados pelo processo principal aos shards
+SHARD_REQUEST = 0
+SHARD_REMOVE_NODE = 1
+SHARD_NODE_VERSION = 2
+SHARD_CONFIRM_NODE = 3
+
+# Identificador das tramas de alterações das subscrições enviadas pelos shards, que nunca é usado num pedido
+SHARD_PUSH = 0xFFFFFFFF
+
+# Número de bytes lidos de cada vez por um shard
+SHARD_RECV_SIZE = 1 << 16
+
+# Base de dados vazia, usada para construir as respostas dos pedidos de leitura que falharam (ver _error_reply)
+EMPTY_DB = FS_Tracker_DataBase()
+
+_SHARD_HEADER = struct.Struct('>IIB')
+_SHARD_REPLY_HEADER = struct.Struct('>II')
+_PORT = struct.Struct('>H')
+
+
+"""
+Função que devolve o shard responsável por um ficheiro. Usa o crc32 do nome, e não a função hash, para todos os processos
+calcularem o mesmo shard.
+"""
+def shard_of(fileName, n_shards):
+    return zlib.crc32(fileName.encode('utf-8')) % n_shards
+
+
+"""
+Função que divide um pedido de um FS_Node, recebido na versão do protocolo 'version', pelos shards, devolvendo uma lista
+de pares (shard, trama), em que cada trama é um pedido da versão 2 sem o campo size_packet, ou uma lista vazia caso o pedido
+não seja conhecido. Os pedidos de um único ficheiro da versão 2 (o caso comum) são enviados sem serem convertidos, lendo
+apenas o nome do ficheiro. Os anúncios são convertidos e divididos num anúncio por shard, com os ficheiros desse shard, e
+os pedidos da versão 1 são convertidos para a versão 2, para os shards receberem sempre a mesma versão.
+"""
+def split_request(frame, version, n_shards):
+    if version >= 2 and frame[0] != 1:
+        return [(shard_of(Message_Protocols.get_request_filename_v2(frame), n_shards), bytes(frame))]
+
+    id_mode, message = Message_Protocols.decode_request_TCP(frame, version)
+    if message is None:
+        return []
+    if id_mode == 1:
+        shards = {}
+        for file in message:
+            shards.setdefault(shard_of(file[0], n_shards), []).append(file)
+        return [(shard, bytes(Message_Protocols.encode_message_TCP_v2(files, True, 1)[4:])) for shard, files in shards.items()]
+
+    fileName = message if id_mode == 0 else message[0]
+    if id_mode == 2 or id_mode == 3:
+        message = [fileName, message[1]]
+    return [(shard_of(fileName, n_shards), bytes(Message_Protocols.encode_message_TCP_v2(message, True, id_mode)[4:]))]
+
+
+def _encode_record(request_id, kind, addr, version, body):
+    ip = addr[0].encode('utf-8')
+    payload = bytes([len(ip)]) + ip + _PORT.pack(addr[1]) + bytes([version]) + body
+    return _SHARD_HEADER.pack(len(payload) + 5, request_id, kind) + payload
+
+
+"""
+Função que converte uma trama de alterações de uma subscrição do FS_Node 'addr' no registo enviado ao processo principal.
+"""
+def _encode_push(addr, frame):
+    ip = addr[0].encode('utf-8')
+    payload = bytes([len(ip)]) + ip + _PORT.pack(addr[1]) + frame
+    return _SHARD_REPLY_HEADER.pack(len(payload) + 4, SHARD_PUSH) + payload
+
+
+"""
+Função que aplica um registo do processo principal na base de dados do shard, devolvendo a resposta (trama completa, na
+versão do FS_Node) caso seja um pedido de leitura e None caso contrário. Caso seja indicado 'outbox', as subscrições dos
+FS_Nodes escrevem as tramas de alterações nesse buffer, já no formato enviado ao processo principal (ver _encode_push).
+"""
+def handle_record(FS_Tracker_DB, record, outbox=None):
+    _, request_id, kind = _SHARD_HEADER.unpack_from(record, 0)
+    position = _SHARD_HEADER.size
+    ip_size = record[position]
+    ip = str(record[position+1:position+1+ip_size], 'utf-8')
+    position += 1 + ip_size
+    addr = (ip, _PORT.unpack_from(record, position)[0])
+    version = record[position+2]
+    body = record[position+3:]
+
+    if kind == SHARD_REQUEST:
+        message = Message_Protocols.decode_message_TCP_v2(body, True)
+        push = None
+        if message[0] == 10 and outbox is not None:
+            push = lambda frame: outbox.extend(_encode_push(addr, frame))
+        frame = get_reply_frame(FS_Tracker_DB, message, version, addr, push)
+        if frame is None:
+            FS_Tracker_DB.apply_message(addr, message)
+            return None
+        return _SHARD_REPLY_HEADER.pack(len(frame) + 4, request_id) + frame
+    elif kind == SHARD_REMOVE_NODE:
+        FS_Tracker_DB.remove_FS_node(addr)
+    elif kind == SHARD_NODE_VERSION:
+        FS_Tracker_DB.set_node_version(addr, version)
+    elif kind == SHARD_CONFIRM_NODE:
+        FS_Tracker_DB.confirm_FS_node(addr)
+    return None
+
+
+"""
+Função que devolve a resposta a um registo de leitura cuja aplicação falhou (ver shard_worker), ou None caso o registo não
+seja um pedido de leitura. A resposta é a de uma base de dados vazia (EMPTY_DB), pelo que os pedidos de ficheiros recebem
+uma lista de FS_Nodes vazia, no formato esperado pelo processo principal.
+"""
+def _error_reply(record):
+    _, request_id, kind = _SHARD_HEADER.unpack_from(record, 0)
+    position = _SHARD_HEADER.size + 1 + record[_SHARD_HEADER.size]
+    version = record[position+2]
+    body = record[position+3:]
+    if kind != SHARD_REQUEST or not body or body[0] not in READ_MODES:
+        return None
+
+    try:
+        frame = get_reply_frame(EMPTY_DB, Message_Protocols.decode_message_TCP_v2(body, True), version)
+    except Exception:
+        frame = None
+    if frame is None:
+        frame = Message_Protocols.encode_message_TCP([], False, Message_Protocols.REPLY_FILE_OWNERS, version=version)
+    return _SHARD_REPLY_HEADER.pack(len(frame) + 4, request_id) + frame
+
+
+"""
+Função executada por cada shard. Lê do socket os registos enviados pelo processo principal, pela ordem em que foram
+enviados, e responde aos pedidos de leitura no mesmo socket. Todos os registos completos lidos de uma vez são aplicados
+antes de enviar as respostas, que seguem juntas, reduzindo o número de chamadas ao sistema quando há muitos pedidos. As
+respostas e as tramas de alterações das subscrições são escritas no mesmo buffer (outbox), pela ordem em que são geradas.
+
+Um erro ao aplicar um registo é contado em shard.errors e não termina o shard: os pedidos de leitura recebem a resposta de
+_error_reply, pois o processo principal espera pela resposta de cada pedido, e o shard continua com os registos seguintes.
+
+Caso o FS_Tracker guarde o seu estado em disco, cada shard usa a sua pasta, identificada pelo índice e pelo número de shards,
+pois com outro número de shards os ficheiros seriam atribuídos a shards diferentes.
+"""
+def shard_worker(sock, index, n_shards, state_path):
+    FS_Tracker_DB = FS_Tracker_DataBase()
+    if state_path is not None:
+        load_state(FS_Tracker_DB, state_path.rstrip("/") + f"/shard.{index}.{n_shards}")
+
+    buffer = bytearray()
+    outbox = bytearray()
+    while True:
+        data = sock.recv(SHARD_RECV_SIZE)
+        if not data:
+            break
+        buffer += data
+
+        offset = 0
+        while len(buffer) - offset >= 4:
+            size = int.from_bytes(buffer[offset:offset+4], byteorder='big')
+            if len(buffer) - offset - 4 < size:
+                break
+            record = bytes(buffer[offset:offset+4+size])
+            offset += 4 + size
+            try:
+                reply = handle_record(FS_Tracker_DB, record, outbox)
+            except Exception as error:
+                FS_Tracker_DB.metrics.add("shard.errors")
+                sys.stderr.write(f"Erro no shard {index}: {error!r}\n")
+                reply = _error_reply(record)
+            if reply is not None:
+                outbox += reply
+        del buffer[:offset]
+
+        if outbox:
+            sock.sendall(outbox)
+            outbox.clear()
+    sock.close()
+
+
+class Shard_Router():
+
+    """
+    Classe usada pelo processo principal para comunicar com os shards. Cada shard tem um socket (socketpair) e os pedidos
+    de leitura de cada shard ficam num dicionário de pending, com o identificador do pedido como key e o Future da resposta
+    como value, até a tarefa que lê as respostas desse shard as receber. Caso um shard termine, os pedidos à espera da sua
+    resposta, e os seguintes, falham com ConnectionError (contado em shard.lost), o que fecha as conexões dos FS_Nodes que
+    os fizeram, em vez de ficarem à espera de uma resposta que nunca chega. Os shards são criados com o método spawn, para cada um herdar apenas
+    o seu socket: ao terminar o processo principal, todos os sockets dos shards fecham e os shards terminam.
+
+    Como cada ficheiro pertence a um único shard e os registos de cada shard são aplicados pela ordem de envio, as
+    informações de um FS_Node sobre um ficheiro continuam a ser guardadas pela ordem em que foram enviadas, e a remoção de
+    um FS_Node, enviada a todos os shards, é aplicada depois de todas as suas mensagens anteriores.
+
+    As métricas do processo principal (metrics) contam os bytes recebidos de cada tipo de pedido e a duração dos pedidos de
+    leitura incluindo a comunicação com os shards (frontend.request.<id_mode>). O pedido das métricas (id_mode==8) é enviado
+    a todos os shards e as respostas são juntas com as métricas do processo principal (ver Tracker_Metrics.merge_snapshots).
+    O pedido de vários ficheiros (id_mode==9), assim como a subscrição (id_mode==10), é dividido pelos shards de cada ficheiro
+    (ver bulk_owners).
+
+    Estrutura connections = {(172.0.0.1, 9090): Push_Stream}
+    Conexão de cada FS_Node, onde são escritas as tramas de alterações das suas subscrições recebidas dos shards, com os
+    mesmos limites do servidor asyncio (ver FS_Tracker_Async.Push_Stream). Como estas
+    não passam pela corrotina da conexão, uma trama de alterações pode chegar ao FS_Node antes da resposta à subscrição, o
+    que o FS_Node tem em conta (ver Swarm_Subscriptions).
+    """
+    def __init__(self, n_shards, state_path=None):
+        self.n_shards = n_shards
+        self.metrics = Tracker_Metrics()
+        context = multiprocessing.get_context('spawn')
+        self.processes = []
+        self.sockets = []
+        for index in range(n_shards):
+            parent, child = socket.socketpair()
+            process = context.Process(target=shard_worker, args=(child, index, n_shards, state_path), daemon=True)
+            process.start()
+            child.close()
+            self.processes.append(process)
+            self.sockets.append(parent)
+        self.writers = []
+        self.pending = [{} for _ in range(n_shards)]
+        self.connections = {}
+        self.request_ids = itertools.count()
+
+
+    """
+    Corrotina que cria os streams de cada shard e as tarefas que leem as respostas. Tem de ser executada no ciclo de eventos
+    do servidor.
+    """
+    async def start(self):
+        for shard, sock in enumerate(self.sockets):
+            reader, writer = await asyncio.open_connection(sock=sock)
+            self.writers.append(writer)
+            asyncio.get_running_loop().create_task(self._read_replies(shard, reader))
+
+
+    """
+    Corrotina que envia o pedido de um FS_Node aos shards responsáveis e, caso seja um pedido de leitura, devolve a resposta.
+    """
+    async def request(self, addr, version, frame):
+        if version >= 2 and frame[0] == 8:
+            stats = await self.stats(addr)
+            return Message_Protocols.encode_message_TCP(stats, False, Message_Protocols.REPLY_STATS, version=version)
+        if version >= 2 and (frame[0] == 9 or frame[0] == 10):
+            start = time.perf_counter()
+            reply = await self.bulk_owners(addr, frame)
+            self.metrics.observe(f"frontend.request.{frame[0]}", time.perf_counter() - start, None, addr)
+            return reply
+
+        parts = split_request(frame, version, self.n_shards)
+        if parts and parts[0][1][0] in READ_MODES:
+            start = time.perf_counter()
+            reply = await self._read(parts[0][0], addr, version, parts[0][1])
+            self.metrics.observe(f"frontend.request.{parts[0][1][0]}", time.perf_counter() - start, None, addr)
+            return reply
+
+        for shard, body in parts:
+            self._check(shard)
+            self.writers[shard].write(_encode_record(0, SHARD_REQUEST, addr, version, body))
+            await self.writers[shard].drain()
+        return None
+
+
+    """
+    Corrotina que pede as métricas a todos os shards que não terminaram e devolve-as juntas com as métricas do processo
+    principal.
+    """
+    async def stats(self, addr=("", 0)):
+        shards = [shard for shard in range(self.n_shards) if not self.writers[shard].is_closing()]
+        replies = await asyncio.gather(*[self._read(shard, addr, 2, bytes([8])) for shard in shards])
+        snapshots = [Message_Protocols.decode_message_TCP_v2(reply[4:], False) for reply in replies]
+        return merge_snapshots(snapshots + [self.metrics.snapshot()])
+
+
+    """
+    Corrotina que responde ao pedido dos FS_Nodes de vários ficheiros (id_mode==9 e id_mode==10): os ficheiros são divididos
+    por shard, cada shard recebe um pedido com os seus ficheiros (e regista as subscrições desses ficheiros) e as respostas
+    são juntas pela ordem do pedido original, sem converter os FS_Nodes (ver Message_Protocols.split_bulk_owners_reply_v2).
+    """
+    async def bulk_owners(self, addr, frame):
+        id_mode, (max_owners, files) = Message_Protocols.decode_request_TCP(frame, 2)
+        shards = {}
+        for position, file in enumerate(files):
+            shards.setdefault(shard_of(file[0], self.n_shards), []).append(position)
+
+        requests = []
+        for shard, positions in shards.items():
+            body = bytes(Message_Protocols.encode_message_TCP_v2([max_owners, [files[position] for position in positions]], True, id_mode)[4:])
+            requests.append(self._read(shard, addr, 2, body))
+
+        replies = [None] * len(files)
+        for positions, reply in zip(shards.values(), await asyncio.gather(*requests)):
+            for position, entry in zip(positions, Message_Protocols.split_bulk_owners_reply_v2(reply[4:])):
+                replies[position] = entry
+        return Message_Protocols.encode_bulk_owners_reply_v2(replies)
+
+
+    async def _read(self, shard, addr, version, body):
+        self._check(shard)
+        request_id = next(self.request_ids) % SHARD_PUSH
+        future = asyncio.get_running_loop().create_future()
+        self.pending[shard][request_id] = future
+        self.writers[shard].write(_encode_record(request_id, SHARD_REQUEST, addr, version, body))
+        return await future
+
+
+    """
+    Corrotina que envia a mesma informação sobre um FS_Node a todos os shards (remoção, versão ou confirmação).
+    """
+    async def broadcast(self, kind, addr, version=1):
+        record = _encode_record(0, kind, addr, version, b'')
+        for writer in self.writers:
+            if writer.is_closing():
+                continue
+            writer.write(record)
+            await writer.drain()
+
+
+    """
+    Escreve na conexão do FS_Node uma trama de alterações recebida de um shard (ver _encode_push), descartando-a caso o
+    FS_Node já não esteja ligado.
+    """
+    def _push(self, record):
+        ip_size = record[0]
+        addr = (str(record[1:1+ip_size], 'utf-8'), _PORT.unpack_from(record, 1 + ip_size)[0])
+        stream = self.connections.get(addr)
+        if stream is not None:
+            stream.push(record[3+ip_size:])
+
+
+    def _check(self, shard):
+        if self.writers[shard].is_closing():
+            raise ConnectionError(f"O shard {shard} terminou")
+
+
+    """
+    Corrotina que lê as respostas de um shard até o seu socket fechar. Nesse caso, o socket é fechado e os pedidos à espera
+    de resposta falham com ConnectionError.
+    """
+    async def _read_replies(self, shard, reader):
+        pending = self.pending[shard]
+        try:
+            while True:
+                size, request_id = _SHARD_REPLY_HEADER.unpack(await reader.readexactly(_SHARD_REPLY_HEADER.size))
+                frame = await reader.readexactly(size - 4)
+                if request_id == SHARD_PUSH:
+                    self._push(frame)
+                    continue
+                future = pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        self.metrics.add("shard.lost")
+        self.writers[shard].close()
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"O shard {shard} terminou"))
+        pending.clear()
+
+
+"""
+Corrotina que gere a conexão com um FS_Node no processo principal, com as mesmas regras de FS_Tracker_Async.client_connection,
+mas enviando os pedidos aos shards em vez de os aplicar numa base de dados local. Os pedidos de leitura de uma conexão são
+respondidos pela ordem em que chegam.
+"""
+async def client_connection(reader, writer, router):
+    addr = writer.get_extra_info('peername')[:2]
+    version = 1
+    router.connections[addr] = Push_Stream(writer, router.metrics)
+
+    # Caso a informação do FS_Node tenha sido carregada do disco, esta é substituída pelo anúncio que o FS_Node vai enviar
+    await router.broadcast(SHARD_CONFIRM_NODE, addr)
+
+    try:
+        while True:
+            size_packet = int.from_bytes(await reader.readexactly(4), byteorder='big')
+            frame = await reader.readexactly(size_packet)
+            router.metrics.add(f"bytes_in.{frame[0] if version >= 2 else int.from_bytes(frame[:4], byteorder='big')}", size_packet + 4)
+
+            if version == 1:
+                message = Message_Protocols.decode_request_TCP(frame, version)
+                if message[0]==0 and (probe := Message_Protocols.parse_protocol_probe(message[1])) is not None:
+                    # A resposta ainda segue a versão 1, as mensagens seguintes já seguem a versão acordada
+                    writer.write(Message_Protocols.encode_message_TCP([min(probe, Message_Protocols.PROTOCOL_VERSION)], False))
+                    version = min(probe, Message_Protocols.PROTOCOL_VERSION)
+                    await router.broadcast(SHARD_NODE_VERSION, addr, version)
+                    await writer.drain()
+                    continue
+
+            reply = await router.request(addr, version, frame)
+            if reply is not None:
+                writer.write(reply)
+                await writer.drain()
+
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        router.connections.pop(addr, None)
+        await router.broadcast(SHARD_REMOVE_NODE, addr)
+        writer.close()
+
+
+"""
+Função que inicia os shards e o servidor no endereço e porta indicados e aceita conexões até o processo terminar. Caso seja
+indicado 'metrics_path', as métricas de todos os processos são escritas nesse ficheiro a cada METRICS_INTERVAL segundos.
+"""
+def serve_forever(FS_Tracker_IP, Tracker_Port, n_shards, state_path=None, metrics_path=None):
+    router = Shard_Router(n_shards, state_path)
+
+    async def dump_metrics():
+        while True:
+            await asyncio.sleep(METRICS_INTERVAL)
+            dump_snapshot(await router.stats(), metrics_path)
+
+    async def serve():
+        await router.start()
+        if metrics_path is not None:
+            asyncio.get_running_loop().create_task(dump_metrics())
+        server = await asyncio.start_server(lambda reader, writer: client_connection(reader, writer, router), FS_Tracker_IP, Tracker_Port, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
@@ -0,0 +1,467 @@
+"""
+Ficheiro correspondente à classe que guarda, no FS_Tracker, os FS_Nodes que possuem um ficheiro ou partes do mesmo. Cada
+ficheiro tem uma instância desta classe, que permite consultar, atualizar, promover a completo e remover um FS_Node em tempo
+constante, mantendo a ordem rotativa pela qual os FS_Nodes são enviados nas respostas do FS_Tracker e o número de FS_Nodes
+que possuem cada pacote do ficheiro.
+"""
+
+import threading
+from ReentrantRWLock import ReentrantRWLock
+from Message_Protocols import encode_peer_v2
+
+
+
+# Número de FS_Nodes percorridos por cada FS_Node devolvido por File_Owners.select, no máximo
+SCAN_FACTOR = 8
+
+
+class File_Owners():
+
+	"""
+	Estrutura packets = {(172.0.0.1, 9090): -1, (193.0.1.2, 9090): 61253}
+	Cada key é o endereço de um FS_Node que possuí pacotes do ficheiro e cada value os pacotes que possuí, no formato de
+	packets_owned das mensagens do FS_Node, ou -1 caso o FS_Node tenha o ficheiro completo.
+
+	Estrutura ring = {(172.0.0.1, 9090): [(193.0.1.2, 9090), (193.0.1.2, 9090)], (193.0.1.2, 9090): [...]}
+	Lista circular duplamente ligada com os mesmos endereços, em que cada value é o par [anterior, seguinte]. A variável head
+	é o FS_Node que será enviado em primeiro lugar na próxima resposta e a cada resposta avança uma posição. Como os FS_Nodes
+	com o ficheiro completo e os restantes partilham a mesma lista circular, percorrê-la a partir de head dá [completos rodados]
+	+ [incompletos] + [restantes completos], ou o equivalente quando a rotação já chegou aos incompletos.
+
+	Os FS_Nodes novos, ou que passam a ter o ficheiro completo, são inseridos antes de head e passam a ser o novo head, ficando
+	em primeiro lugar na próxima resposta.
+
+	Estrutura partial_counts = [2, 0, 1, ...]
+	Número de FS_Nodes sem o ficheiro completo que possuem cada pacote, pela ordem dos pacotes. O número de cópias de um pacote
+	na rede é n_complete (número de FS_Nodes com o ficheiro completo) mais o valor desta lista, pelo que um FS_Node com o
+	ficheiro completo que entra ou sai da rede apenas altera n_complete. Nas restantes alterações apenas são percorridos os
+	pacotes que mudaram.
+
+	Estrutura snapshot = Owners_Snapshot
+	Cópia imutável da lista circular a partir de head, usada por todas as consultas (ver Owners_Snapshot), com a posição atual
+	da rotação e a cache com os FS_Nodes já convertidos para a resposta do FS_Tracker da versão 2. As consultas apenas leem o
+	snapshot atual, sem adquirir o lock do ficheiro, pelo que nunca esperam por uma escrita nem a atrasam. Cada escrita que
+	altera os FS_Nodes, ou a versão do protocolo de um FS_Node, atualiza o snapshot convertendo apenas esse FS_Node (ver
+	_patch), pelo que a consulta seguinte a uma escrita não tem de reconstruir o snapshot nem a cache. Uma escrita que apenas
+	altera os pacotes de um FS_Node (o caso das atualizações de pacotes) altera a sua posição do snapshot atual em tempo
+	constante, encontrada no dicionário positions; as restantes (um FS_Node novo, removido ou que passa a ter o ficheiro
+	completo) constroem um snapshot novo e trocam-no de uma só vez (copy-on-write). O snapshot só é construído de raiz no
+	primeiro pedido do ficheiro, e a cache é construída uma vez por ficheiro (misses) com o dicionário peers_version das
+	versões dos FS_Nodes, usado depois para converter os FS_Nodes alterados. Os pedidos respondidos a partir da cache contam
+	em hits e as escritas que a alteraram em patches.
+
+	Estrutura positions = {(172.0.0.1, 9090): 0, (193.0.1.2, 9090): 1}
+	Posição de cada FS_Node no snapshot atual, ou None caso ainda não tenha sido construída para este snapshot. Como a
+	posição dos FS_Nodes apenas muda com um snapshot novo, é construída uma vez por snapshot, na primeira atualização de
+	pacotes seguinte.
+
+	Estrutura counts = (3, 1, 2, ...)
+	Cópia imutável do número de FS_Nodes que possuem cada pacote, descartada a cada escrita e reconstruída no pedido seguinte.
+
+	O lock de leitura e escrita protege a lista circular, os pacotes e as contagens: as escritas adquirem o lock de escrita e
+	as consultas apenas o adquirem para construir um snapshot novo. Caso seja indicado o histograma 'lock_wait', o lock regista
+	nele o tempo de espera sempre que está ocupado.
+	"""
+	def __init__(self, n_packets, lock_wait=None):
+		self.lock = ReentrantRWLock(lock_wait)
+		self.n_packets = n_packets
+		self.all_packets = (1 << n_packets) - 1
+		self.packets = {}
+		self.ring = {}
+		self.head = None
+		self.partial_counts = [0] * n_packets
+		self.n_complete = 0
+		self.snapshot = None
+		self.positions = None
+		self.peers_version = None
+		self.counts = None
+		self.hits = 0
+		self.misses = 0
+		self.patches = 0
+
+
+	def __contains__(self, addr):
+		return addr in self.packets
+
+
+	def __len__(self):
+		return len(self.packets)
+
+
+	"""
+	Função que aplica a informação enviada por um FS_Node sobre o ficheiro, seguindo as regras descritas em
+	FS_Tracker_DataBase.update_information. Para um FS_Node que ainda não possuía pacotes do ficheiro 'packets_owned' são os
+	pacotes que possuí; caso contrário são as alterações, aplicadas com um XOR. Um FS_Node com o ficheiro completo que envia -1
+	apagou o ficheiro.
+	"""
+	def update(self, addr, packets_owned):
+		current = self.packets.get(addr)
+
+		if current is None:
+			if packets_owned == -1 or self.n_packets == 1 or packets_owned == self.all_packets:
+				self._set(addr, -1)
+			elif packets_owned:
+				self._set(addr, packets_owned)
+			return
+
+		if packets_owned == -1:
+			self._set(addr, None if current == -1 else -1)
+			return
+
+		xor = (self.all_packets if current == -1 else current) ^ packets_owned
+		if xor == 0:
+			self._set(addr, None)
+		elif xor == self.all_packets:
+			self._set(addr, -1)
+		else:
+			self._set(addr, xor)
+
+
+	"""
+	Função que remove um FS_Node. Caso seja o próximo a ser enviado em primeiro lugar, passa a sê-lo o seguinte, para a rotação
+	não voltar atrás.
+	"""
+	def remove(self, addr):
+		self._set(addr, None)
+
+
+	"""
+	Devolve os FS_Nodes a partir de head, no formato da resposta do FS_Tracker (o endereço para os FS_Nodes com o ficheiro completo
+	e [endereço, pacotes] para os restantes), e avança a rotação uma posição.
+	"""
+	def rotate(self):
+		snapshot = self.get_snapshot()
+		n = len(snapshot.order)
+		if n == 0:
+			return []
+
+		first, _, _ = self._advance(snapshot, n, -1, n, 1)
+		return [self._owner(snapshot, position % n) for position in range(first, first + n)]
+
+
+	"""
+	Devolve, no mesmo formato que rotate, no máximo 'max_owners' FS_Nodes a partir de head que possuem algum dos pacotes de
+	'packets_needed' (-1 caso sejam todos os pacotes). Para o custo não crescer com o número de FS_Nodes do ficheiro, são
+	percorridos no máximo 'max_visited' FS_Nodes (por omissão SCAN_FACTOR vezes 'max_owners').
+
+	A rotação avança para o FS_Node seguinte ao último percorrido, pelo que pedidos consecutivos recebem grupos diferentes
+	de FS_Nodes, distribuindo os pedidos de pacotes por todos os FS_Nodes do ficheiro.
+	"""
+	def select(self, max_owners, packets_needed=-1, max_visited=None):
+		snapshot = self.get_snapshot()
+		n = len(snapshot.order)
+		if n == 0 or max_owners <= 0:
+			return []
+
+		first, count, selected = self._advance(snapshot, max_owners, packets_needed, max_visited)
+		if selected is None:
+			selected = [position % n for position in range(first, first + count)]
+		return [self._owner(snapshot, position) for position in selected]
+
+
+	"""
+	Funções equivalentes a rotate e select, que devolvem os mesmos FS_Nodes e avançam a rotação da mesma forma, mas já
+	convertidos e concatenados para a resposta da versão 2, a partir da cache. 'peers_version' é o dicionário com a versão
+	de cada FS_Node, usado para construir a cache.
+	"""
+	def rotate_encoded(self, peers_version):
+		snapshot = self.get_snapshot()
+		n = len(snapshot.order)
+		if n == 0:
+			return b''
+
+		peers = self._get_encoded(snapshot, peers_version)
+		first, _, _ = self._advance(snapshot, n, -1, n, 1)
+		return b''.join(peers[first:]) + b''.join(peers[:first])
+
+
+	def select_encoded(self, max_owners, packets_needed, peers_version, max_visited=None):
+		snapshot = self.get_snapshot()
+		n = len(snapshot.order)
+		if n == 0 or max_owners <= 0:
+			return b''
+
+		peers = self._get_encoded(snapshot, peers_version)
+		first, count, selected = self._advance(snapshot, max_owners, packets_needed, max_visited)
+
+		# Sem filtro todos os FS_Nodes percorridos são devolvidos, pelo que a resposta é um único excerto (ou dois, se der a volta)
+		if selected is None:
+			last = first + count
+			if last <= n:
+				return b''.join(peers[first:last])
+			return b''.join(peers[first:]) + b''.join(peers[:last - n])
+
+		return b''.join([peers[position] for position in selected])
+
+
+	"""
+	Devolve o snapshot atual dos FS_Nodes do ficheiro (ver Owners_Snapshot), sem adquirir o lock do ficheiro. Apenas no
+	primeiro pedido do ficheiro é adquirido o lock de escrita, para construir o snapshot a partir da lista circular sem
+	alterações em curso; a partir daí, cada escrita mantém o snapshot atualizado.
+	"""
+	def get_snapshot(self):
+		snapshot = self.snapshot
+		if snapshot is not None:
+			return snapshot
+
+		with self.lock.w_locked():
+			if self.snapshot is None:
+				order = []
+				addr = self.head
+				for _ in range(len(self.ring)):
+					order.append(addr)
+					addr = self.ring[addr][1]
+				self.snapshot = Owners_Snapshot(tuple(order), [self.packets[addr] for addr in order])
+				self.positions = None
+			return self.snapshot
+
+
+	"""
+	Função que volta a converter um FS_Node na cache, quando a versão do protocolo do FS_Node muda. Deve ser chamada com o
+	lock de escrita.
+	"""
+	def refresh(self, addr):
+		current = self.packets.get(addr)
+		if current is not None:
+			self._patch(addr, current, current)
+
+
+	"""
+	Função que avança a rotação do snapshot, com o lock do snapshot, percorrendo no máximo 'max_visited' FS_Nodes a partir da
+	posição atual, como descrito em select. Devolve a primeira posição, o número de FS_Nodes percorridos e as posições dos
+	FS_Nodes que possuem algum dos pacotes de 'packets_needed', ou None caso não haja filtro (são devolvidos todos os
+	percorridos). 'step' indica um avanço fixo da rotação, usado por rotate.
+	"""
+	def _advance(self, snapshot, max_owners, packets_needed, max_visited, step=None):
+		n = len(snapshot.order)
+		if max_visited is None:
+			max_visited = max_owners * SCAN_FACTOR
+		max_visited = min(max_visited, n)
+
+		with snapshot.lock:
+			first = snapshot.cursor
+			if packets_needed == -1:
+				count = min(max_owners, max_visited)
+				snapshot.cursor = (first + (count if step is None else step)) % n
+				return first, count, None
+
+			packets = snapshot.packets
+			selected = []
+			position = first
+			for count in range(1, max_visited + 1):
+				packets_owned = packets[position]
+				if packets_owned == -1 or packets_owned & packets_needed:
+					selected.append(position)
+				position = position + 1 if position + 1 < n else 0
+				if len(selected) == max_owners:
+					break
+			snapshot.cursor = position
+			return first, count, selected
+
+
+	def _owner(self, snapshot, position):
+		packets_owned = snapshot.packets[position]
+		addr = snapshot.order[position]
+		return addr if packets_owned == -1 else [addr, packets_owned]
+
+
+	def _get_encoded(self, snapshot, peers_version):
+		encoded = snapshot.encoded
+		if encoded is not None:
+			self.hits += 1
+			return encoded
+
+		# Construída com o lock de escrita, para uma escrita não criar um snapshot novo sem a cache a meio da construção
+		with self.lock.w_locked():
+			if self.snapshot is snapshot and snapshot.encoded is None:
+				self.misses += 1
+				self.peers_version = peers_version
+				snapshot.encoded = [encode_peer_v2(addr, packets_owned, peers_version) for addr, packets_owned in zip(snapshot.order, snapshot.packets)]
+			if snapshot.encoded is not None:
+				return snapshot.encoded
+		return [encode_peer_v2(addr, packets_owned, peers_version) for addr, packets_owned in zip(snapshot.order, snapshot.packets)]
+
+
+	"""
+	Devolve o número de FS_Nodes que possuem cada pacote do ficheiro, pela ordem dos pacotes. Tal como os FS_Nodes, os valores
+	são lidos de um tuplo imutável (counts), descartado a cada escrita e reconstruído com o lock de escrita no pedido seguinte.
+	"""
+	def get_counts(self):
+		counts = self.counts
+		if counts is None:
+			with self.lock.w_locked():
+				counts = self.counts
+				if counts is None:
+					n_complete = self.n_complete
+					counts = self.counts = tuple(n_complete + count for count in self.partial_counts)
+		return list(counts)
+
+
+	"""
+	Função que altera os pacotes de um FS_Node para 'packets_owned' (-1 caso passe a ter o ficheiro completo e None caso deixe de
+	ter pacotes), atualizando a lista circular e o número de cópias de cada pacote. Os FS_Nodes novos e os que passam a ter o
+	ficheiro completo são colocados em head.
+	"""
+	def _set(self, addr, packets_owned):
+		current = self.packets.get(addr)
+		if current == packets_owned:
+			return
+
+		self._patch(addr, current, packets_owned)
+		self.counts = None
+		self.n_complete += (packets_owned == -1) - (current == -1)
+		old_partial = current if current is not None and current != -1 else 0
+		new_partial = packets_owned if packets_owned is not None and packets_owned != -1 else 0
+		if old_partial != new_partial:
+			self._update_counts(old_partial ^ new_partial, new_partial)
+
+		if packets_owned is None:
+			del self.packets[addr]
+			self._unlink(addr)
+			return
+
+		self.packets[addr] = packets_owned
+		if current is None:
+			self._link_first(addr)
+		elif packets_owned == -1:
+			self._unlink(addr)
+			self._link_first(addr)
+
+
+	"""
+	Função que atualiza o snapshot com os pacotes do FS_Node 'addr' alterados de 'current' para 'packets_owned'. Caso o
+	snapshot tenha a cache dos FS_Nodes convertidos, apenas o FS_Node alterado é convertido. Deve ser chamada com o lock de
+	escrita, antes de alterar a lista circular.
+
+	Caso o FS_Node continue na mesma posição, os seus pacotes são alterados no próprio snapshot, na posição indicada por
+	positions, sem copiar os restantes FS_Nodes. Como a alteração de uma posição de uma lista é atómica, uma consulta em curso
+	recebe os pacotes de antes ou de depois da escrita para esse FS_Node.
+
+	Caso contrário, o snapshot é substituído por um novo, seguindo as mesmas regras de _set para a lista circular: um FS_Node
+	novo, ou que passa a ter o ficheiro completo, fica na posição atual da rotação (o próximo a ser enviado) e um FS_Node
+	removido sai da sua posição, passando a posição atual da rotação para o seguinte quando era o próximo a ser enviado. As
+	cópias são feitas pelo interpretador, sem percorrer os FS_Nodes em Python, e head passa a ser o FS_Node da posição atual
+	da rotação, para a lista circular continuar igual ao snapshot. Uma consulta ao snapshot anterior que avance a rotação
+	depois de o cursor ser copiado não conta no snapshot novo, pelo que, no máximo, os mesmos FS_Nodes são enviados em
+	primeiro lugar duas vezes.
+	"""
+	def _patch(self, addr, current, packets_owned):
+		snapshot = self.snapshot
+		if snapshot is None:
+			return
+
+		order, packets, parts = snapshot.order, snapshot.packets, snapshot.encoded
+		if parts is not None:
+			self.patches += 1
+			part = None if packets_owned is None else encode_peer_v2(addr, packets_owned, self.peers_version)
+
+		# O FS_Node continua na mesma posição
+		if current is not None and packets_owned is not None and (packets_owned != -1 or current == -1):
+			if self.positions is None:
+				self.positions = dict(zip(order, range(len(order))))
+			position = self.positions[addr]
+			packets[position] = packets_owned
+			if parts is not None:
+				parts[position] = part
+			return
+
+		with snapshot.lock:
+			cursor = snapshot.cursor
+		if order:
+			self.head = order[cursor]
+
+		if current is not None:
+			position = self.positions[addr] if self.positions is not None else order.index(addr)
+			order = order[:position] + order[position+1:]
+			packets = packets[:position] + packets[position+1:]
+			if parts is not None:
+				parts = parts[:position] + parts[position+1:]
+			if position < cursor:
+				cursor -= 1
+			if cursor >= len(order):
+				cursor = 0
+		if packets_owned is not None:
+			order = order[:cursor] + (addr,) + order[cursor:]
+			packets = packets[:cursor] + [packets_owned] + packets[cursor:]
+			if parts is not None:
+				parts = parts[:cursor] + [part] + parts[cursor:]
+
+		patched = Owners_Snapshot(order, packets)
+		patched.cursor = cursor
+		patched.encoded = parts
+		self.snapshot = patched
+		self.positions = None
+
+
+	"""
+	Função que atualiza partial_counts com os pacotes que mudaram ('changed'), somando 1 aos que passaram a existir em 'added'
+	e subtraindo 1 aos restantes. Com poucos pacotes alterados (o caso das atualizações de um FS_Node) são percorridos os bits
+	a 1 do inteiro; caso contrário, é usada a representação binária em texto, em que a posição de cada carácter é o índice do
+	pacote.
+	"""
+	def _update_counts(self, changed, added):
+		counts = self.partial_counts
+		if changed.bit_count() <= 64:
+			last = self.n_packets - 1
+			while changed:
+				lowest = changed & -changed
+				bit = lowest.bit_length() - 1
+				counts[last - bit] += 1 if added & lowest else -1
+				changed ^= lowest
+			return
+
+		changed_bin = format(changed, f'0{self.n_packets}b')
+		added_bin = format(added, f'0{self.n_packets}b')
+		index = changed_bin.find('1')
+		while index != -1:
+			counts[index] += 1 if added_bin[index] == '1' else -1
+			index = changed_bin.find('1', index + 1)
+
+
+	def _link_first(self, addr):
+		if self.head is None:
+			self.ring[addr] = [addr, addr]
+		else:
+			previous = self.ring[self.head][0]
+			self.ring[addr] = [previous, self.head]
+			self.ring[previous][1] = addr
+			self.ring[self.head][0] = addr
+		self.head = addr
+
+
+	def _unlink(self, addr):
+		previous, following = self.ring.pop(addr)
+		if following == addr:
+			self.head = None
+			return
+		self.ring[previous][1] = following
+		self.ring[following][0] = previous
+		if self.head == addr:
+			self.head = following
+
+
+class Owners_Snapshot():
+
+	"""
+	Estado dos FS_Nodes de um ficheiro num dado momento, construído por File_Owners.get_snapshot: order são os endereços pela
+	ordem da lista circular a partir de head (um tuplo, que nunca é alterado) e packets os pacotes de cada um, pela mesma
+	ordem (-1 caso tenha o ficheiro completo). Podem ser lidos por várias threads sem locks.
+
+	Estrutura encoded = [peer1, peer2, ...]
+	Os FS_Nodes convertidos para a versão 2, pela ordem de order. Uma resposta é a concatenação de um excerto de encoded a
+	partir da posição cursor, pelo que a rotação não obriga a converter os FS_Nodes novamente, e uma escrita apenas converte
+	o FS_Node que alterou (ver File_Owners._patch).
+
+	O estado que muda é cursor, a posição de order enviada em primeiro lugar na próxima resposta, com o lock do snapshot,
+	que apenas é mantido enquanto a rotação avança, a construção de encoded, uma vez, com o lock de escrita do ficheiro, e
+	as posições de packets e encoded de um FS_Node cujos pacotes mudam sem mudar de posição, também com o lock de escrita.
+	"""
+
+	__slots__ = ("order", "packets", "cursor", "encoded", "lock")
+
+	def __init__(self, order, packets):
+		self.order = order
+		self.packets = packets
+		self.cursor = 0
+		self.encoded = None
+		self.lock = threading.Lock()
@@ -3,191 +3,1074 @@ Ficheiro que contem algumas das funções relativas à troca de mensagens entre
 """
 
 import json
+import re
 import socket
+import struct
 import hashlib
+import threading
+import time
+import weakref
+import operator
 import zlib
+from collections import OrderedDict
+from itertools import groupby
 
 
 
+"""
+Versão 2 do protocolo. Na versão 1 cada carácter dos nomes dos ficheiros e dos endereços IP é enviado como 8 bytes
+ASCII '0'/'1', o que torna estes campos 8 vezes maiores e obriga a um ciclo em Python por carácter em cada extremo.
+Na versão 2 as strings são enviadas em UTF-8 precedidas do seu tamanho e os inteiros são empacotados com o módulo struct.
+
+A versão é negociada na primeira troca de mensagens entre o FS_Node e o FS_Tracker: o FS_Node envia, ainda na versão 1,
+um pedido de ficheiro (id_mode==0) com o nome reservado PROTOCOL_PROBE seguido da versão máxima que suporta. Um FS_Tracker
+antigo responde com uma lista vazia (o ficheiro não existe), pelo que o FS_Node continua na versão 1. Um FS_Tracker novo
+responde com uma lista cujo primeiro elemento é a versão aceite e, a partir desse momento, ambos usam essa versão na
+conexão. Entre FS_Nodes, a versão de cada FS_Node é comunicada pelo FS_Tracker na lista de FS_Nodes que possuem um ficheiro,
+logo um FS_Node nunca envia datagramas da versão 2 a um FS_Node antigo.
+
+Formato das tramas TCP na versão 2 -> size_packet (4 bytes) + id_mode (1 byte) + corpo, em que size_packet conta o id_mode
+e o corpo. Nas respostas do FS_Tracker o id_mode é substituído pelo tipo de resposta.
+Formato dos datagramas UDP na versão 2 -> versão (1 byte) + mode (1 byte) + corpo. O primeiro byte de um datagrama da
+versão 1 é sempre 0, o que permite distinguir as duas versões.
+"""
+PROTOCOL_VERSION = 2
+PROTOCOL_PROBE = "\x00FS_PROTOCOL/"
+
+_U8 = struct.Struct('>B')
+_U16 = struct.Struct('>H')
+_U32 = struct.Struct('>I')
+_V1_TCP_HEADER = struct.Struct('>II')
+_V2_TCP_HEADER = struct.Struct('>IB')
+_V2_UDP_HEADER = struct.Struct('>BB')
+
+# Tamanho máximo, em bytes, de cada trama de um anúncio de ficheiros (ver encode_announcement_frames)
+MAX_ANNOUNCEMENT_FRAME = 256 * 1024
+
+# Tamanho, em bytes, de cada pacote de um ficheiro quando este não indica outro (é o único tamanho da versão 1)
+DEFAULT_BLOCK_SIZE = 1024
+
+# MTU usado quando não é configurado nem é possível determinar o MTU do caminho até outro FS_Node e tamanho dos cabeçalhos IPv4 e UDP
+DEFAULT_MTU = 1500
+UDP_IP_OVERHEAD = 28
+
+# Tamanho do buffer de receção dos datagramas da versão 1, que nunca são fragmentados
+V1_DATAGRAM_SIZE = 2000
+
+# Flags de um ficheiro numa mensagem da versão 2 (id_mode==1 e id_mode==3)
+FLAG_FILE_COMPLETE = 0x01
+FLAG_FILE_BLOCK_SIZE = 0x02
+
+# Flags de um FS_Node na resposta do FS_Tracker da versão 2
+FLAG_PEER_INCOMPLETE = 0x01
+FLAG_PEER_V2 = 0x02
+FLAG_PEER_REMOVED = 0x04
+
+# Tipos de resposta do FS_Tracker na versão 2
+REPLY_FILE_OWNERS = 0
+REPLY_FILE_MANIFEST = 1
+REPLY_FILE_RARITY = 2
+REPLY_STATS = 3
+REPLY_BULK_OWNERS = 4
+REPLY_OWNERS_DELTA = 5
+REPLY_OWNERS_RESYNC = 6
+
+# Tamanho, em bytes, da hash SHA-256 de cada pacote no manifesto de um ficheiro
+PIECE_HASH_SIZE = 32
+
+# Codificações de um inteiro que representa os pacotes que um FS_Node possuí (ver _pack_bitmap)
+BITMAP_RAW = 0
+BITMAP_RUNS = 1
+BITMAP_SPARSE = 2
+
+# Codificações do número de FS_Nodes que possuem cada pacote (ver _pack_counts)
+COUNTS_BYTES = 0
+COUNTS_RUNS = 1
+
+# Flags de um pedido de pacotes da versão 2 (mode==0 e mode==2)
+REQUEST_FLAG_COMPRESS = 0x01
+
+# Versão negociada em cada socket TCP, as conexões que não negociaram usam a versão 1
+_connections_version = weakref.WeakKeyDictionary()
+
+
+"""
+Funções que guardam e devolvem a versão do protocolo negociada numa conexão TCP.
+"""
+def set_protocol_version(c, version):
+    _connections_version[c] = version
+
+
+def get_protocol_version(c):
+    return _connections_version.get(c, 1)
+
+
+"""
+Função usada pelo FS_Tracker para verificar se um pedido de ficheiro é na verdade o pedido de negociação da versão do
+protocolo. Devolve a versão máxima suportada pelo FS_Node ou None se for um pedido normal.
+"""
+def parse_protocol_probe(filename):
+    if isinstance(filename, str) and filename.startswith(PROTOCOL_PROBE):
+        version = filename[len(PROTOCOL_PROBE):]
+        if version.isdigit():
+            return int(version)
+    return None
+
+
+"""
+Função usada pelo FS_Node, logo após estabelecer a conexão com o FS_Tracker, para negociar a versão do protocolo. Devolve a
+versão acordada, ficando esta também associada ao socket.
+"""
+def negotiate_protocol_version(c, send_lock):
+    send_lock.acquire()
+    send_message_TCP(c, send_lock, PROTOCOL_PROBE + str(PROTOCOL_VERSION), True, 0)
+    reply = receive_message_TCP(c, False)
+    send_lock.release()
+
+    version = 1
+    if isinstance(reply, list) and len(reply)==1 and 1 <= reply[0] <= PROTOCOL_VERSION:
+        version = reply[0]
+    set_protocol_version(c, version)
+
+    return version
+
+
+"""
+Funções auxiliares da versão 2 que convertem strings e inteiros que representam pacotes para binário e vice-versa. As funções
+de leitura recebem o buffer e a posição onde começa o campo e devolvem o valor lido e a posição seguinte.
+"""
+def _pack_str8(text):
+    data = text.encode('utf-8')
+    return _U8.pack(len(data)) + data
+
+
+def _pack_str16(text):
+    data = text.encode('utf-8')
+    return _U16.pack(len(data)) + data
+
+
+def _pack_bitmap(packets_owned):
+    encoding, data = _encode_bitmap(packets_owned)
+    return _U8.pack(encoding) + _U32.pack(len(data)) + data
+
+
+def _unpack_str8(buffer, offset):
+    size = buffer[offset]
+    offset += 1
+    return str(buffer[offset:offset+size], 'utf-8'), offset + size
+
+
+def _unpack_str16(buffer, offset):
+    size, = _U16.unpack_from(buffer, offset)
+    offset += 2
+    return str(buffer[offset:offset+size], 'utf-8'), offset + size
+
+
+def _unpack_bitmap(buffer, offset):
+    encoding = buffer[offset]
+    size, = _U32.unpack_from(buffer, offset + 1)
+    offset += 5
+    return _decode_bitmap(encoding, buffer[offset:offset+size]), offset + size
+
+
+"""
+Codificações do inteiro que representa os pacotes que um FS_Node possuí. Todas são precedidas da codificação (1 byte) e do
+tamanho dos dados (4 bytes), ficando os dados num dos seguintes formatos:
+
+BITMAP_RAW    -> o inteiro em big-endian, com (bit_length + 7) // 8 bytes
+BITMAP_RUNS   -> n_bits + n_runs + (distância + comprimento) * n_runs, em que cada sequência de bits a 1 é indicada pela
+                 distância desde o fim da sequência anterior e pelo seu comprimento
+BITMAP_SPARSE -> n_bits + n_ones + distância * n_ones, em que cada bit a 1 é indicado pela distância desde o bit anterior
+
+Nas codificações BITMAP_RUNS e BITMAP_SPARSE, n_bits é o número de bits do inteiro em big-endian (um múltiplo de 8), as
+posições são contadas a partir do bit mais significativo e todos os números são varints (7 bits por byte, com o bit mais
+significativo a indicar que o número continua). A codificação é escolhida pela densidade do inteiro: um ficheiro quase
+completo ou quase vazio tem poucas sequências e fica com alguns bytes em vez de um bit por pacote, e os pacotes espalhados
+são enviados pela sua posição. Caso nenhuma seja mais pequena, é usada BITMAP_RAW.
+
+As sequências são procuradas nos bytes do inteiro, saltando os bytes a 0 e juntando os bytes a 0xFF com bytes.find(),
+pelo que só os bytes mistos, que são no máximo tantos quanto as sequências, são percorridos em Python.
+"""
+_BITMAP_BYTE_CLASS = bytes(0 if byte==0x00 else 2 if byte==0xFF else 1 for byte in range(256))
+_BYTE_RUNS = [[(run.start(), run.end()) for run in re.finditer('1+', format(byte, '08b'))] for byte in range(256)]
+
+def _encode_bitmap(packets_owned):
+    raw = packets_owned.to_bytes((packets_owned.bit_length() + 7) // 8, byteorder='big')
+    if len(raw) <= 8:
+        return BITMAP_RAW, raw
+
+    # Estima o tamanho de cada codificação a partir do número de bits a 1 e do número de sequências de bits a 1
+    n_bits = len(raw) * 8
+    ones = packets_owned.bit_count()
+    runs = ((packets_owned ^ (packets_owned >> 1)).bit_count() + 1) // 2
+    runs_size = runs * (_varint_size((n_bits - ones) // runs) + _varint_size(ones // runs))
+    sparse_size = ones * _varint_size(n_bits // ones)
+    if min(runs_size, sparse_size) >= len(raw):
+        return BITMAP_RAW, raw
+
+    data = bytearray(_pack_varint(n_bits))
+    if runs_size <= sparse_size:
+        encoding = BITMAP_RUNS
+        bitmap_runs = _bitmap_runs(raw)
+        data += _pack_varint(len(bitmap_runs))
+        end = 0
+        for start, stop in bitmap_runs:
+            data += _pack_varint(start - end)
+            data += _pack_varint(stop - start)
+            end = stop
+    else:
+        encoding = BITMAP_SPARSE
+        data += _pack_varint(ones)
+        position = -1
+        for start, stop in _bitmap_runs(raw):
+            for bit in range(start, stop):
+                data += _pack_varint(bit - position)
+                position = bit
+
+    if len(data) < len(raw):
+        return encoding, bytes(data)
+    return BITMAP_RAW, raw
+
+
+def _bitmap_runs(raw):
+    classes = raw.translate(_BITMAP_BYTE_CLASS)
+    size = len(raw)
+    runs = []
+    position = 0
+    while position < size:
+        byte_class = classes[position]
+
+        # Salta os bytes a 0 até ao próximo byte misto ou a 0xFF
+        if byte_class==0:
+            position = min((found for found in (classes.find(1, position), classes.find(2, position)) if found!=-1), default=size)
+            continue
+
+        # Uma sequência de bytes a 0xFF termina no próximo byte a 0 ou misto, um byte misto ocupa um byte
+        if byte_class==2:
+            end = min((found for found in (classes.find(0, position), classes.find(1, position)) if found!=-1), default=size)
+            byte_runs = [(0, (end - position) * 8)]
+        else:
+            end = position + 1
+            byte_runs = _BYTE_RUNS[raw[position]]
+
+        base = position * 8
+        for start, stop in byte_runs:
+            if runs and runs[-1][1]==base + start:
+                runs[-1][1] = base + stop
+            else:
+                runs.append([base + start, base + stop])
+        position = end
+    return runs
+
+
+def _decode_bitmap(encoding, data):
+    if encoding==BITMAP_RAW:
+        return int.from_bytes(data, byteorder='big')
+    if encoding!=BITMAP_RUNS and encoding!=BITMAP_SPARSE:
+        raise ValueError(f"Codificação de pacotes desconhecida: {encoding}")
+
+    n_bits, offset = _unpack_varint(data, 0)
+    count, offset = _unpack_varint(data, offset)
+    raw = bytearray(n_bits // 8)
+    position = 0 if encoding==BITMAP_RUNS else -1
+    for _ in range(count):
+        distance, offset = _unpack_varint(data, offset)
+        position += distance
+        if encoding==BITMAP_SPARSE:
+            raw[position >> 3] |= 0x80 >> (position & 7)
+            continue
+
+        length, offset = _unpack_varint(data, offset)
+        end = position + length
+
+        # Preenche os bits do primeiro e do último byte da sequência e os bytes inteiros entre eles
+        while position < end and position & 7:
+            raw[position >> 3] |= 0x80 >> (position & 7)
+            position += 1
+        full_end = end & ~7
+        if position < full_end:
+            raw[position >> 3:full_end >> 3] = b'\xff' * ((full_end - position) >> 3)
+            position = full_end
+        while position < end:
+            raw[position >> 3] |= 0x80 >> (position & 7)
+            position += 1
+
+    return int.from_bytes(raw, byteorder='big')
+
+
+"""
+Funções que convertem a lista com o número de FS_Nodes que possuem cada pacote de um ficheiro (resposta REPLY_FILE_RARITY).
+Quando todos os valores cabem num byte e mudam com frequência, cada valor é enviado num byte (COUNTS_BYTES); caso contrário
+são enviadas as sequências de pacotes com o mesmo valor, como pares de varints (repetições, valor) (COUNTS_RUNS). O número
+de sequências é contado com map() sobre a lista, sem um ciclo em Python por pacote.
+
+Formato -> n_packets (4 bytes) + codificação (1 byte) + valores
+"""
+def _pack_counts(counts):
+    data = bytearray(_U32.pack(len(counts)))
+    runs = sum(map(operator.ne, counts, counts[1:])) + 1 if counts else 0
+    if counts and max(counts) < 256 and 2 * runs >= len(counts):
+        data += _U8.pack(COUNTS_BYTES)
+        data += bytes(counts)
+        return data
+
+    data += _U8.pack(COUNTS_RUNS)
+    for count, run in groupby(counts):
+        data += _pack_varint(len(list(run)))
+        data += _pack_varint(count)
+    return data
+
+
+def _unpack_counts(buffer, offset):
+    n_packets, = _U32.unpack_from(buffer, offset)
+    encoding = buffer[offset + 4]
+    offset += 5
+    if encoding==COUNTS_BYTES:
+        return list(buffer[offset:offset + n_packets]), offset + n_packets
+
+    counts = []
+    while len(counts) < n_packets:
+        run, offset = _unpack_varint(buffer, offset)
+        count, offset = _unpack_varint(buffer, offset)
+        if run==0:
+            break
+        counts += [count] * run
+    return counts, offset
+
+
+def _varint_size(value):
+    return max(1, (value.bit_length() + 6) // 7)
+
+
+def _pack_varint(value):
+    data = bytearray()
+    while value > 0x7F:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    data.append(value)
+    return data
+
+
+def _unpack_varint(buffer, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+"""
+Função que converte uma mensagem para uma trama TCP da versão 2, seguindo os mesmos argumentos que a função send_message_TCP.
+O argumento 'peers_version' é um dicionário com a versão de cada FS_Node e é usado pelo FS_Tracker para informar quem pede um
+ficheiro de quais os FS_Nodes que suportam a versão 2.
+
+id_mode==0 -> size_packet + id_mode + filename_size (2 bytes) + filename
+id_mode==1 -> size_packet + id_mode + (filename_size + filename + n_packets + flags + [packets_Owned]) * n
+id_mode==2 -> size_packet + id_mode + filename_size + filename + packet_index
+id_mode==3 -> size_packet + id_mode + filename_size + filename + flags + [packets_Owned]
+id_mode==4 -> size_packet + id_mode + filename_size + filename + n_hashes + hashes
+id_mode==5 -> size_packet + id_mode + filename_size + filename
+id_mode==6 -> size_packet + id_mode + filename_size + filename
+id_mode==7 -> size_packet + id_mode + filename_size + filename + max_owners (2 bytes) + flags + [packets_Needed]
+id_mode==8 -> size_packet + id_mode
+id_mode==9 -> size_packet + id_mode + max_owners (2 bytes) + (filename_size + filename + flags + [packets_Needed]) * n
+id_mode==10 -> igual ao id_mode==9
+id_mode==11 -> size_packet + id_mode + filename_size + filename
+resposta   -> size_packet + tipo + n_packets + block_size + (flags + ip_size (1 byte) + ip + port (2 bytes) + [packets_Owned]) * n
+manifesto  -> size_packet + tipo + n_hashes + hashes
+raridade   -> size_packet + tipo + n_packets + codificação (1 byte) + número de FS_Nodes de cada pacote
+métricas   -> size_packet + tipo + json_size (4 bytes) + json
+vários     -> size_packet + tipo + (filename_size + filename + reply_size (4 bytes) + [n_packets + block_size + FS_Nodes]) * n
+alterações -> size_packet + tipo + filename_size + filename + (flags + ip_size + ip + port + [packets_Owned]) * n
+resync     -> size_packet + tipo
+
+O id_mode==4 publica no FS_Tracker o manifesto de um ficheiro (a hash SHA-256 de cada pacote, concatenadas) e o id_mode==5
+pede o manifesto de um ficheiro, ao qual o FS_Tracker responde com o tipo REPLY_FILE_MANIFEST (sem hashes caso não o
+conheça). Ambos só existem na versão 2. Nas respostas, o argumento 'id_mode' indica o tipo de resposta, sendo
+REPLY_FILE_OWNERS por omissão.
+
+O id_mode==6 pede o número de FS_Nodes que possuem cada pacote de um ficheiro, ao qual o FS_Tracker responde com o tipo
+REPLY_FILE_RARITY (sem pacotes caso não conheça o ficheiro), codificada pela função _pack_counts.
+
+O id_mode==7 pede, tal como o id_mode==0, os FS_Nodes que possuem um ficheiro, mas no máximo 'max_owners' e apenas os que
+possuem algum dos pacotes em falta (packets_Needed, no mesmo formato de packets_Owned, ou FLAG_FILE_COMPLETE caso faltem
+todos). A mensagem é [filename, max_owners, packets_Needed] e a resposta é do tipo REPLY_FILE_OWNERS.
+
+O id_mode==8 pede o estado das métricas do FS_Tracker (ver Tracker_Metrics), ao qual o FS_Tracker responde com o tipo
+REPLY_STATS, com o estado em JSON. A mensagem é None.
+
+O id_mode==9 pede os FS_Nodes que possuem vários ficheiros numa só trama, com as mesmas regras do id_mode==7 para cada
+ficheiro, ou todos os FS_Nodes (sem filtro, como no id_mode==0) caso max_owners seja 0. A mensagem é
+[max_owners, [[filename, packets_Needed], ...]] e a resposta é do tipo REPLY_BULK_OWNERS, com a resposta de cada ficheiro,
+pela ordem do pedido, sem o cabeçalho (reply_size igual a 0 para os ficheiros que o FS_Tracker não conhece). Como mensagem,
+a resposta é um dicionário com o nome de cada ficheiro como key e a lista da resposta REPLY_FILE_OWNERS como value, ou None
+caso o ficheiro não seja conhecido.
+
+O id_mode==10 é o pedido do id_mode==9 que, além de responder com os FS_Nodes de cada ficheiro, subscreve as alterações dos
+FS_Nodes desses ficheiros: enquanto a subscrição durar, o FS_Tracker envia na mesma conexão, sem pedido, uma trama do tipo
+REPLY_OWNERS_DELTA por cada alteração aplicada, com o estado atual de cada FS_Node que mudou (packets_Owned, ou apenas
+as flags, com FLAG_PEER_INCOMPLETE a 0, caso tenha o ficheiro completo, ou com FLAG_PEER_REMOVED caso tenha deixado de ter
+pacotes do ficheiro). Como é enviado o estado e não a alteração, aplicar a mesma trama duas vezes dá o mesmo resultado. A
+mensagem é [filename, [[(ip, port), packets_Owned], ...]], com packets_Owned igual a None nos FS_Nodes removidos. O
+id_mode==11 termina a subscrição de um ficheiro e não tem resposta. A mensagem é o nome do ficheiro.
+
+Quando um FS_Node não lê as tramas de alterações ao ritmo a que são enviadas, o FS_Tracker descarta as que estão por enviar
+e envia uma única trama do tipo REPLY_OWNERS_RESYNC, sem corpo (a mensagem é None), depois da qual segue as alterações
+seguintes. O FS_Node volta então a pedir os FS_Nodes de todos os ficheiros subscritos (id_mode==10) e substitui a sua
+lista pela resposta, aplicando por cima as alterações recebidas depois da trama REPLY_OWNERS_RESYNC.
+
+No id_mode==1, cada ficheiro pode ter um quarto elemento com o tamanho dos seus pacotes, que só é enviado (flag
+FLAG_FILE_BLOCK_SIZE) quando é diferente de DEFAULT_BLOCK_SIZE. Na resposta, o primeiro elemento da lista pode ser um
+tuplo (n_packets, block_size).
+
+Em que packets_Owned -> codificação (1 byte) + packets_Owned_size + packets_Owned
+
+A trama é construída num bytearray com o espaço do cabeçalho reservado no início, que só é preenchido no fim, quando já
+se conhece o tamanho da trama. Desta forma, o custo é linear no número de ficheiros ou de FS_Nodes da mensagem.
+"""
+def encode_message_TCP_v2(message, mode, id_mode=None, peers_version=None):
+    packet = bytearray(_V2_TCP_HEADER.size)
+    if (mode):
+        if id_mode==0:
+            packet += _pack_str16(message)
+        elif id_mode==1:
+            for file in message:
+                _append_file_v2(packet, *file)
+        elif id_mode==2:
+            packet += _pack_str16(message[0])
+            packet += _U32.pack(message[1])
+        elif id_mode==3:
+            packet += _pack_str16(message[0])
+            if message[1]==-1:
+                packet += _U8.pack(FLAG_FILE_COMPLETE)
+            else:
+                packet += _U8.pack(0)
+                packet += _pack_bitmap(message[1])
+        elif id_mode==4:
+            packet += _pack_str16(message[0])
+            packet += _U32.pack(len(message[1]) // PIECE_HASH_SIZE)
+            packet += message[1]
+        elif id_mode==5 or id_mode==6 or id_mode==11:
+            packet += _pack_str16(message)
+        elif id_mode==7:
+            packet += _pack_str16(message[0])
+            packet += _U16.pack(message[1])
+            if message[2]==-1:
+                packet += _U8.pack(FLAG_FILE_COMPLETE)
+            else:
+                packet += _U8.pack(0)
+                packet += _pack_bitmap(message[2])
+        elif id_mode==9 or id_mode==10:
+            packet += _U16.pack(message[0])
+            for fileName, packets_needed in message[1]:
+                packet += _pack_str16(fileName)
+                if packets_needed==-1:
+                    packet += _U8.pack(FLAG_FILE_COMPLETE)
+                else:
+                    packet += _U8.pack(0)
+                    packet += _pack_bitmap(packets_needed)
+    elif id_mode==REPLY_FILE_MANIFEST:
+        packet += _U32.pack(len(message) // PIECE_HASH_SIZE)
+        packet += message
+    elif id_mode==REPLY_FILE_RARITY:
+        packet += _pack_counts(message)
+    elif id_mode==REPLY_STATS:
+        data = json.dumps(message).encode('utf-8')
+        packet += _U32.pack(len(data))
+        packet += data
+    elif id_mode==REPLY_BULK_OWNERS:
+        for fileName, owners in message.items():
+            body = encode_message_TCP_v2(owners, False, REPLY_FILE_OWNERS, peers_version)[5:] if owners else b''
+            packet += _pack_str16(fileName)
+            packet += _U32.pack(len(body))
+            packet += body
+    elif id_mode==REPLY_OWNERS_RESYNC:
+        pass
+    elif id_mode==REPLY_OWNERS_DELTA:
+        packet += _pack_str16(message[0])
+        for addr, packets_owned in message[1]:
+            if packets_owned is None:
+                packet += _U8.pack(FLAG_PEER_REMOVED) + _pack_str8(addr[0]) + _U16.pack(addr[1])
+            else:
+                packet += encode_peer_v2(addr, packets_owned, peers_version)
+    else:
+        id_mode = REPLY_FILE_OWNERS
+        if len(message):
+            if isinstance(message[0], tuple):
+                packet += struct.pack('>II', *message[0])
+            else:
+                packet += struct.pack('>II', message[0], DEFAULT_BLOCK_SIZE)
+            for info in message[1:]:
+                if not isinstance(info, list):
+                    packet += encode_peer_v2(info, -1, peers_version)
+                else:
+                    packet += encode_peer_v2(info[0], info[1], peers_version)
+
+    _V2_TCP_HEADER.pack_into(packet, 0, len(packet) - 4, id_mode)
+    return packet
+
+
+"""
+Função que converte um FS_Node da resposta do FS_Tracker da versão 2 (flags + ip_size + ip + port + [packets_Owned]), com
+'packets_owned' igual a -1 caso o FS_Node tenha o ficheiro completo. Como cada FS_Node é convertido independentemente dos
+restantes, o FS_Tracker pode guardar os FS_Nodes já convertidos e construir as respostas apenas juntando-os com
+encode_owners_reply_v2.
+"""
+def encode_peer_v2(addr, packets_owned, peers_version=None):
+    flags = 0 if packets_owned==-1 else FLAG_PEER_INCOMPLETE
+    if peers_version is not None and peers_version.get(addr, 1) >= 2:
+        flags |= FLAG_PEER_V2
+    packet = _U8.pack(flags) + _pack_str8(addr[0]) + _U16.pack(addr[1])
+    if packets_owned!=-1:
+        packet += _pack_bitmap(packets_owned)
+    return packet
+
+
+def encode_owners_reply_v2(n_packets, block_size, peers):
+    return _V2_TCP_HEADER.pack(len(peers) + 9, REPLY_FILE_OWNERS) + struct.pack('>II', n_packets, block_size) + peers
+
+
+"""
+Funções que constroem e dividem a resposta REPLY_BULK_OWNERS a partir das respostas de cada ficheiro já convertidas, sem
+converter os FS_Nodes: 'replies' é uma lista de pares (filename, resposta), em que a resposta é uma trama REPLY_FILE_OWNERS
+sem os 5 bytes do cabeçalho, ou None caso o ficheiro não seja conhecido. split_bulk_owners_reply_v2 recebe a trama sem o
+campo size_packet e devolve a lista de pares pela mesma ordem.
+"""
+def encode_bulk_owners_reply_v2(replies):
+    packet = bytearray(_V2_TCP_HEADER.size)
+    for fileName, reply in replies:
+        packet += _pack_str16(fileName)
+        packet += _U32.pack(len(reply) if reply else 0)
+        if reply:
+            packet += reply
+    _V2_TCP_HEADER.pack_into(packet, 0, len(packet) - 4, REPLY_BULK_OWNERS)
+    return packet
+
+
+def split_bulk_owners_reply_v2(frame):
+    replies = []
+    offset = 1
+    while offset < len(frame):
+        fileName, offset = _unpack_str16(frame, offset)
+        size, = _U32.unpack_from(frame, offset)
+        offset += 4
+        replies.append((fileName, bytes(frame[offset:offset + size]) if size else None))
+        offset += size
+    return replies
+
+
+def _append_file_v2(packet, fileName, n_packets, packets_owned, block_size=DEFAULT_BLOCK_SIZE):
+    packet += _pack_str16(fileName)
+    packet += _U32.pack(n_packets)
+    flags = FLAG_FILE_COMPLETE if packets_owned==-1 else 0
+    if block_size!=DEFAULT_BLOCK_SIZE:
+        flags |= FLAG_FILE_BLOCK_SIZE
+    packet += _U8.pack(flags)
+    if block_size!=DEFAULT_BLOCK_SIZE:
+        packet += _U32.pack(block_size)
+    if packets_owned!=-1:
+        packet += _pack_bitmap(packets_owned)
+
+
+"""
+Função que converte o conteúdo de uma trama TCP da versão 2 (sem o campo size_packet) para os tipos de dados correspondentes,
+devolvendo o mesmo que a função receive_message_TCP. Na resposta do FS_Tracker, o primeiro elemento é o tuplo
+(n_packets, block_size) e cada FS_Node é devolvido no formato [(ip, port), packets_Owned, versão], sendo packets_Owned
+igual a -1 quando o FS_Node tem o ficheiro completo. A resposta com o manifesto de um ficheiro é devolvida como bytes
+com as hashes concatenadas, a resposta com a raridade dos pacotes como uma lista com o número de FS_Nodes que possuem
+cada pacote, pela ordem dos pacotes, a resposta com as métricas como um dicionário, a resposta com vários ficheiros como
+um dicionário com a resposta de cada ficheiro e as alterações de uma subscrição como [filename, FS_Nodes], com cada FS_Node
+no formato [(ip, port), packets_Owned, versão] e packets_Owned igual a None caso o FS_Node tenha sido removido.
+"""
+def decode_message_TCP_v2(frame, mode):
+    id_mode = frame[0]
+    offset = 1
+    end = len(frame)
+
+    message = None
+    if (mode):
+        if id_mode==0:
+            message, offset = _unpack_str16(frame, offset)
+        elif id_mode==1:
+            message = []
+            while offset < end:
+                filename, offset = _unpack_str16(frame, offset)
+                n_packets, = _U32.unpack_from(frame, offset)
+                flags = frame[offset+4]
+                offset += 5
+                entry = [filename, n_packets, -1]
+                if flags & FLAG_FILE_BLOCK_SIZE:
+                    entry.append(_U32.unpack_from(frame, offset)[0])
+                    offset += 4
+                if not flags & FLAG_FILE_COMPLETE:
+                    entry[2], offset = _unpack_bitmap(frame, offset)
+                message.append(entry)
+        elif id_mode==2:
+            filename, offset = _unpack_str16(frame, offset)
+            packet_index, = _U32.unpack_from(frame, offset)
+            message = [filename, packet_index]
+        elif id_mode==3:
+            filename, offset = _unpack_str16(frame, offset)
+            flags = frame[offset]
+            offset += 1
+            if flags & FLAG_FILE_COMPLETE:
+                message = [filename, -1]
+            else:
+                packets_owned, offset = _unpack_bitmap(frame, offset)
+                message = [filename, packets_owned]
+        elif id_mode==4:
+            filename, offset = _unpack_str16(frame, offset)
+            n_hashes, = _U32.unpack_from(frame, offset)
+            offset += 4
+            message = [filename, bytes(frame[offset:offset + n_hashes * PIECE_HASH_SIZE])]
+        elif id_mode==5 or id_mode==6 or id_mode==11:
+            message, offset = _unpack_str16(frame, offset)
+        elif id_mode==7:
+            filename, offset = _unpack_str16(frame, offset)
+            max_owners, = _U16.unpack_from(frame, offset)
+            flags = frame[offset+2]
+            offset += 3
+            if flags & FLAG_FILE_COMPLETE:
+                message = [filename, max_owners, -1]
+            else:
+                packets_needed, offset = _unpack_bitmap(frame, offset)
+                message = [filename, max_owners, packets_needed]
+        elif id_mode==9 or id_mode==10:
+            max_owners, = _U16.unpack_from(frame, offset)
+            offset += 2
+            files = []
+            while offset < end:
+                filename, offset = _unpack_str16(frame, offset)
+                flags = frame[offset]
+                offset += 1
+                packets_needed = -1
+                if not flags & FLAG_FILE_COMPLETE:
+                    packets_needed, offset = _unpack_bitmap(frame, offset)
+                files.append([filename, packets_needed])
+            message = [max_owners, files]
+        return (id_mode, message)
+
+    if id_mode==REPLY_FILE_MANIFEST:
+        n_hashes, = _U32.unpack_from(frame, offset)
+        return bytes(frame[offset + 4:offset + 4 + n_hashes * PIECE_HASH_SIZE])
+
+    if id_mode==REPLY_FILE_RARITY:
+        message, offset = _unpack_counts(frame, offset)
+        return message
+
+    if id_mode==REPLY_OWNERS_RESYNC:
+        return None
+
+    if id_mode==REPLY_STATS:
+        size, = _U32.unpack_from(frame, offset)
+        return json.loads(str(frame[offset + 4:offset + 4 + size], 'utf-8'))
+
+    if id_mode==REPLY_BULK_OWNERS:
+        message = {}
+        while offset < end:
+            filename, offset = _unpack_str16(frame, offset)
+            size, = _U32.unpack_from(frame, offset)
+            offset += 4
+            message[filename] = _decode_owners_v2(frame, offset, offset + size) if size else None
+            offset += size
+        return message
+
+    if id_mode==REPLY_OWNERS_DELTA:
+        filename, offset = _unpack_str16(frame, offset)
+        peers = []
+        while offset < end:
+            flags = frame[offset]
+            ip, offset = _unpack_str8(frame, offset + 1)
+            port, = _U16.unpack_from(frame, offset)
+            offset += 2
+            packets_owned = None if flags & FLAG_PEER_REMOVED else -1
+            if flags & FLAG_PEER_INCOMPLETE:
+                packets_owned, offset = _unpack_bitmap(frame, offset)
+            peers.append([(ip, port), packets_owned, 2 if flags & FLAG_PEER_V2 else 1])
+        return [filename, peers]
+
+    if offset < end:
+        message = _decode_owners_v2(frame, offset, end)
+
+    return message
+
+
+def _decode_owners_v2(frame, offset, end):
+    message = [struct.unpack_from('>II', frame, offset)]
+    offset += 8
+    while offset < end:
+        flags = frame[offset]
+        ip, offset = _unpack_str8(frame, offset + 1)
+        port, = _U16.unpack_from(frame, offset)
+        offset += 2
+        packets_owned = -1
+        if flags & FLAG_PEER_INCOMPLETE:
+            packets_owned, offset = _unpack_bitmap(frame, offset)
+        message.append([(ip, port), packets_owned, 2 if flags & FLAG_PEER_V2 else 1])
+    return message
+
+
+"""
+Classe que lê as tramas TCP de um socket para um buffer reutilizável. Em vez de fazer um recv() por cada campo da
+mensagem, o leitor faz recv_into() para o espaço livre do buffer, lendo de uma só vez tudo o que já estiver no socket
+buffer, e os campos são depois lidos a partir de memoryviews do buffer sem serem copiados. Desta forma, uma trama custa
+uma ou duas chamadas ao sistema em vez de uma por campo e uma leitura incompleta nunca desalinha a stream, pois o leitor
+só devolve um campo quando tem todos os seus bytes.
+
+Os bytes que já foram lidos do socket mas que pertencem à trama seguinte ficam guardados no buffer, por isso todas as
+leituras de um socket têm de passar pelo mesmo leitor (ver get_frame_reader). As memoryviews devolvidas apenas são válidas
+até à leitura seguinte.
+"""
+class Frame_Reader():
+
+    DEFAULT_SIZE = 64 * 1024
+
+    def __init__(self, c, size=DEFAULT_SIZE):
+        self.c = c
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    """
+    Assegura que existem pelo menos 'size' bytes por ler no buffer, devolvendo False caso a conexão seja fechada antes.
+    Quando o espaço livre no fim do buffer não chega, os bytes por ler são movidos para o início e, se a trama for maior
+    que o buffer, este é substituído por um maior.
+    """
+    def fill(self, size):
+        pending = self.end - self.start
+        if pending >= size:
+            return True
+
+        if self.start + size > len(self.buffer):
+            if size > len(self.buffer):
+                buffer = bytearray(max(size, 2 * len(self.buffer)))
+                buffer[:pending] = self.view[self.start:self.end]
+                self.buffer = buffer
+                self.view = memoryview(buffer)
+            else:
+                self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = pending
+
+        while self.end - self.start < size:
+            received = self.c.recv_into(self.view[self.end:])
+            if not received:
+                return False
+            self.end += received
+        return True
+
+    """
+    Devolve uma memoryview com os próximos 'size' bytes da stream ou None caso a conexão seja fechada.
+    """
+    def read(self, size):
+        if not self.fill(size):
+            return None
+        data = self.view[self.start:self.start+size]
+        self.start += size
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > 16 * self.DEFAULT_SIZE:
+                self.buffer = bytearray(self.DEFAULT_SIZE)
+                self.view = memoryview(self.buffer)
+        return data
+
+    """
+    Devolve o inteiro big-endian formado pelos próximos 'size' bytes da stream ou None caso a conexão seja fechada.
+    """
+    def read_int(self, size):
+        data = self.read(size)
+        if data is None:
+            return None
+        return int.from_bytes(data, byteorder='big')
+
+
+# Leitor associado a cada socket TCP
+_connections_reader = weakref.WeakKeyDictionary()
+
+
+"""
+Função que devolve o leitor de tramas associado a um socket, criando-o na primeira leitura.
+"""
+def get_frame_reader(c):
+    reader = _connections_reader.get(c)
+    if reader is None:
+        reader = Frame_Reader(c)
+        _connections_reader[c] = reader
+    return reader
+
+
+"""
+Função auxiliar da versão 1 que converte um campo de texto em que cada carácter ocupa 8 bytes ASCII '0'/'1'.
+"""
+def _decode_bits_text(data):
+    if not len(data):
+        return ''
+    return int(bytes(data), 2).to_bytes(len(data) // 8, byteorder='big').decode('latin-1')
+
+
+"""
+Função que converte o conteúdo de uma trama TCP da versão 1 enviada por um FS_Node (sem o campo size_packet), devolvendo
+um tuplo com o identificador do pedido e os dados, tal como a função receive_message_TCP.
+"""
+def decode_message_TCP_v1(frame):
+    id_mode = int.from_bytes(frame[:4], byteorder='big')
+    end = len(frame)
+
+    message = None
+    if id_mode==0:
+        # formato packet -> size_packet + mode + filename
+        message = _decode_bits_text(frame[4:])
+
+    elif id_mode==1:
+        # formato packet -> size_packet + mode + filename_size + filename + n_packets + packets_Owned + filename_size + filename + n_packets + packets_Owned + ...
+        message = []
+        offset = 4
+        while offset < end:
+            filename_size = int.from_bytes(frame[offset:offset+4], byteorder='big')
+            offset += 4
+            filename = _decode_bits_text(frame[offset:offset+filename_size])
+            offset += filename_size
+
+            # Número de pacotes que compõem o ficheiro e byte que identifica se o FS_Node tem o ficheiro completo ou não
+            n_packets = int.from_bytes(frame[offset:offset+4], byteorder='big')
+            byte_id = frame[offset+4]
+            offset += 5
+
+            if byte_id==1:
+                message.append([filename, n_packets, -1])
+            else:
+                # Número de bytes do inteiro que representa os pacotes que o FS_Node possuí do ficheiro, seguido do inteiro
+                num_bytes_packets_owned = int.from_bytes(frame[offset:offset+4], byteorder='big')
+                offset += 4
+                packets_owned = int.from_bytes(frame[offset:offset+num_bytes_packets_owned], byteorder='big')
+                offset += num_bytes_packets_owned
+                message.append([filename, n_packets, packets_owned])
+
+    elif id_mode==2 or id_mode==3:
+        # formato packet -> size_packet + mode + filename + packet_index
+        filename = _decode_bits_text(frame[4:end-4])
+        packet_index = int.from_bytes(frame[end-4:], byteorder='big')
+        message = [filename, packet_index]
+
+    return (id_mode, message)
+
+
+"""
+Função que lê a resposta do FS_Tracker da versão 1 a partir do leitor de tramas. Nesta versão o campo size_packet da
+resposta conta apenas 5 bytes por cada FS_Node, em vez dos 9 que realmente ocupam os campos fixos, pelo que não é possível
+ler a trama toda de uma vez. Os campos são lidos um a um, mas a partir do buffer do leitor, o que continua a evitar uma
+chamada ao sistema por campo.
+"""
+def _receive_reply_TCP_v1(reader, size_packet):
+
+    # Recebe o número de pacotes que compõem o ficheiro
+    n_packets = reader.read_int(4)
+    if n_packets is None:
+        return -1
+
+    size_packet -= 4 # n_packets = 4
+    message = [n_packets]
+    while size_packet > 0:
+
+        # Recebe o byte que identifica se o que vem a seguir é do tipo (193.0.1.2, 9090) ou [(172.0.1, 9090), 61253] e o número de bytes do endereço IP
+        byte_id = reader.read_int(1)
+        ip_size = reader.read_int(4)
+        if ip_size is None:
+            return -1
+
+        # Recebe o endereço IP
+        ip_bin = reader.read(ip_size)
+        if ip_bin is None:
+            return -1
+        ip = _decode_bits_text(ip_bin)
+
+        # Recebe a porta
+        port = reader.read_int(4)
+        if port is None:
+            return -1
+
+        if byte_id==0:
+            message.append((ip, port))
+            size_packet = size_packet - ip_size - 5
+        elif byte_id==1:
+
+            # Recebe o número que identifica quantos bytes ocupa o inteiro que vem a seguir (inteiro que representa os pacotes que o FS_Node possuí do ficheiro)
+            num_bytes_packets_owned = reader.read_int(4)
+            if num_bytes_packets_owned is None:
+                return -1
+
+            # Recebe o inteiro que representa os pacotes que o FS_Node possuí do ficheiro
+            packets_owned = reader.read_int(num_bytes_packets_owned)
+            if packets_owned is None:
+                return -1
+
+            message.append([(ip, port), packets_owned])
+            size_packet = size_packet - ip_size - num_bytes_packets_owned - 9
+
+    return message
+
+
 """
 Função responsável por receber e traduzir mensagens, sendo também responsável por verificar se o FS_Node ou FS_Tracker
 não fecharam a conexão quer durante a transmissão de uma mensagem ou quando não estão a transmitir. Importante referir
 que o argumento 'mode' refere-se ao tipo de mensagem que esperamos receber. Este é igual a 0 nos casos em que não
 estamos à espera de receber um pedido, por exemplo, quando o FS_Node recebe do FS_Tracker a resposta de um pedido de "get fileX".
 
-O loop assegura que lemos a mensagem toda do socket buffer, caso esta ainda não esteja toda no buffer e a thread já
-esteja a tentar ler.
+A leitura é feita através do leitor de tramas associado ao socket, que assegura que lemos a mensagem toda do socket buffer,
+caso esta ainda não esteja toda no buffer e a thread já esteja a tentar ler. As mensagens dos FS_Nodes e as respostas da
+versão 2 são lidas de uma só vez com o tamanho indicado no campo size_packet e só depois convertidas.
 
 Caso a máquina que está a enviar os dados feche a conexão em qualquer momento, a função devolve -1, caso contrário, se
 o argumento 'mode' estiver a False devolve os dados sem especificar o tipo de pedido, já se estiver a True, devolve um tuplo
 de dois elementos, sendo o primeiro elemento o inteiro identificador do pedido e o segundo os dados.
 
 Importante salientar que caso a mensagem contenha o campo 'mode' este não é contabilizado para o tamanho da mensagem.
+
+A função receive_frame_TCP lê uma trama completa sem a converter (sem o campo size_packet), devolvendo None caso a conexão
+seja fechada. É usada pelo FS_Tracker, que precisa do tamanho de cada trama para as métricas. A memoryview devolvida apenas
+é válida até à leitura seguinte do socket.
 """
+def receive_frame_TCP(c):
+    reader = get_frame_reader(c)
+    size_packet = reader.read_int(4)
+    if size_packet is None:
+        return None
+    return reader.read(size_packet)
+
+
 def receive_message_TCP(c, mode):
-    size_packet_bin = c.recv(4)
-    if not size_packet_bin:
+    reader = get_frame_reader(c)
+
+    size_packet = reader.read_int(4)
+    if size_packet is None:
         return -1
-    size_packet = int.from_bytes(size_packet_bin, byteorder='big')
 
-    message = None
+    if get_protocol_version(c) >= 2:
+        frame = reader.read(size_packet)
+        if frame is None:
+            return -1
+        return decode_message_TCP_v2(frame, mode)
+
     if (mode):
-        id_mode_bytes = c.recv(4)
-        if not id_mode_bytes:
+        frame = reader.read(size_packet)
+        if frame is None:
             return -1
-        id_mode = int.from_bytes(id_mode_bytes, byteorder='big')
+        return decode_message_TCP_v1(frame)
 
-        if id_mode==0:
-            # formato packet -> size_packet + mode + filename
+    if (size_packet>0):
+        return _receive_reply_TCP_v1(reader, size_packet)
 
-            # Recebe o nome do ficheiro
-            filename_bin = b''
-            size_filename = size_packet - 4
-            while len(filename_bin) < size_filename:
-                data = c.recv(size_filename - len(filename_bin))
-                if not data:
-                    return -1
-                filename_bin += data
-            
-            filename_chunks = [filename_bin[i:i+8] for i in range(0, len(filename_bin), 8)]
-            filename = ''.join(chr(int(chunk, 2)) for chunk in filename_chunks)
+    return None
 
-            message = filename
 
-        if id_mode==1:
-            # formato packet -> size_packet + mode + filename_size + filename + n_packets + packets_Owned + filename_size + filename + n_packets + packets_Owned + ...
+"""
+Função auxiliar da versão 1 que converte texto para binário, ocupando cada carácter 8 bytes ASCII '0'/'1'.
+"""
+def _encode_bits_text(text):
+    return ''.join([format(ord(char), '08b') for char in text]).encode('utf-8')
 
-            message = []
-            while size_packet-4 > 0: # -4 por causa do campo mode do cabeçalho
-
-                # Recebe o número de bytes do nome do ficheiro
-                filename_size_bin = c.recv(4)
-                if not filename_size_bin:
-                    return -1
-                filename_size = int.from_bytes(filename_size_bin, byteorder='big')
-            
-                # Recebe o nome do ficheiro
-                filename_bin = b''
-                while len(filename_bin) < filename_size:
-                    data = c.recv(filename_size - len(filename_bin))
-                    if not data:
-                        return -1
-                    filename_bin += data
-                
-                filename_chunks = [filename_bin[i:i+8] for i in range(0, len(filename_bin), 8)]
-                filename = ''.join(chr(int(chunk, 2)) for chunk in filename_chunks)
-
-                # Recebe o número de pacotes que compõem o ficheiro
-                n_packets_bin = c.recv(4)
-                if not n_packets_bin:
-                    return -1
-                n_packets = int.from_bytes(n_packets_bin, byteorder='big')
-
-                # Recebe o byte que identifica se o FS_Node tem o ficheiro completo ou não
-                byte_id_bin = c.recv(1)
-                byte_id = int.from_bytes(byte_id_bin, byteorder='big')
-
-                if byte_id==1:
-                    message.append([filename, n_packets, -1])
-                    size_packet = size_packet - filename_size - 9
-                elif byte_id==0:
-
-                    # Recebe o número que identifica quantos bytes ocupa o inteiro que vem a seguir (inteiro que representa os pacotes que o FS_Node possuí do ficheiro)
-                    num_bytes_packets_owned_bin = c.recv(4)
-                    num_bytes_packets_owned = int.from_bytes(num_bytes_packets_owned_bin, byteorder='big')
-
-                    # Recebe o inteiro que representa os pacotes que o FS_Node possuí do ficheiro
-                    packets_owned_bin = c.recv(num_bytes_packets_owned)
-                    packets_owned = int.from_bytes(packets_owned_bin, byteorder='big')
-
-                    message.append([filename, n_packets, packets_owned])
-                    size_packet = size_packet - filename_size - num_bytes_packets_owned - 13
-
-        if id_mode==2 or id_mode==3:
+
+"""
+Função que converte uma mensagem para uma trama TCP da versão 1, seguindo os mesmos argumentos que a função send_message_TCP.
+Tal como na versão 2, a trama é construída num bytearray, com o espaço do campo size_packet (e do campo mode) reservado no
+início e preenchido no fim, em vez de concatenar bytes imutáveis, o que tornava o custo quadrático no número de ficheiros ou
+de FS_Nodes.
+"""
+def encode_message_TCP_v1(message, mode, id_mode=None):
+    if (mode):
+        packet = bytearray(_V1_TCP_HEADER.size)
+
+        if id_mode==0:
+            # Usado quando o FS_Node quer perguntar ao FS_Tracker quem tem determinado ficheiro
+            # argumento message -> filename
+            # formato packet -> size_packet + mode + filename
+            packet += _encode_bits_text(message)
+
+        elif id_mode==1:
+            # Usado para informar o FS_Tracker dos ficheiros iniciais que o FS_Node tem
+            # argumento message -> ([fileName, n_packets, packets_Owned], [fileName, n_packets, packets_owned], ...)
+            # formato packet -> size_packet + mode + filename_size + filename + n_packets + packets_Owned + filename_size + filename + n_packets + packets_Owned + ...
+            # packets_Owned: Este campo é composto por campos diferentes dependendo se o ficheiro está completo ou incompleto
+            # ficheiro completo: Apenas um campo, file_completed_byte que ocupa 1 byte
+            # ficheiro incompleto: 3 campos, file_completed_byte + packets_Owned_size + packets_Owned
+            for file in message:
+                _append_file_v1(packet, *file)
+
+        elif id_mode==2 or id_mode==3:
+            # Usado para informar o FS_Tracker de alterações relativas a um ficheiro
+            # argumento message -> (fileName, packet_index)
             # formato packet -> size_packet + mode + filename + packet_index
+            packet += _encode_bits_text(message[0])
+            packet += message[1].to_bytes(4, byteorder='big')
+
+        _V1_TCP_HEADER.pack_into(packet, 0, len(packet) - 4, id_mode)
+        return packet
+
+    # Usado pelo FS_Tracker para informar o FS_Node quais os FS_Nodes que têm o ficheiro que ele pediu
+    # argumento message -> [size_file, (172.0.1, 9090), (193.0.2, 10001), [(172.0.4, 20010), 61253], (193.0.1.3, 9090), [(172.0.1.3, 9090), 5723], ...]
+    # formato packet -> size_packet + size_file + byte_identificador + info + byte_identificador + info + ...
+    # byte_identificador: determina se o campo seguinte é do tipo (193.0.1.2, 9090) ou [(172.0.1, 9090), 61253]
+    # info: está associado ao byte_identificador e pode ser (193.0.1.2, 10015) ou [(172.0.1, 20017), 61253]
+    # Se for do tipo [(172.0.1, 20017), 61253] o info incluí ainda um campo packets_Owned_size e packets_Owned
+    packet = bytearray(4)
+    if len(message):
+        size_packet = 4 # n_packets = 4
+        packet += _U32.pack(message[0])
+        for info in message[1:]:
+            if not isinstance(info, list):
+                ip, port = info
+
+                # Insere um identificador a 0 a informar que não é uma lista
+                ip_bin = _encode_bits_text(ip)
+                size_packet += len(ip_bin) + 5 # identificador + port = 5
+                packet += b'\x00'
+                packet += _U32.pack(len(ip_bin))
+                packet += ip_bin
+                packet += _U32.pack(port)
+            else:
+                (ip, port), packets_owned = info
 
-            # Recebe o nome do ficheiro
-            filename_bin = b''
-            size_filename = size_packet - 8
-            while len(filename_bin) < size_filename:
-                data = c.recv(size_filename - len(filename_bin))
-                if not data:
-                    return -1
-                filename_bin += data
-            
-            filename_chunks = [filename_bin[i:i+8] for i in range(0, len(filename_bin), 8)]
-            filename = ''.join(chr(int(chunk, 2)) for chunk in filename_chunks)
+                # Insere um identificador a 1 a informar que é uma lista de dois elementos
+                ip_bin = _encode_bits_text(ip)
 
-            # Recebe o indíce do pacote (mode==2) ou os pacotes que o FS_Node tem (mode==3)
-            packet_index_bin = c.recv(4)
-            if not packet_index_bin:
-                return -1
-            packet_index = int.from_bytes(packet_index_bin, byteorder='big')
+                # Calcula quantos bytes ocupa o inteiro que representa os pacotes que o FS_Node possuí
+                num_bytes_packets_owned = (packets_owned.bit_length() + 7) // 8
 
-            message = [filename, packet_index]
-    
-    else:
+                size_packet += len(ip_bin) + num_bytes_packets_owned + 9 # identificador + port + num_bytes_packets_owned = 9
+                packet += b'\x01'
+                packet += _U32.pack(len(ip_bin))
+                packet += ip_bin
+                packet += _U32.pack(port)
+                packet += _U32.pack(num_bytes_packets_owned)
+                packet += packets_owned.to_bytes(num_bytes_packets_owned, byteorder='big')
 
-        if (size_packet>0):
-            # formato packet -> size_packet + size_file + byte_identificador + info + byte_identificador + info + ...
+        # O campo size_packet mantém a contagem da versão 1 (ver _receive_reply_TCP_v1)
+        _U32.pack_into(packet, 0, size_packet)
 
-            # Recebe o número de pacotes que compõem o ficheiro
-            n_packets_bin = c.recv(4)
-            if not n_packets_bin:
-                return -1
-            n_packets = int.from_bytes(n_packets_bin, byteorder='big')
-
-            size_packet -= 4 # n_packets = 4
-            message = [n_packets]
-            while size_packet > 0:
-
-                # Recebe o byte que identifica se o que vem a seguir é do tipo (193.0.1.2, 9090) ou [(172.0.1, 9090), 61253]
-                byte_id_bin = c.recv(1)
-                byte_id = int.from_bytes(byte_id_bin, byteorder='big')
-
-                # Recebe o número de bytes do endereço IP
-                ip_size_bin = c.recv(4)
-                if not ip_size_bin:
-                    return -1
-                ip_size = int.from_bytes(ip_size_bin, byteorder='big')
-            
-                # Recebe o nome do ficheiro
-                ip_bin = b''
-                while len(ip_bin) < ip_size:
-                    data = c.recv(ip_size - len(ip_bin))
-                    if not data:
-                        return -1
-                    ip_bin += data
-                
-                ip_chunks = [ip_bin[i:i+8] for i in range(0, len(ip_bin), 8)]
-                ip = ''.join(chr(int(chunk, 2)) for chunk in ip_chunks)
-            
-                # Recebe a porta
-                port_bin = c.recv(4)
-                if not port_bin:
-                    return -1
-                port = int.from_bytes(port_bin, byteorder='big')
-
-                if byte_id==0:
-                    message.append((ip, port))
-                    size_packet = size_packet - ip_size - 5
-                elif byte_id==1:
-                    
-                    # Recebe o número que identifica quantos bytes ocupa o inteiro que vem a seguir (inteiro que representa os pacotes que o FS_Node possuí do ficheiro)
-                    num_bytes_packets_owned_bin = c.recv(4)
-                    num_bytes_packets_owned = int.from_bytes(num_bytes_packets_owned_bin, byteorder='big')
-
-                    # Recebe o inteiro que representa os pacotes que o FS_Node possuí do ficheiro
-                    packets_owned_bin = c.recv(num_bytes_packets_owned)
-                    packets_owned = int.from_bytes(packets_owned_bin, byteorder='big')
-
-                    message.append([(ip, port), packets_owned])
-                    size_packet = size_packet - ip_size - num_bytes_packets_owned - 9
+    return packet
 
-    if (mode):
-        message = (id_mode, message)
 
-    return message
+def _append_file_v1(packet, fileName, n_packets, packets_owned, block_size=DEFAULT_BLOCK_SIZE):
+    filename_bin = _encode_bits_text(fileName)
+    packet += _U32.pack(len(filename_bin))
+    packet += filename_bin
+    packet += _U32.pack(n_packets)
+
+    # Insere um identificador a 1 a informar que o ficheiro está completo
+    if packets_owned==-1:
+        packet += b'\x01'
+
+    # Insere um identificador a 0 a informar que o ficheiro está incompleto
+    else:
+        num_bytes_packets_owned = (packets_owned.bit_length() + 7) // 8
+        packet += b'\x00'
+        packet += _U32.pack(num_bytes_packets_owned)
+        packet += packets_owned.to_bytes(num_bytes_packets_owned, byteorder='big')
 
 
 """
@@ -199,140 +1082,99 @@ e 1 caso pretenda repurtar uma alteração relativamente aos ficheiros que possu
 Importante salientar que caso a mensagem contenha o campo 'mode' este não é contabilizado para o tamanho da mensagem.
 
 Se a conexão for fechada a meio do envio de dados, a função fecha o socket do lado de quem está a tentar enviar os dados.
+
+O argumento 'peers_version' apenas é usado pelo FS_Tracker nas conexões que negociaram a versão 2 (ver encode_message_TCP_v2).
+"""
+def send_message_TCP(c, send_lock, message, mode, id_mode=None, peers_version=None):
+
+    # Converte a mensagem de acordo com a versão negociada na conexão
+    packet = encode_message_TCP(message, mode, id_mode, peers_version, get_protocol_version(c))
+
+    # Enviar a mensagem
+    send_frame_TCP(c, send_lock, packet)
+
+
+"""
+Função que envia uma trama TCP já convertida, por exemplo, uma resposta construída pelo FS_Tracker a partir de FS_Nodes já
+convertidos. Tal como em send_message_TCP, se a conexão for fechada a meio do envio o socket é fechado.
 """
-def send_message_TCP(c, send_lock, message, mode, id_mode=None):
+def send_frame_TCP(c, send_lock, packet):
     try:
+        with send_lock:
+            c.sendall(packet)
+    except socket.error:
+        c.close()
 
-        # Verifica se a mensagem terá identificador
-        packet = None
-        if (mode):
-            mode_bin = id_mode.to_bytes(4, byteorder='big')
-            # c.sendall(length_bytes + mode_bytes + json_message)
-
-            if id_mode==0:
-                # Usado quando o FS_Node quer perguntar ao FS_Tracker quem tem determinado ficheiro
-                # argumento message -> filename
-                # formato packet -> size_packet + mode + filename
-
-                size_packet = 4 # size_mode = 4
-                filename_bin = b''.join(format(ord(char), '08b').encode('utf-8') for char in message)
-                size_packet += len(filename_bin)
-                size_packet_bin = size_packet.to_bytes(4, byteorder='big')
-                packet = size_packet_bin + mode_bin + filename_bin
-
-            if id_mode==1:
-                # Usado para informar o FS_Tracker dos ficheiros iniciais que o FS_Node tem
-                # argumento message -> ([fileName, n_packets, packets_Owned], [fileName, n_packets, packets_owned], ...)
-                # formato packet -> size_packet + mode + filename_size + filename + n_packets + packets_Owned + filename_size + filename + n_packets + packets_Owned + ...
-                # packets_Owned: Este campo é composto por campos diferentes dependendo se o ficheiro está completo ou incompleto
-                # ficheiro completo: Apenas um campo, file_completed_byte que ocupa 1 byte
-                # ficheiro incompleto: 3 campos, file_completed_byte + packets_Owned_size + packets_Owned
-
-
-                byte_id_notCompleted = 0
-                byte_id_Completed = 1
-                byte_id_notCompleted_bin = byte_id_notCompleted.to_bytes(1, byteorder='big')
-                byte_id_Completed_bin = byte_id_Completed.to_bytes(1, byteorder='big')
-
-                size_packet = 4 # size_mode = 4
-                packet = b''
-                for fileName, n_packets, packets_owned in message:
-                    filename_bin = b''.join(format(ord(char), '08b').encode('utf-8') for char in fileName)
-                    filename_size = len(filename_bin)
-                    filename_size_bin = filename_size.to_bytes(4, byteorder='big')
-                    n_packets_bin = n_packets.to_bytes(4, byteorder='big')
-
-
-                    # Insere um identificador a 1 a informar que o ficheiro está completo
-                    if packets_owned==-1:
-                        size_packet += filename_size + 9 # filename_size + n_packets + byte_id_Completed = 9
-                        packet += filename_size_bin + filename_bin + n_packets_bin + byte_id_Completed_bin
-                    
-                    # Insere um identificador a 0 a informar que o ficheiro está incompleto
-                    else:
-                        # Calcula quantos bits o inteiro que representa os pacotes que o FS_Node possuí ocupa
-                        num_bits_packets_owned = packets_owned.bit_length()
-                        # Converte para o número de bytes necessários
-                        num_bytes_packets_owned = (num_bits_packets_owned + 7) // 8
-                        num_bytes_packets_owned_bin = num_bytes_packets_owned.to_bytes(4, byteorder='big')
-                        packets_owned_bin = packets_owned.to_bytes(num_bytes_packets_owned, byteorder='big')
-
-                        size_packet += filename_size + num_bytes_packets_owned + 13 # filename_size + n_packets + byte_id_Completed + num_bytes_packets_owned = 13
-                        packet += filename_size_bin + filename_bin + n_packets_bin + byte_id_notCompleted_bin + num_bytes_packets_owned_bin + packets_owned_bin
-
-                size_packet_bin = size_packet.to_bytes(4, byteorder='big')
-                packet = size_packet_bin + mode_bin + packet
-            
-            elif id_mode==2 or id_mode==3:
-                # Usado para informar o FS_Tracker de alterações relativas a um ficheiro
-                # argumento message -> (fileName, packet_index)
-                # formato packet -> size_packet + mode + filename + packet_index
-
-                filename_bin = filename_bin = b''.join(format(ord(char), '08b').encode('utf-8') for char in message[0])
-                packet_index_bin = message[1].to_bytes(4, byteorder='big')
-                size_packet = len(filename_bin) + 8 # mode + packet_index = 8
-                size_packet_bin = size_packet.to_bytes(4, byteorder='big')
-                packet = size_packet_bin + mode_bin + filename_bin + packet_index_bin
-            
-        else:
-            # Usado pelo FS_Tracker para informar o FS_Node quais os FS_Nodes que têm o ficheiro que ele pediu
-            # argumento message -> [size_file, (172.0.1, 9090), (193.0.2, 10001), [(172.0.4, 20010), 61253], (193.0.1.3, 9090), [(172.0.1.3, 9090), 5723], ...]
-            # formato packet -> size_packet + size_file + byte_identificador + info + byte_identificador + info + ...
-            # byte_identificador: determina se o campo seguinte é do tipo (193.0.1.2, 9090) ou [(172.0.1, 9090), 61253]
-            # info: está associado ao byte_identificador e pode ser (193.0.1.2, 10015) ou [(172.0.1, 20017), 61253]
-            # Se for do tipo [(172.0.1, 20017), 61253] o info incluí ainda um campo packets_Owned_size e packets_Owned
-
-            byte_id_notList = 0
-            byte_id_list = 1
-            byte_id_notList_bin = byte_id_notList.to_bytes(1, byteorder='big')
-            byte_id_list_bin = byte_id_list.to_bytes(1, byteorder='big')
-
-            if len(message):
-                packet = b''
-                size_packet = 4 # n_packets = 4
-                n_packets_bin = message[0].to_bytes(4, byteorder='big')
-                for info in message[1:]:
-                    if not isinstance(info, list):
-                        ip, port = info
-
-                        # Insere um identificador a 0 a informar que não é uma lista
-                        ip_bin = b''.join(format(ord(char), '08b').encode('utf-8') for char in ip)
-                        ip_size = len(ip_bin)
-                        ip_size_bin = ip_size.to_bytes(4, byteorder='big')
-                        port_bin = port.to_bytes(4, byteorder='big')
-                        size_packet += ip_size + 5 # identificador + port = 5
-                        packet += byte_id_notList_bin + ip_size_bin + ip_bin + port_bin
-                    else:
-                        addr, packets_owned = info
-                        ip, port = addr
-
-                        # Insere um identificador a 1 a informar que é uma lista de dois elementos
-                        ip_bin = b''.join(format(ord(char), '08b').encode('utf-8') for char in ip)
-                        ip_size = len(ip_bin)
-                        ip_size_bin = ip_size.to_bytes(4, byteorder='big')
-                        port_bin = port.to_bytes(4, byteorder='big')
-
-                        # Calcula quantos bits o inteiro que representa os pacotes que o FS_Node possuí ocupa
-                        num_bits_packets_owned = packets_owned.bit_length()
-                        # Converte para o número de bytes necessários
-                        num_bytes_packets_owned = (num_bits_packets_owned + 7) // 8
-                        num_bytes_packets_owned_bin = num_bytes_packets_owned.to_bytes(4, byteorder='big')
-                        packets_owned_bin = packets_owned.to_bytes(num_bytes_packets_owned, byteorder='big')
-
-                        size_packet += ip_size + num_bytes_packets_owned + 9 # identificador + port + num_bytes_packets_owned = 9
-                        packet += byte_id_list_bin + ip_size_bin + ip_bin + port_bin + num_bytes_packets_owned_bin + packets_owned_bin
-            
-                size_packet_bin = size_packet.to_bytes(4, byteorder='big')
-                packet = size_packet_bin + n_packets_bin + packet
-            else:
-                size_packet = 0
-                size_packet_bin = size_packet.to_bytes(4, byteorder='big')
-                packet = size_packet_bin
-
-        # Enviar a mensagem
-        send_lock.acquire()
-        c.sendall(packet)
-        send_lock.release()
+
+"""
+Funções que convertem mensagens de e para tramas TCP na versão do protocolo 'version', sem acederem a um socket. São usadas
+por send_message_TCP e pelo servidor asyncio do FS_Tracker, que lê as tramas e escreve as respostas diretamente nos streams
+da conexão. Apenas os pedidos dos FS_Nodes são convertidos a partir de uma trama, pois a resposta do FS_Tracker da versão 1
+não indica o seu tamanho total (ver _receive_reply_TCP_v1).
+"""
+def encode_message_TCP(message, mode, id_mode=None, peers_version=None, version=1):
+    if version >= 2:
+        return encode_message_TCP_v2(message, mode, id_mode, peers_version)
+    return encode_message_TCP_v1(message, mode, id_mode)
+
+
+def decode_request_TCP(frame, version=1):
+    if version >= 2:
+        return decode_message_TCP_v2(frame, True)
+    return decode_message_TCP_v1(frame)
+
+
+"""
+Função que devolve o nome do ficheiro de um pedido da versão 2 (sem o campo size_packet) sem converter o resto da trama, ou
+None no anúncio (id_mode==1) e nos pedidos de vários ficheiros (id_mode==9 e id_mode==10), que podem conter vários ficheiros,
+e no pedido das métricas (id_mode==8). Em todos os outros pedidos o nome do ficheiro é o primeiro campo, a seguir ao id_mode.
+"""
+def get_request_filename_v2(frame):
+    if frame[0]==1 or frame[0]==8 or frame[0]==9 or frame[0]==10:
+        return None
+    return _unpack_str16(frame, 1)[0]
+
+
+"""
+Função que divide o anúncio dos ficheiros de um FS_Node (id_mode==1) em várias tramas, cada uma com no máximo
+'max_frame_size' bytes (exceto se um único ficheiro não couber numa trama). Cada trama é um anúncio completo por si só,
+pelo que o FS_Tracker aplica-as uma a uma como se fossem anúncios separados. Assim, um FS_Node com milhares de ficheiros
+nunca precisa de construir um único buffer gigante, nem o FS_Tracker de o receber.
+"""
+def encode_announcement_frames(files, version, max_frame_size=MAX_ANNOUNCEMENT_FRAME):
+    if version >= 2:
+        header, append_file = _V2_TCP_HEADER, _append_file_v2
+    else:
+        header, append_file = _V1_TCP_HEADER, _append_file_v1
+
+    packet = bytearray(header.size)
+    for file in files:
+        mark = len(packet)
+        append_file(packet, *file)
+
+        # Caso a trama ultrapasse o limite, envia-a sem o último ficheiro, que passa para a trama seguinte
+        if len(packet) > max_frame_size and mark > header.size:
+            entry = packet[mark:]
+            del packet[mark:]
+            header.pack_into(packet, 0, len(packet) - 4, 1)
+            yield packet
+            packet = bytearray(header.size)
+            packet += entry
+
+    header.pack_into(packet, 0, len(packet) - 4, 1)
+    yield packet
+
+
+"""
+Função que envia o anúncio dos ficheiros de um FS_Node ao FS_Tracker, dividido em tramas limitadas (ver
+encode_announcement_frames). O lock de envio é libertado entre tramas, para que outros pedidos do FS_Node não fiquem à
+espera que o anúncio todo seja enviado.
+"""
+def send_announcement_TCP(c, send_lock, files, max_frame_size=MAX_ANNOUNCEMENT_FRAME):
+    try:
+        for packet in encode_announcement_frames(files, get_protocol_version(c), max_frame_size):
+            with send_lock:
+                c.sendall(packet)
     except socket.error:
         c.close()
 
@@ -343,9 +1185,31 @@ Função que envia uma mensagem para outro FS_Node através de um socket UDP. Ca
 que o modo 0 envia em conjunto com os dados, informações adicionais de forma ao FS_Node que receber a mensagem conseguir devolver
 o pacote pedido. No ínicio de cada mensagem é enviado ainda o tamanho da mesma, para o recetor ter a certeza da quantidade que tem
 de ler.
+
+O argumento "version" corresponde à versão do protocolo suportada pelo FS_Node de destino. Na versão 2, o argumento
+"max_datagram" é o tamanho máximo de cada datagrama: uma resposta (mode==1) maior do que este tamanho é dividida em vários
+fragmentos (mode==3) e, num pedido de vários pacotes (mode==2), é enviado para o outro FS_Node saber o tamanho máximo dos
+datagramas que pode responder.
+
+Também na versão 2, o argumento "flags" é enviado nos pedidos (por exemplo REQUEST_FLAG_COMPRESS, para pedir os pacotes
+comprimidos) e o argumento "compressor" é o Block_Compressor usado para comprimir uma resposta, quando quem a pediu aceita
+pacotes comprimidos.
 """
-def send_message_UDP(mode, socket, filename, packet_index, packet, destiny):
-    if (mode==0):
+def send_message_UDP(mode, socket, filename, packet_index, packet, destiny, version=1, max_datagram=None, flags=0, compressor=None):
+    if (version>=2):
+        if max_datagram is None:
+            max_datagram = DEFAULT_MTU - UDP_IP_OVERHEAD
+        if (mode==1):
+            compressed = compressor.compress(filename, packet_index, packet) if compressor is not None else None
+            if compressed is not None:
+                datagrams = _encode_block_UDP_v2(filename, packet_index, compressed, max_datagram, True)
+            else:
+                datagrams = _encode_block_UDP_v2(filename, packet_index, packet, max_datagram)
+            for datagram in datagrams:
+                socket.sendto(datagram, destiny)
+            return
+        packet = _encode_message_UDP_v2(mode, filename, packet_index, max_datagram, flags)
+    elif (mode==0):
         # Usado para pedir pacotes de ficheiros a outros FS_Nodes
         # formato packet -> mode + checksum + filename_size + filename + packet_index
 
@@ -381,10 +1245,26 @@ def send_message_UDP(mode, socket, filename, packet_index, packet, destiny):
 
 
 """
-
+Função que recebe um datagrama de outro FS_Node e o converte para uma lista. Um pedido de pacote é devolvido no formato
+[0, endereço, filename, packet_index, flags, versão], uma resposta no formato [1, endereço, filename + packet_index, packet,
+versão], um pedido de vários pacotes (apenas na versão 2) no formato [2, endereço, filename, [packet_index, ...], max_datagram,
+flags, versão] e um fragmento de uma resposta (apenas na versão 2) no formato [3, endereço, filename + packet_index, (offset,
+block_length, data, compressed), versão], sendo a versão a do protocolo usado pelo FS_Node que enviou o datagrama, de forma a
+responder na mesma versão. As respostas comprimidas são devolvidas já descomprimidas, mas os fragmentos de uma resposta
+comprimida só podem ser descomprimidos depois de juntos (compressed a True). Caso o datagrama esteja corrompido devolve -1.
+
+O argumento "buffer_size" é o tamanho máximo dos datagramas que o FS_Node aceita, que deve ser pelo menos V1_DATAGRAM_SIZE.
 """
-def receive_message_UDP(socket):
-    message, sender_address = socket.recvfrom(2000)
+def receive_message_UDP(socket, buffer_size=V1_DATAGRAM_SIZE):
+    message, sender_address = socket.recvfrom(buffer_size)
+
+    if message[:1]==b'\x02':
+        packet = _decode_message_UDP_v2(message)
+        if packet==-1:
+            return -1
+        packet.insert(1, sender_address)
+        packet.append(2)
+        return packet
 
     # Lê o modo
     modo_bin = message[:4]
@@ -414,7 +1294,7 @@ def receive_message_UDP(socket):
             packet_index_bin = message[i:]
             packet_index = int.from_bytes(packet_index_bin, byteorder='big')
 
-            packet = [modo, filename, packet_index]
+            packet = [modo, filename, packet_index, 0]
         else:
             return -1
     elif (modo==1):
@@ -443,7 +1323,221 @@ def receive_message_UDP(socket):
             packet = [modo, filename, packet_data]
         else:
             return -1
+    else:
+        return -1
 
     packet.insert(1, sender_address)
+    packet.append(1)
     
     return packet
+
+
+"""
+Funções que convertem os datagramas da versão 2. Os campos são os mesmos que na versão 1, mas o nome do ficheiro é enviado
+em UTF-8 e, na resposta, o índice do pacote deixa de ser concatenado ao nome do ficheiro em texto.
+
+mode==0 -> versão + mode + checksum + filename_size (2 bytes) + filename + packet_index
+mode==1 -> versão + mode + checksum + filename_size (2 bytes) + filename + packet_index + packet
+mode==2 -> versão + mode + checksum + filename_size (2 bytes) + filename + codificação (1 byte) + índices + max_datagram (2 bytes)
+mode==3 -> versão + mode + checksum + filename_size (2 bytes) + filename + packet_index + offset + block_length + fragmento
+mode==4 -> igual ao mode==1, mas com o pacote comprimido com zlib
+mode==5 -> igual ao mode==3, mas os fragmentos são do pacote comprimido com zlib (block_length é o tamanho comprimido)
+
+Os pedidos (mode==0 e mode==2) terminam num byte de flags. Caso o FS_Node que pediu indique REQUEST_FLAG_COMPRESS, cada
+pacote é respondido no mode==4 (ou mode==5) se a compressão compensar, ou no mode==1 (ou mode==3) caso contrário (ver
+Block_Compressor).
+
+Em todos os modos o checksum é um CRC32 do datagrama, que apenas deteta erros de transmissão. Na versão 1 as respostas levam
+uma hash SHA-256 calculada em cada envio, mas esta não permite saber se o pacote é o correto. Na versão 2 a integridade
+de cada pacote é verificada por quem o recebe, com a hash do pacote no manifesto do ficheiro publicado no FS_Tracker.
+
+O modo 2 é um pedido de vários pacotes de uma só vez, ao qual o FS_Node responde com um datagrama do modo 1 por cada
+pacote pedido. Neste modo o argumento 'packet_index' é a lista dos índices pedidos, que são enviados da forma mais
+compacta: um mapa de bits a partir do primeiro índice (BATCH_RANGE -> primeiro índice + tamanho do mapa (2 bytes) + mapa)
+ou a lista dos índices (BATCH_LIST -> número de índices (2 bytes) + índices).
+
+O modo 3 transporta uma parte de um pacote que não cabe num só datagrama, indicando a posição da parte dentro do pacote e
+o tamanho total do pacote, para o FS_Node que a recebe conseguir reconstruir o pacote.
+"""
+def _encode_message_UDP_v2(mode, filename, packet_index, max_datagram, flags=0):
+    header = _V2_UDP_HEADER.pack(2, mode)
+    if (mode==2):
+        body = _pack_str16(filename) + _pack_batch(packet_index) + _U16.pack(min(max_datagram, 0xFFFF)) + _U8.pack(flags)
+    else:
+        body = _pack_str16(filename) + _U32.pack(packet_index) + _U8.pack(flags)
+    checksum = zlib.crc32(header + body) & 0xFFFFFFFF
+    return header + _U32.pack(checksum) + body
+
+
+def _encode_block_UDP_v2(filename, packet_index, packet, max_datagram, compressed=False):
+    name = _pack_str16(filename)
+
+    # Envia o pacote num só datagrama se este couber
+    if 6 + len(name) + 4 + len(packet) <= max_datagram:
+        header = _V2_UDP_HEADER.pack(2, 4 if compressed else 1)
+        body = name + _U32.pack(packet_index)
+        checksum = zlib.crc32(packet, zlib.crc32(body, zlib.crc32(header))) & 0xFFFFFFFF
+        return [header + _U32.pack(checksum) + body + packet]
+
+    # Caso contrário, divide-o em fragmentos
+    header = _V2_UDP_HEADER.pack(2, 5 if compressed else 3)
+    fragment_size = max_datagram - (6 + len(name) + 12)
+    if fragment_size <= 0:
+        raise ValueError(f"Datagramas de {max_datagram} bytes não têm espaço para o nome {filename}")
+    datagrams = []
+    for offset in range(0, len(packet), fragment_size):
+        body = name + struct.pack('>III', packet_index, offset, len(packet)) + packet[offset:offset+fragment_size]
+        checksum = zlib.crc32(body, zlib.crc32(header)) & 0xFFFFFFFF
+        datagrams.append(header + _U32.pack(checksum) + body)
+    return datagrams
+
+
+def _decode_message_UDP_v2(message):
+    if len(message) < 2:
+        return -1
+    modo = message[1]
+    view = memoryview(message)
+
+    if modo > 5:
+        return -1
+    if zlib.crc32(view[6:], zlib.crc32(view[:2])) & 0xFFFFFFFF != int.from_bytes(view[2:6], byteorder='big'):
+        return -1
+
+    filename, offset = _unpack_str16(view, 6)
+    if (modo==2):
+        packets_index, offset = _unpack_batch(view, offset)
+        max_datagram, = _U16.unpack_from(view, offset)
+        flags = view[offset+2] if len(view) > offset + 2 else 0
+        return [modo, filename, packets_index, max_datagram, flags]
+
+    packet_index, = _U32.unpack_from(view, offset)
+    if (modo==0):
+        flags = view[offset+4] if len(view) > offset + 4 else 0
+        return [modo, filename, packet_index, flags]
+    elif (modo==3 or modo==5):
+        fragment_offset, block_length = struct.unpack_from('>II', view, offset + 4)
+        return [3, filename + str(packet_index), (fragment_offset, block_length, message[offset+12:], modo==5)]
+    elif (modo==4):
+        try:
+            return [1, filename + str(packet_index), zlib.decompress(message[offset+4:])]
+        except zlib.error:
+            return -1
+    return [modo, filename + str(packet_index), message[offset+4:]]
+
+
+BATCH_RANGE = 0
+BATCH_LIST = 1
+
+def _pack_batch(indices):
+    first = min(indices)
+    span = max(indices) - first + 1
+    if (span + 7) // 8 + 4 <= 4 * len(indices):
+        size = (span + 7) // 8
+        bitmap = 0
+        for index in indices:
+            bitmap |= 1 << (size * 8 - 1 - (index - first))
+        bitmap_bin = bitmap.to_bytes(size, byteorder='big')
+        return _U8.pack(BATCH_RANGE) + _U32.pack(first) + _U16.pack(len(bitmap_bin)) + bitmap_bin
+    return _U8.pack(BATCH_LIST) + _U16.pack(len(indices)) + struct.pack(f'>{len(indices)}I', *indices)
+
+
+def _unpack_batch(buffer, offset):
+    encoding = buffer[offset]
+    if encoding==BATCH_RANGE:
+        first, size = struct.unpack_from('>IH', buffer, offset + 1)
+        offset += 7
+        bitmap = format(int.from_bytes(buffer[offset:offset+size], byteorder='big'), f'0{size * 8}b')
+        return [first + i for i, bit in enumerate(bitmap) if bit=='1'], offset + size
+    size, = _U16.unpack_from(buffer, offset + 1)
+    return list(struct.unpack_from(f'>{size}I', buffer, offset + 3)), offset + 3 + 4 * size
+
+
+"""
+Classe que comprime os pacotes enviados aos FS_Nodes que pediram pacotes comprimidos. Cada pacote só é enviado comprimido
+se o tamanho comprimido for no máximo 'ratio' vezes o tamanho original, caso contrário é enviado tal como está.
+
+O resultado da compressão dos pacotes mais pedidos (incluindo a decisão de não comprimir) é guardado numa cache LRU com
+no máximo 'cache_size' pacotes, para que um pacote pedido por vários FS_Nodes só seja comprimido uma vez. Cada entrada
+guarda o CRC32 do pacote original, pelo que um pacote que mudou no disco é comprimido novamente.
+
+A classe mantém contadores, devolvidos por get_stats(), que permitem comparar os bytes poupados com o tempo de CPU gasto a
+comprimir: pacotes comprimidos, pacotes enviados sem compressão, acertos na cache, bytes originais, bytes enviados e
+segundos de CPU.
+"""
+class Block_Compressor():
+
+    def __init__(self, ratio=0.9, level=1, cache_size=4096):
+        self.ratio = ratio
+        self.level = level
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"compressed": 0, "skipped": 0, "cache_hits": 0, "bytes_in": 0, "bytes_out": 0, "cpu_seconds": 0.0}
+
+
+    """
+    Devolve o pacote comprimido, ou None se a compressão não compensar.
+    """
+    def compress(self, filename, packet_index, packet):
+        key = (filename, packet_index)
+        checksum = zlib.crc32(packet)
+
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and entry[0]==checksum:
+                self.cache.move_to_end(key)
+                self.stats["cache_hits"] += 1
+                compressed = entry[1]
+            else:
+                start = time.thread_time()
+                compressed = zlib.compress(packet, self.level)
+                self.stats["cpu_seconds"] += time.thread_time() - start
+                if len(compressed) > len(packet) * self.ratio:
+                    compressed = None
+
+                self.cache[key] = (checksum, compressed)
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+            self.stats["bytes_in"] += len(packet)
+            if compressed is None:
+                self.stats["skipped"] += 1
+                self.stats["bytes_out"] += len(packet)
+            else:
+                self.stats["compressed"] += 1
+                self.stats["bytes_out"] += len(compressed)
+
+        return compressed
+
+
+    """
+    Devolve uma cópia dos contadores, com os bytes poupados pela compressão.
+    """
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats["bytes_saved"] = stats["bytes_in"] - stats["bytes_out"]
+        return stats
+
+
+"""
+Função que determina o MTU do caminho até outro FS_Node, perguntando ao sistema operativo (Linux) através de um socket UDP
+ligado ao destino. Caso não seja possível, devolve o MTU por omissão. Os valores são guardados em cache por destino.
+"""
+_path_MTU_cache = {}
+
+def probe_path_MTU(destiny, default=DEFAULT_MTU):
+    if (mtu := _path_MTU_cache.get(destiny)) is not None:
+        return mtu
+
+    mtu = default
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.setsockopt(socket.IPPROTO_IP, getattr(socket, 'IP_MTU_DISCOVER', 10), getattr(socket, 'IP_PMTUDISC_DO', 2))
+            probe.connect(destiny)
+            mtu = probe.getsockopt(socket.IPPROTO_IP, getattr(socket, 'IP_MTU', 14))
+    except OSError:
+        pass
+
+    _path_MTU_cache[destiny] = mtu
+    return mtu
@@ -0,0 +1,139 @@
+"""
+Ficheiro correspondente à classe que junta as atualizações de pacotes que o FS_Node envia ao FS_Tracker. Em vez de enviar
+uma mensagem por cada pacote recebido, o FS_Node guarda, por ficheiro, o mapa de bits das alterações e envia-o numa única
+mensagem (id_mode==3) quando há pacotes suficientes, quando passa algum tempo desde a primeira alteração por enviar ou quando
+termina a transferência de um ficheiro.
+"""
+
+import threading
+import time
+import Message_Protocols
+
+
+
+# Número de pacotes alterados a partir do qual as alterações são enviadas de imediato
+MAX_PENDING_PACKETS = 256
+
+# Tempo máximo, em segundos, que uma alteração fica por enviar
+MAX_PENDING_TIME = 0.5
+
+
+class Packet_Updates():
+
+	"""
+	Estrutura que guarda as alterações por enviar de cada ficheiro. Contem um dicionário em que cada key é o nome do ficheiro e
+	cada value é o mapa de bits com as alterações (o mesmo formato que o FS_Tracker espera no id_mode==3, ou seja, os bits dos
+	pacotes que mudaram, aos quais o FS_Tracker aplica um XOR).
+
+	Exemplo da estrutura: {file1: 0b0011000}
+
+	A estrutura pending = {file1: [3, 1700000000.5]} guarda, para cada ficheiro com alterações por enviar, o número de pacotes
+	alterados e o instante da primeira alteração, para que enviar apenas um ficheiro (no fim da sua transferência) desconte
+	esses pacotes do total e o prazo dos restantes ficheiros passe a contar da sua própria primeira alteração.
+
+	Como o FS_Tracker aplica as alterações com um XOR, a ordem pela qual os pacotes de um ficheiro são agrupados não altera o
+	resultado. Na versão 1 do protocolo, o id_mode==3 só suporta ficheiros até 32 pacotes, por isso cada pacote continua a ser
+	enviado numa mensagem própria (id_mode==2).
+	"""
+	def __init__(self, s, send_lock_TCP, max_pending_packets=MAX_PENDING_PACKETS, max_pending_time=MAX_PENDING_TIME):
+		self.s = s
+		self.send_lock_TCP = send_lock_TCP
+		self.max_pending_packets = max_pending_packets
+		self.max_pending_time = max_pending_time
+		self.updates = {}
+		self.pending = {}
+		self.pending_packets = 0
+		self.first_update = None
+		self.lock = threading.Lock()
+		self.condition = threading.Condition(self.lock)
+
+
+	"""
+	Função que regista a alteração de um pacote de um ficheiro com 'n_packets' pacotes, enviando as alterações ao FS_Tracker
+	caso já existam MAX_PENDING_PACKETS pacotes por enviar.
+	"""
+	def add(self, fileName, n_packets, packet_index):
+		if Message_Protocols.get_protocol_version(self.s) < 2:
+			Message_Protocols.send_message_TCP(self.s, self.send_lock_TCP, (fileName, packet_index), True, 2)
+			return
+
+		with self.lock:
+			self.updates[fileName] = self.updates.get(fileName, 0) ^ (1 << n_packets - packet_index - 1)
+			if (entry := self.pending.get(fileName)) is None:
+				self.pending[fileName] = entry = [0, time.time()]
+			entry[0] += 1
+			self.pending_packets += 1
+			if self.first_update is None:
+				self.first_update = entry[1]
+				self.condition.notify()
+			full = self.pending_packets >= self.max_pending_packets
+
+		if full:
+			self.flush()
+
+
+	"""
+	Função que envia ao FS_Tracker as alterações por enviar, de todos os ficheiros ou apenas do ficheiro indicado. Os ficheiros
+	cujas alterações se anulam (mapa de bits igual a 0) não são enviados.
+
+	O lock das alterações é mantido até ao fim do envio, pelo que as alterações retiradas por uma thread são sempre enviadas
+	antes das mensagens que outra thread envie a seguir com este lock, como a remoção de um ficheiro (ver remove).
+	"""
+	def flush(self, fileName=None):
+		with self.lock:
+			self._send(self._take(fileName))
+
+
+	"""
+	Função que envia ao FS_Tracker a remoção de um ficheiro, com os pacotes 'packets' que o FS_Node possuía, no formato do
+	id_mode==3. As alterações do ficheiro por enviar são enviadas antes, na mesma secção crítica, pois o FS_Tracker aplica a
+	remoção com um XOR sobre os pacotes que conhece, e nenhuma alteração do ficheiro retirada antes por outra thread pode
+	chegar depois da remoção e voltar a registar o ficheiro.
+	"""
+	def remove(self, fileName, packets):
+		with self.lock:
+			updates = self._take(fileName)
+			with self.send_lock_TCP:
+				self._send(updates)
+				Message_Protocols.send_message_TCP(self.s, self.send_lock_TCP, [fileName, packets], True, 3)
+
+
+	"""
+	Funções auxiliares de flush e remove, chamadas com o lock das alterações. _take retira as alterações de todos os ficheiros
+	ou do ficheiro indicado, atualizando os totais dos restantes, e _send envia-as, mantendo o lock de envio durante todo o
+	envio para as alterações seguirem seguidas no socket.
+	"""
+	def _take(self, fileName):
+		if fileName is None:
+			updates = self.updates
+			self.updates = {}
+			self.pending = {}
+		else:
+			updates = {fileName: self.updates.pop(fileName)} if fileName in self.updates else {}
+			self.pending.pop(fileName, None)
+
+		self.pending_packets = sum(entry[0] for entry in self.pending.values())
+		self.first_update = min((entry[1] for entry in self.pending.values()), default=None)
+		return updates
+
+
+	def _send(self, updates):
+		with self.send_lock_TCP:
+			for name, delta in updates.items():
+				if delta:
+					Message_Protocols.send_message_TCP(self.s, self.send_lock_TCP, [name, delta], True, 3)
+
+
+	"""
+	Função usada pela thread que envia as alterações ao fim de MAX_PENDING_TIME segundos. Bloqueia até existir uma alteração
+	por enviar há pelo menos esse tempo.
+	"""
+	def wait_expired(self):
+		with self.lock:
+			while True:
+				if self.first_update is None:
+					self.condition.wait()
+				elif (remaining := self.first_update + self.max_pending_time - time.time()) > 0:
+					self.condition.wait(remaining)
+				else:
+					return
@@ -1,27 +1,47 @@
 import threading
+import time
 from contextlib import contextmanager
 
 class ReentrantRWLock():
 
-    def __init__(self):
+    """
+    Lock de leitura e escrita que dá preferência às escritas: um escritor à espera fecha o turnstile, pelo que os leitores que
+    chegam depois esperam que a escrita termine, em vez de manterem o lock ocupado indefinidamente. Um leitor que já tem o
+    lock de leitura (por exemplo, numa função chamada dentro de outro bloco r_locked) não passa pelo turnstile, para não
+    ficar à espera de um escritor que espera por ele. O número de leituras de cada thread é guardado em reading.
+
+    Caso seja indicado 'wait_histogram' (um Tracker_Metrics.Histogram), o tempo de espera, em microssegundos, de cada
+    aquisição que encontra o lock ocupado é registado no histograma. As aquisições sem espera apenas fazem uma tentativa
+    sem bloquear, pelo que não medem o tempo.
+    """
+    def __init__(self, wait_histogram=None):
         self.w_lock = threading.Lock()
         self.num_r_lock = threading.Lock()
+        self.turnstile = threading.Lock()
         self.num_r = 0
-    
+        self.reading = threading.local()
+        self.wait_histogram = wait_histogram
+
     def r_acquire(self):
+        depth = getattr(self.reading, "depth", 0)
+        if depth == 0:
+            self._acquire(self.turnstile)
+            self.turnstile.release()
+        self.reading.depth = depth + 1
         self.num_r_lock.acquire()
         self.num_r += 1
         if self.num_r == 1:
-            self.w_lock.acquire()
+            self._acquire(self.w_lock)
         self.num_r_lock.release()
-    
+
     def r_release(self):
+        self.reading.depth -= 1
         self.num_r_lock.acquire()
         self.num_r -= 1
         if self.num_r == 0:
             self.w_lock.release()
         self.num_r_lock.release()
-    
+
     @contextmanager
     def r_locked(self):
         """ This method is designed to be used via the `with` statement. """
@@ -30,13 +50,27 @@ class ReentrantRWLock():
             yield
         finally:
             self.r_release()
-    
+
     def w_acquire(self):
-        self.w_lock.acquire()
+        self._acquire(self.turnstile)
+        try:
+            self._acquire(self.w_lock)
+        finally:
+            self.turnstile.release()
+
+    def _acquire(self, lock):
+        if self.wait_histogram is None:
+            lock.acquire()
+            return
+        if lock.acquire(False):
+            return
+        start = time.perf_counter()
+        lock.acquire()
+        self.wait_histogram.record((time.perf_counter() - start) * 1000000)
 
     def w_release(self):
         self.w_lock.release()
-    
+
     @contextmanager
     def w_locked(self):
         """ This method is designed to be used via the `with` statement. """
@@ -0,0 +1,188 @@
+"""
+Ficheiro correspondente à classe que gere, no FS_Node, as respostas do FS_Tracker e as subscrições das alterações dos FS_Nodes
+dos ficheiros que estão a ser transferidos. Como o FS_Tracker envia as alterações na conexão TCP sem pedido, em qualquer
+momento, o socket TCP passa a ser lido por uma única thread (Tracker_listener_thread do FS_Node), que entrega as respostas
+aos pedidos através desta classe e aplica as alterações à lista de FS_Nodes de cada transferência.
+"""
+
+import queue
+import threading
+import Message_Protocols
+
+
+
+class Swarm_Subscriptions():
+
+	"""
+	Estrutura files = {F1: [FS_Nodes, pending, changes, replace, since_resync]}
+	A key corresponde ao nome de um ficheiro subscrito (id_mode==10) e o value a uma lista de 5 elementos. O primeiro é a lista
+	de FS_Nodes usada pelas threads da transferência (ver get_file_Thread), no formato de convert_complete_FS_Nodes, ou None
+	enquanto a transferência ainda não começou. O segundo é um dicionário com o estado mais recente de cada FS_Node alterado
+	que ainda não foi aplicado à lista, no formato das alterações do FS_Tracker (pacotes, -1 caso tenha o ficheiro completo
+	ou None caso tenha sido removido), e o terceiro o número de vezes que a lista foi alterada. O quarto indica se pending
+	tem todos os FS_Nodes do ficheiro (depois de uma ressincronização), caso em que os FS_Nodes da lista que não estão em
+	pending são removidos, e o último guarda as alterações recebidas desde a última trama REPLY_OWNERS_RESYNC (ver reset), ou
+	None fora de uma ressincronização.
+
+	Exemplo da estrutura: {file1: [[20, [("node1", 9090), 1048575]], {("node2", 9090): 74215}, 3, False, None]}
+
+	As alterações que chegam antes da lista de FS_Nodes (por exemplo, antes da resposta à subscrição) ficam em pending e são
+	aplicadas quando a transferência começa. Como o FS_Tracker envia o estado de cada FS_Node e não a alteração, aplicar uma
+	alteração que já estava na resposta não altera o resultado. A lista nunca é alterada no lugar de um FS_Node: os FS_Nodes
+	são substituídos de uma só vez (FS_Nodes[1:] = ...), pelo que as threads que a percorrem leem sempre uma lista completa.
+
+	A fila replies guarda as respostas do FS_Tracker pela ordem de chegada. Como cada pedido é enviado, e a sua resposta
+	recebida, com o lock de envio do socket TCP, nunca há mais do que um pedido à espera de resposta.
+
+	Quando o FS_Tracker descarta alterações (REPLY_OWNERS_RESYNC), resync_pending indica que os ficheiros subscritos têm de
+	voltar a ser pedidos e resyncing que a thread que os pede (Swarm_resync_thread do FS_Node) está a correr.
+	"""
+	def __init__(self, s, send_lock_TCP):
+		self.s = s
+		self.send_lock_TCP = send_lock_TCP
+		self.files = {}
+		self.lock = threading.Lock()
+		self.replies = queue.SimpleQueue()
+		self.resync_pending = False
+		self.resyncing = False
+
+
+	"""
+	Funções que entregam e devolvem as respostas do FS_Tracker, no formato de receive_message_TCP. Quando a conexão é fechada,
+	todos os pedidos seguintes recebem -1.
+	"""
+	def deliver_reply(self, reply):
+		self.replies.put(reply)
+
+
+	def receive_reply(self):
+		reply = self.replies.get()
+		if reply == -1:
+			self.replies.put(reply)
+		return reply
+
+
+	"""
+	Função que regista a subscrição de um ficheiro, antes de o pedido de subscrição ser enviado ao FS_Tracker, para que as
+	alterações que cheguem antes da resposta não sejam descartadas.
+	"""
+	def add(self, fileName):
+		with self.lock:
+			self.files.setdefault(fileName, [None, {}, 0, False, {} if self.resyncing else None])
+
+
+	"""
+	Função que associa à subscrição de um ficheiro a lista de FS_Nodes da sua transferência, aplicando as alterações que já
+	tinham chegado. Caso o ficheiro não tenha sido subscrito, a lista não é alterada.
+	"""
+	def attach(self, fileName, FS_Nodes):
+		with self.lock:
+			if (entry := self.files.get(fileName)) is None:
+				return
+			entry[0] = FS_Nodes
+			self._merge(entry)
+
+
+	"""
+	Função usada pela thread que lê o socket TCP para aplicar uma trama de alterações do FS_Tracker. 'peers' é a lista
+	[[endereço, pacotes], ...] já com os endereços convertidos. As alterações de ficheiros que já não estão subscritos são
+	descartadas.
+	"""
+	def apply(self, fileName, peers):
+		with self.lock:
+			if (entry := self.files.get(fileName)) is None:
+				return
+			for address, packets_owned in peers:
+				entry[1][address] = packets_owned
+				if entry[4] is not None:
+					entry[4][address] = packets_owned
+			if entry[0] is not None:
+				self._merge(entry)
+
+
+	"""
+	Funções que gerem a ressincronização dos ficheiros subscritos. request_resync é chamada pela thread que lê o socket TCP ao
+	receber REPLY_OWNERS_RESYNC: as alterações de cada ficheiro passam a ser guardadas também em since_resync e devolve True
+	caso seja preciso iniciar a thread que pede os ficheiros. Essa thread obtém a lista de ficheiros a pedir com take_resync
+	(None quando já não há nenhuma ressincronização por fazer) e aplica a resposta de cada ficheiro com reset.
+
+	O FS_Tracker só descarta alterações enviadas antes da trama REPLY_OWNERS_RESYNC, e o pedido é enviado depois de esta ser
+	recebida, pelo que a resposta tem o estado de todos os FS_Nodes cujas alterações foram descartadas. As alterações
+	recebidas depois da trama são mais recentes do que as descartadas e são aplicadas por cima da resposta, pois, com o
+	servidor com shards, podem chegar antes da resposta e ser mais recentes do que esta. Caso chegue outra trama
+	REPLY_OWNERS_RESYNC antes de a resposta ser aplicada, since_resync volta a começar e os ficheiros são pedidos outra vez.
+	"""
+	def request_resync(self):
+		with self.lock:
+			for entry in self.files.values():
+				entry[4] = {}
+			self.resync_pending = True
+			start = not self.resyncing
+			self.resyncing = True
+		return start
+
+
+	def take_resync(self):
+		with self.lock:
+			if not self.resync_pending:
+				self.resyncing = False
+				return None
+			self.resync_pending = False
+			return list(self.files)
+
+
+	"""
+	Substitui os FS_Nodes de um ficheiro pela resposta 'peers' do FS_Tracker ([[endereço, pacotes], ...], no formato de
+	apply), com as alterações recebidas desde a trama REPLY_OWNERS_RESYNC por cima. Devolve False caso o ficheiro já não
+	esteja subscrito.
+	"""
+	def reset(self, fileName, peers):
+		with self.lock:
+			if (entry := self.files.get(fileName)) is None:
+				return False
+			table = {address: packets_owned for address, packets_owned in peers}
+			table.update(entry[4] or {})
+			entry[1] = table
+			entry[3] = True
+			if not self.resync_pending:
+				entry[4] = None
+			if entry[0] is not None:
+				self._merge(entry)
+			return True
+
+
+	"""
+	Devolve o número de vezes que a lista de FS_Nodes de um ficheiro foi alterada, ou 0 caso não esteja subscrito.
+	"""
+	def get_changes(self, fileName):
+		entry = self.files.get(fileName)
+		return entry[2] if entry is not None else 0
+
+
+	"""
+	Função que termina a subscrição de um ficheiro, no fim da sua transferência, e avisa o FS_Tracker (id_mode==11).
+	"""
+	def remove(self, fileName):
+		with self.lock:
+			if self.files.pop(fileName, None) is None:
+				return
+		Message_Protocols.send_message_TCP(self.s, self.send_lock_TCP, fileName, True, 11)
+
+
+	def _merge(self, entry):
+		FS_Nodes, pending = entry[0], entry[1]
+		if not pending and not entry[3]:
+			return
+
+		complete_value = (1 << FS_Nodes[0]) - 1
+		table = {} if entry[3] else {address: packets for address, packets in FS_Nodes[1:]}
+		entry[3] = False
+		for address, packets_owned in pending.items():
+			if packets_owned is None:
+				table.pop(address, None)
+			else:
+				table[address] = complete_value if packets_owned == -1 else packets_owned
+		pending.clear()
+
+		FS_Nodes[1:] = [[address, packets] for address, packets in table.items()]
+		entry[2] += 1
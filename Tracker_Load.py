@@ -0,0 +1,336 @@
+"""
+Ficheiro que gera carga sintética num FS_Tracker local, para medir a sua capacidade. Cada FS_Node simulado é uma corrotina
+com a sua conexão TCP, que fala o protocolo real de Message_Protocols (versão 2): negoceia a versão, anuncia os seus
+ficheiros (id_mode==1), envia atualizações de pacotes (id_mode==2) e pede os FS_Nodes que possuem ficheiros (id_mode==0, ou
+id_mode==7 com --query 7). Com --churn, os FS_Nodes desligam-se abruptamente (sem fechar a conexão de forma ordenada) e
+voltam a ligar-se como FS_Nodes novos.
+
+A popularidade dos ficheiros segue uma distribuição de Zipf (--zipf), para existirem ficheiros muito pedidos e ficheiros
+raros, e cada FS_Node faz em média --rate operações por segundo, com intervalos exponenciais, das quais --reads são pedidos.
+
+A cada --interval segundos é escrito o número de pedidos e atualizações por segundo, os percentis da latência dos pedidos
+nesse intervalo e a memória (RSS) do FS_Tracker e dos seus processos filhos (--tracker-pid, apenas em Linux). No fim é
+escrito o resumo da execução, que pode ser guardado num ficheiro JSON (--save) com todos os intervalos.
+
+Formato: python3 Tracker_Load.py Tracker_Name Tracker_Port [--nodes N] [--files N] [--files-per-node N] [--packets N]
+         [--rate N] [--reads N] [--query 0|7] [--churn N] [--zipf N] [--duration N] [--interval N] [--connect-rate N]
+         [--tracker-pid PID] [--save ficheiro.json] [--seed N]
+"""
+
+import asyncio
+import bisect
+import itertools
+import json
+import os
+import random
+import sys
+import time
+import Message_Protocols
+from Tracker_Metrics import Histogram
+
+
+
+# Valores por omissão das opções
+DEFAULT_OPTIONS = {
+	"--nodes": 1000,
+	"--files": 10000,
+	"--files-per-node": 20,
+	"--packets": 256,
+	"--rate": 1.0,
+	"--reads": 0.5,
+	"--query": 0,
+	"--churn": 0.0,
+	"--zipf": 1.0,
+	"--duration": 30.0,
+	"--interval": 1.0,
+	"--connect-rate": 500.0,
+	"--tracker-pid": None,
+	"--save": None,
+	"--seed": 0,
+}
+
+# Número máximo de FS_Nodes devolvidos por pedido com --query 7
+MAX_OWNERS = 50
+
+
+class Load_Stats():
+
+	"""
+	Contadores partilhados por todos os FS_Nodes simulados. Os valores de cada intervalo são reiniciados a cada relatório
+	(take_interval), enquanto os totais e o histograma total se mantêm até ao fim.
+	"""
+	def __init__(self):
+		self.reads = 0
+		self.writes = 0
+		self.connects = 0
+		self.disconnects = 0
+		self.errors = 0
+		self.bytes_in = 0
+		self.bytes_out = 0
+		self.latency = Histogram()
+		self.total_latency = Histogram()
+		self.totals = {"reads": 0, "writes": 0, "connects": 0, "disconnects": 0, "errors": 0, "bytes_in": 0, "bytes_out": 0}
+
+
+	def record_latency(self, seconds):
+		self.latency.record(seconds * 1000000)
+		self.total_latency.record(seconds * 1000000)
+
+
+	def take_interval(self):
+		interval = {"reads": self.reads, "writes": self.writes, "connects": self.connects, "disconnects": self.disconnects,
+			"errors": self.errors, "bytes_in": self.bytes_in, "bytes_out": self.bytes_out}
+		for name, value in interval.items():
+			self.totals[name] += value
+		latency = self.latency.snapshot()
+		self.reads = self.writes = self.connects = self.disconnects = self.errors = self.bytes_in = self.bytes_out = 0
+		self.latency = Histogram()
+		return interval, latency
+
+
+class Swarm():
+
+	"""
+	Estado comum da simulação: as opções, o gerador de números aleatórios e a tabela cumulativa da distribuição de Zipf
+	usada para escolher ficheiros, em que o ficheiro i tem peso 1 / (i + 1) ^ zipf.
+	"""
+	def __init__(self, host, port, options):
+		self.host = host
+		self.port = port
+		self.options = options
+		self.random = random.Random(options["--seed"])
+		self.stats = Load_Stats()
+		self.names = [f"load_{i:06d}.bin" for i in range(options["--files"])]
+		self.cumulative = list(itertools.accumulate(1 / (i + 1) ** options["--zipf"] for i in range(options["--files"])))
+
+
+	def pick_file(self):
+		return self.names[bisect.bisect_left(self.cumulative, self.random.random() * self.cumulative[-1])]
+
+
+	"""
+	Devolve os ficheiros de um FS_Node novo, no formato do anúncio: metade dos ficheiros completos e os restantes com cada
+	pacote presente com probabilidade 1/2.
+	"""
+	def make_files(self):
+		n_packets = self.options["--packets"]
+		files = {}
+		while len(files) < min(self.options["--files-per-node"], len(self.names)):
+			name = self.pick_file()
+			if name not in files:
+				files[name] = -1 if self.random.random() < 0.5 else self.random.getrandbits(n_packets)
+		return files
+
+
+"""
+Função que lê uma trama do FS_Tracker, devolvendo o número de bytes lidos.
+"""
+async def read_frame(reader):
+	size = int.from_bytes(await reader.readexactly(4), byteorder='big')
+	await reader.readexactly(size)
+	return size + 4
+
+
+"""
+Corrotina que simula um FS_Node durante toda a execução: liga-se, anuncia os seus ficheiros e faz operações até ser desligado
+pelo churn, voltando a ligar-se como um FS_Node novo, ou até a execução terminar.
+"""
+async def simulated_node(swarm, deadline):
+	options = swarm.options
+	stats = swarm.stats
+	n_packets = options["--packets"]
+
+	while time.monotonic() < deadline:
+		try:
+			reader, writer = await asyncio.open_connection(swarm.host, swarm.port)
+		except OSError:
+			stats.errors += 1
+			await asyncio.sleep(1)
+			continue
+		stats.connects += 1
+
+		try:
+			# Negociação da versão, com a mensagem e a resposta da versão 1
+			probe = Message_Protocols.encode_message_TCP(Message_Protocols.PROTOCOL_PROBE + "2", True, 0)
+			writer.write(probe)
+			stats.bytes_out += len(probe)
+			stats.bytes_in += await read_frame(reader)
+
+			files = swarm.make_files()
+			announcement = [[name, n_packets, packets_owned] for name, packets_owned in files.items()]
+			for frame in Message_Protocols.encode_announcement_frames(announcement, 2):
+				writer.write(frame)
+				stats.bytes_out += len(frame)
+			stats.writes += 1
+			await writer.drain()
+
+			while time.monotonic() < deadline:
+				await asyncio.sleep(swarm.random.expovariate(options["--rate"]))
+
+				if options["--churn"] and swarm.random.random() < options["--churn"] / options["--rate"]:
+					# Desliga-se sem fechar a conexão de forma ordenada, como um FS_Node que falha
+					writer.transport.abort()
+					stats.disconnects += 1
+					break
+
+				incomplete = [name for name, packets_owned in files.items() if packets_owned != -1]
+				if swarm.random.random() < options["--reads"] or not incomplete:
+					name = swarm.pick_file()
+					if options["--query"] == 7:
+						packets_owned = files.get(name, -1)
+						packets_needed = -1 if packets_owned == -1 else ((1 << n_packets) - 1) ^ packets_owned
+						frame = Message_Protocols.encode_message_TCP_v2([name, MAX_OWNERS, packets_needed], True, 7)
+					else:
+						frame = Message_Protocols.encode_message_TCP_v2(name, True, 0)
+					start = time.perf_counter()
+					writer.write(frame)
+					stats.bytes_out += len(frame)
+					stats.bytes_in += await read_frame(reader)
+					stats.record_latency(time.perf_counter() - start)
+					stats.reads += 1
+				else:
+					# Atualização de um pacote em falta de um ficheiro incompleto
+					name = swarm.random.choice(incomplete)
+					missing = [index for index in range(n_packets) if not files[name] >> (n_packets - index - 1) & 1]
+					index = swarm.random.choice(missing)
+					files[name] |= 1 << (n_packets - index - 1)
+					if files[name] == (1 << n_packets) - 1:
+						files[name] = -1
+					frame = Message_Protocols.encode_message_TCP_v2([name, index], True, 2)
+					writer.write(frame)
+					stats.bytes_out += len(frame)
+					stats.writes += 1
+					await writer.drain()
+			else:
+				# A execução terminou sem o FS_Node ter sido desligado pelo churn
+				writer.close()
+
+		except (OSError, asyncio.IncompleteReadError):
+			stats.errors += 1
+			writer.transport.abort()
+
+
+"""
+Função que devolve a memória (RSS), em bytes, do processo 'pid' e de todos os seus descendentes (por exemplo, os shards do
+FS_Tracker), lida de /proc, ou None caso não seja possível.
+"""
+def tracker_rss(pid):
+	if pid is None:
+		return None
+	try:
+		children = {}
+		for entry in os.listdir("/proc"):
+			if entry.isdigit():
+				try:
+					with open(f"/proc/{entry}/stat") as file:
+						fields = file.read().rsplit(")", 1)[1].split()
+					children.setdefault(int(fields[1]), []).append(int(entry))
+				except OSError:
+					pass
+
+		total = 0
+		pending = [pid]
+		while pending:
+			current = pending.pop()
+			with open(f"/proc/{current}/status") as file:
+				for line in file:
+					if line.startswith("VmRSS:"):
+						total += int(line.split()[1]) * 1024
+			pending.extend(children.get(current, []))
+		return total
+	except OSError:
+		return None
+
+
+"""
+Corrotina que escreve o relatório de cada intervalo até ao fim da execução, devolvendo a lista dos intervalos.
+"""
+async def report(swarm, deadline):
+	interval = swarm.options["--interval"]
+	started = time.monotonic()
+	intervals = []
+	print(f"{'tempo':>6} {'pedidos/s':>10} {'atualiz./s':>10} {'ligações':>8} {'quedas':>7} {'erros':>6} {'p50 us':>8} {'p90 us':>8} {'p99 us':>8} {'p99.9 us':>9} {'RSS MB':>8}")
+	while time.monotonic() < deadline:
+		await asyncio.sleep(interval)
+		values, latency = swarm.stats.take_interval()
+		rss = tracker_rss(swarm.options["--tracker-pid"])
+		elapsed = time.monotonic() - started
+		intervals.append({"time": elapsed, **values, "latency": {key: latency[key] for key in ("count", "mean", "p50", "p90", "p99", "p99.9", "max")}, "rss": rss})
+		rss_text = f"{rss / 1048576:8.1f}" if rss is not None else f"{'-':>8}"
+		print(f"{elapsed:6.1f} {values['reads'] / interval:10.0f} {values['writes'] / interval:10.0f} {values['connects']:8d} {values['disconnects']:7d} {values['errors']:6d} {latency['p50']:8d} {latency['p90']:8d} {latency['p99']:8d} {latency['p99.9']:9d} {rss_text}")
+	return intervals
+
+
+"""
+Corrotina que inicia os FS_Nodes simulados ao ritmo de --connect-rate por segundo e espera pelo fim da execução.
+"""
+async def run(swarm):
+	options = swarm.options
+	deadline = time.monotonic() + options["--duration"]
+	reporter = asyncio.get_running_loop().create_task(report(swarm, deadline))
+
+	nodes = []
+	for i in range(options["--nodes"]):
+		nodes.append(asyncio.get_running_loop().create_task(simulated_node(swarm, deadline)))
+		await asyncio.sleep(1 / options["--connect-rate"])
+
+	intervals = await reporter
+	await asyncio.gather(*nodes, return_exceptions=True)
+	return intervals
+
+
+def parse_options(arguments):
+	options = dict(DEFAULT_OPTIONS)
+	for option in DEFAULT_OPTIONS:
+		if option in arguments:
+			position = arguments.index(option)
+			value = arguments[position + 1]
+			del arguments[position:position + 2]
+			if option in ("--save",):
+				options[option] = value
+			elif isinstance(DEFAULT_OPTIONS[option], float):
+				options[option] = float(value)
+			else:
+				options[option] = int(value)
+	return options
+
+
+def Main():
+	arguments = sys.argv[1:]
+	options = parse_options(arguments)
+	if len(arguments) != 2:
+		print("Argumentos introduzidos errados.")
+		print("Formato Correto: python3 Tracker_Load.py Tracker_Name Tracker_Port [opções] (ver o início do ficheiro)")
+		return
+
+	# Cada FS_Node simulado usa um descritor de ficheiro
+	try:
+		import resource
+		soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+		resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+	except (ImportError, ValueError, OSError):
+		pass
+
+	swarm = Swarm(arguments[0], int(arguments[1]), options)
+	start = time.monotonic()
+	intervals = asyncio.run(run(swarm))
+	elapsed = time.monotonic() - start
+
+	totals = swarm.stats.totals
+	latency = swarm.stats.total_latency.snapshot()
+	rss = [interval["rss"] for interval in intervals if interval["rss"] is not None]
+	print("")
+	print(f"{totals['reads']} pedidos ({totals['reads'] / elapsed:.0f}/s), {totals['writes']} atualizações ({totals['writes'] / elapsed:.0f}/s), "
+		f"{totals['connects']} ligações, {totals['disconnects']} quedas, {totals['errors']} erros em {elapsed:.1f} s")
+	print(f"latência dos pedidos: p50 {latency['p50']} us, p90 {latency['p90']} us, p99 {latency['p99']} us, p99.9 {latency['p99.9']} us, máximo {latency['max']} us")
+	if rss:
+		print(f"RSS do FS_Tracker: inicial {rss[0] / 1048576:.1f} MB, máximo {max(rss) / 1048576:.1f} MB, final {rss[-1] / 1048576:.1f} MB")
+
+	if options["--save"] is not None:
+		summary = {"options": options, "elapsed": elapsed, "totals": totals, "latency": {key: value for key, value in latency.items() if key != "buckets"}, "intervals": intervals}
+		with open(options["--save"], "w") as file:
+			json.dump(summary, file, indent=1)
+
+
+if __name__ == '__main__':
+	Main()
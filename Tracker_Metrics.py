@@ -0,0 +1,271 @@
+"""
+Ficheiro correspondente ao registo de métricas do FS_Tracker: contadores, gauges e histogramas de latência. O custo de
+cada medição é de algumas operações sobre inteiros, pelo que as métricas ficam sempre ligadas. O estado das métricas pode
+ser pedido por um FS_Node (id_mode==8) ou escrito periodicamente num ficheiro (opção --metrics do FS_Tracker).
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+
+
+# Número de sub-intervalos de cada potência de 2 dos histogramas (erro relativo máximo de 1/16)
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+# Duração, em segundos, a partir da qual uma operação é escrita no terminal, com o ficheiro e o FS_Node envolvidos
+SLOW_OPERATION = 0.05
+
+# Intervalo mínimo, em segundos, entre avisos de operações lentas (as operações lentas no intervalo são apenas contadas)
+SLOW_LOG_INTERVAL = 1.0
+
+# Intervalo, em segundos, entre escritas das métricas no ficheiro
+METRICS_INTERVAL = 10
+
+# Percentis indicados no estado de cada histograma
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class Histogram():
+
+	"""
+	Histograma de valores inteiros não negativos (por omissão, durações em microssegundos) com intervalos logarítmicos, ao
+	estilo dos histogramas HDR: os valores menores que 2 * SUB_BUCKETS têm um intervalo cada e cada potência de 2 seguinte
+	é dividida em SUB_BUCKETS intervalos. Registar um valor custa apenas o cálculo do índice do intervalo, com memória fixa,
+	e os percentis têm um erro relativo de no máximo 1/SUB_BUCKETS.
+
+	Estrutura buckets = {índice: contagem}
+	Apenas os intervalos com valores são guardados, o que permite juntar histogramas de vários processos somando as contagens.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.buckets = {}
+		self.count = 0
+		self.total = 0
+		self.max = 0
+
+
+	def record(self, value):
+		value = int(value)
+		index = bucket_index(value)
+		with self.lock:
+			self.buckets[index] = self.buckets.get(index, 0) + 1
+			self.count += 1
+			self.total += value
+			if value > self.max:
+				self.max = value
+
+
+	def snapshot(self):
+		with self.lock:
+			return summarize(dict(self.buckets), self.count, self.total, self.max)
+
+
+"""
+Funções que convertem um valor para o índice do seu intervalo no histograma e um índice para o menor valor do intervalo.
+"""
+def bucket_index(value):
+	shift = value.bit_length() - SUB_BUCKET_BITS - 1
+	if shift <= 0:
+		return value
+	return (shift << SUB_BUCKET_BITS) + (value >> shift)
+
+
+def bucket_value(index):
+	shift = (index >> SUB_BUCKET_BITS) - 1
+	if shift <= 0:
+		return index
+	return ((index & (SUB_BUCKETS - 1)) | SUB_BUCKETS) << shift
+
+
+"""
+Função que devolve o estado de um histograma: número de valores, média, máximo, percentis e os intervalos, com os índices
+como strings (para o estado poder ser convertido para JSON e de volta).
+"""
+def summarize(buckets, count, total, maximum):
+	state = {"count": count, "mean": total / count if count else 0, "max": maximum, "sum": total}
+	ordered = sorted((int(index), n) for index, n in buckets.items())
+	for percentile in PERCENTILES:
+		target = count * percentile / 100
+		seen = 0
+		value = 0
+		for index, n in ordered:
+			seen += n
+			value = bucket_value(index)
+			if seen >= target:
+				break
+		state[f"p{percentile:g}"] = min(value, maximum)
+	state["buckets"] = {str(index): n for index, n in ordered}
+	return state
+
+
+class Tracker_Metrics():
+
+	"""
+	Estrutura counters = {"bytes_in.1": 1024, ...}
+	Contadores, incrementados com add.
+
+	Estrutura gauges = {"store_queue.total": função, ...}
+	Valores instantâneos, calculados apenas quando é pedido o estado das métricas, pela função registada com o nome do gauge.
+
+	Estrutura histograms = {"request.0": Histogram, ...}
+	Histogramas de durações em microssegundos, criados no primeiro registo.
+
+	Estrutura store_queues = {(172.0.0.1, 9090): deque([mensagens])}
+	Filas de mensagens à espera de serem guardadas de cada FS_Node ligado (data_to_store do FS_Tracker), usadas pelos gauges
+	store_queue.total e store_queue.max, que indicam o total de mensagens em espera e o FS_Node com mais mensagens em espera.
+
+	A variável slow_log indica se as operações lentas são escritas no stderr (ver observe). Os benchmarks, que medem as
+	durações com os seus próprios histogramas, desligam-na para os avisos não se misturarem com os resultados.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counters = {}
+		self.gauges = {}
+		self.histograms = {}
+		self.store_queues = {}
+		self.started = time.time()
+		self.slow_log = True
+		self.slow_logged = 0
+		self.slow_suppressed = 0
+		self.gauges["store_queue.total"] = lambda: sum(len(queue) for queue in list(self.store_queues.values()))
+		self.gauges["store_queue.max"] = self._largest_store_queue
+
+
+	def add(self, name, value=1):
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + value
+
+
+	def gauge(self, name, function):
+		self.gauges[name] = function
+
+
+	def histogram(self, name):
+		histogram = self.histograms.get(name)
+		if histogram is None:
+			with self.lock:
+				histogram = self.histograms.setdefault(name, Histogram())
+		return histogram
+
+
+	"""
+	Regista a duração, em segundos, de uma operação no histograma 'name'. Caso ultrapasse SLOW_OPERATION, a operação é contada
+	em slow_operations e, com slow_log, escrita no stderr com o ficheiro e o FS_Node envolvidos. É escrito no máximo um aviso
+	a cada SLOW_LOG_INTERVAL segundos, com o número de operações lentas omitidas desde o aviso anterior.
+	"""
+	def observe(self, name, seconds, file=None, addr=None):
+		self.histogram(name).record(seconds * 1000000)
+		if seconds < SLOW_OPERATION:
+			return
+
+		self.add("slow_operations")
+		if not self.slow_log:
+			return
+		now = time.monotonic()
+		with self.lock:
+			if now - self.slow_logged < SLOW_LOG_INTERVAL:
+				self.slow_suppressed += 1
+				return
+			self.slow_logged = now
+			suppressed = self.slow_suppressed
+			self.slow_suppressed = 0
+		omitted = f" ({suppressed} operações lentas omitidas)" if suppressed else ""
+		sys.stderr.write(f"Operação lenta: {name} demorou {seconds * 1000:.1f} ms (ficheiro={file}, FS_Node={addr}){omitted}\n")
+
+
+	def timed(self, name, file=None, addr=None):
+		return _Timer(self, name, file, addr)
+
+
+	def register_store_queue(self, addr, queue):
+		self.store_queues[addr] = queue
+
+
+	def unregister_store_queue(self, addr):
+		self.store_queues.pop(addr, None)
+
+
+	"""
+	Devolve o estado de todas as métricas, num dicionário que pode ser convertido para JSON.
+	"""
+	def snapshot(self):
+		with self.lock:
+			counters = dict(self.counters)
+			histograms = dict(self.histograms)
+		return {
+			"uptime": time.time() - self.started,
+			"counters": counters,
+			"gauges": {name: function() for name, function in list(self.gauges.items())},
+			"histograms": {name: histogram.snapshot() for name, histogram in histograms.items()},
+		}
+
+
+	def _largest_store_queue(self):
+		largest = 0
+		for queue in list(self.store_queues.values()):
+			largest = max(largest, len(queue))
+		return largest
+
+
+"""
+Classe devolvida por Tracker_Metrics.timed, que mede a duração do bloco with e a regista com observe.
+"""
+class _Timer():
+
+	__slots__ = ("metrics", "name", "file", "addr", "start")
+
+	def __init__(self, metrics, name, file, addr):
+		self.metrics = metrics
+		self.name = name
+		self.file = file
+		self.addr = addr
+
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+
+
+	def __exit__(self, *exception):
+		self.metrics.observe(self.name, time.perf_counter() - self.start, self.file, self.addr)
+
+
+"""
+Função que junta o estado das métricas de vários processos (por exemplo, dos shards do FS_Tracker): os contadores, os gauges
+e os intervalos dos histogramas são somados, exceto os gauges terminados em .max, dos quais é usado o maior valor. Os gauges
+de cada shard, como o número de FS_Nodes, são somados, pelo que um FS_Node com ficheiros em vários shards conta em cada um.
+"""
+def merge_snapshots(snapshots):
+	merged = {"uptime": 0, "counters": {}, "gauges": {}, "histograms": {}}
+	histograms = {}
+	for snapshot in snapshots:
+		merged["uptime"] = max(merged["uptime"], snapshot["uptime"])
+		for name, value in snapshot["counters"].items():
+			merged["counters"][name] = merged["counters"].get(name, 0) + value
+		for name, value in snapshot["gauges"].items():
+			if name.endswith(".max"):
+				merged["gauges"][name] = max(merged["gauges"].get(name, 0), value)
+			else:
+				merged["gauges"][name] = merged["gauges"].get(name, 0) + value
+		for name, state in snapshot["histograms"].items():
+			buckets, count, total, maximum = histograms.get(name, ({}, 0, 0, 0))
+			for index, n in state["buckets"].items():
+				buckets[index] = buckets.get(index, 0) + n
+			histograms[name] = (buckets, count + state["count"], total + state["sum"], max(maximum, state["max"]))
+	for name, (buckets, count, total, maximum) in histograms.items():
+		merged["histograms"][name] = summarize(buckets, count, total, maximum)
+	return merged
+
+
+"""
+Função que escreve o estado das métricas em JSON no ficheiro 'path', substituindo-o de uma só vez para quem o lê nunca
+encontrar um ficheiro incompleto.
+"""
+def dump_snapshot(snapshot, path):
+	temporary_path = path + ".tmp"
+	with open(temporary_path, 'w') as file:
+		json.dump(snapshot, file, indent=1, sort_keys=True)
+	os.replace(temporary_path, path)
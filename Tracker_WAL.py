@@ -0,0 +1,221 @@
+"""
+Ficheiro correspondente à classe que guarda em disco o estado da base de dados do FS_Tracker, para que este possa ser
+reiniciado sem esperar que todos os FS_Nodes voltem a anunciar os seus ficheiros. O estado é guardado num snapshot, escrito
+periodicamente, e num registo (write-ahead log) com as alterações aplicadas desde o último snapshot. Ao iniciar, o FS_Tracker
+lê o snapshot e aplica o registo, pelo que o tempo de arranque depende apenas do tamanho do estado.
+"""
+
+import os
+import struct
+import threading
+import zlib
+import Message_Protocols
+from ReentrantRWLock import ReentrantRWLock
+
+
+
+# Tipos de registo
+RECORD_MESSAGE = 0
+RECORD_REMOVE_NODE = 1
+RECORD_NODE_VERSION = 2
+
+# Intervalo, em segundos, entre snapshots
+SNAPSHOT_INTERVAL = 60
+
+_SNAPSHOT_MAGIC = b'FSTS'
+_RECORD_HEADER = struct.Struct('>IIB')
+_GENERATION = struct.Struct('>I')
+_PORT = struct.Struct('>H')
+
+
+class Tracker_WAL():
+
+	"""
+	Cada registo tem o formato size (4 bytes) + crc32 (4 bytes) + tipo (1 byte) + ip_size (1 byte) + ip + port (2 bytes) + corpo,
+	em que size conta o tipo, o endereço e o corpo e o crc32 é calculado sobre os mesmos campos. O corpo de RECORD_MESSAGE é a
+	trama TCP da versão 2 da mensagem do FS_Node (id_mode 1 a 4), o de RECORD_NODE_VERSION a versão (1 byte) e o de
+	RECORD_REMOVE_NODE é vazio. Ao ler, o primeiro registo incompleto ou com crc32 errado (por exemplo, escrito a meio quando o
+	FS_Tracker terminou) marca o fim do ficheiro.
+
+	O snapshot é uma sequência de registos do mesmo formato, precedida de _SNAPSHOT_MAGIC e do número de geração: para cada
+	FS_Node, a sua versão e o anúncio de todos os ficheiros que possuí, seguidos dos manifestos dos ficheiros. O registo da
+	geração g chama-se wal.g.bin e contém as alterações posteriores ao snapshot da mesma geração. Ao iniciar, são aplicados
+	o snapshot e os registos das gerações seguintes que existam, por ordem. Um novo snapshot é escrito num ficheiro temporário
+	e só depois substitui o anterior, e os registos das gerações anteriores apenas são apagados depois disso, pelo que uma
+	falha a meio de um snapshot nunca aplica a mesma alteração duas vezes (o que, com os XOR das atualizações, daria pacotes
+	errados) nem perde as alterações do registo da nova geração.
+
+	O lock de leitura e escrita impede que seja tirado um snapshot entre a aplicação de uma alteração na base de dados e a sua
+	escrita no registo: as alterações usam o lock de leitura (podendo ser aplicadas em simultâneo) e o snapshot o de escrita.
+	O lock de escrita apenas é mantido enquanto o estado é copiado para memória e o registo passa para a geração seguinte; a
+	conversão, a escrita e a sincronização do snapshot com o disco são feitas depois, sem atrasar as alterações. Os registos
+	são enviados para o sistema operativo a cada alteração (flush), sobrevivendo ao fim do processo, mas só são sincronizados
+	com o disco (fsync) em cada snapshot.
+	"""
+	def __init__(self, path):
+		self.path = path if path.endswith("/") else path + "/"
+		self.lock = ReentrantRWLock()
+		self.file_lock = threading.Lock()
+		self.generation = 0
+		self.snapshot_generation = 0
+		self.file = None
+		os.makedirs(self.path, exist_ok=True)
+
+
+	"""
+	Função que carrega na base de dados o snapshot e o registo guardados e abre o registo para escrita. Devolve o número de
+	registos aplicados.
+	"""
+	def load(self, FS_Tracker_DB):
+		applied = 0
+
+		snapshot_path = self.path + "snapshot.bin"
+		if os.path.exists(snapshot_path):
+			with open(snapshot_path, 'rb') as file:
+				data = file.read()
+			if data[:4] == _SNAPSHOT_MAGIC:
+				self.generation, = _GENERATION.unpack_from(data, 4)
+				applied += self._replay(FS_Tracker_DB, data, 8)[0]
+		self.snapshot_generation = self.generation
+
+		# Um snapshot que falhou depois de o registo passar para a geração seguinte deixa vários registos por aplicar
+		end = 0
+		while os.path.exists(self._wal_path(self.generation)):
+			with open(self._wal_path(self.generation), 'rb') as file:
+				data = file.read()
+			count, end = self._replay(FS_Tracker_DB, data, 0)
+			applied += count
+			if not os.path.exists(self._wal_path(self.generation + 1)):
+				break
+			self.generation += 1
+
+		# Descarta o final incompleto do registo, para os registos seguintes ficarem a seguir ao último registo válido
+		self.file = open(self._wal_path(self.generation), 'ab')
+		self.file.truncate(end)
+		return applied
+
+
+	"""
+	Funções que escrevem no registo as alterações aplicadas na base de dados. Devem ser chamadas com o lock de leitura
+	adquirido, juntamente com a alteração correspondente.
+	"""
+	def append_message(self, addr, message):
+		frame = Message_Protocols.encode_message_TCP_v2(message[1], True, message[0])
+		self._append(RECORD_MESSAGE, addr, frame[4:])
+
+
+	def append_remove_node(self, addr):
+		self._append(RECORD_REMOVE_NODE, addr, b'')
+
+
+	def append_node_version(self, addr, version):
+		self._append(RECORD_NODE_VERSION, addr, bytes([version]))
+
+
+	"""
+	Função que escreve um snapshot do estado da base de dados e passa a usar o registo da geração seguinte, apagando os
+	registos anteriores, cujas alterações já estão no snapshot. Com o lock de escrita apenas é copiado o estado (ver
+	_capture_state) e aberto o novo registo.
+	"""
+	def snapshot(self, FS_Tracker_DB):
+		with self.lock.w_locked():
+			state = self._capture_state(FS_Tracker_DB)
+			with self.file_lock:
+				self.file.close()
+				self.generation += 1
+				self.file = open(self._wal_path(self.generation), 'wb')
+			generation = self.generation
+
+		temporary_path = self.path + "snapshot.bin.tmp"
+		with open(temporary_path, 'wb') as file:
+			file.write(_SNAPSHOT_MAGIC + _GENERATION.pack(generation))
+			for kind, addr, body in self._state_records(*state):
+				file.write(self._encode_record(kind, addr, body))
+			file.flush()
+			os.fsync(file.fileno())
+		os.replace(temporary_path, self.path + "snapshot.bin")
+
+		for old_generation in range(self.snapshot_generation, generation):
+			if os.path.exists(self._wal_path(old_generation)):
+				os.remove(self._wal_path(old_generation))
+		self.snapshot_generation = generation
+
+
+	"""
+	Função que copia o estado da base de dados, com o lock de escrita do registo: as versões dos FS_Nodes, os pacotes que
+	cada FS_Node possuí de cada ficheiro e os manifestos. Apenas são copiados os dicionários, sem converter os registos.
+	"""
+	def _capture_state(self, FS_Tracker_DB):
+		files = []
+		for name, owners in list(FS_Tracker_DB.files.items()):
+			with owners.lock.r_locked():
+				packets = dict(owners.packets)
+			if packets:
+				files.append((name, owners.n_packets, FS_Tracker_DB.get_block_size(name), packets))
+		return dict(FS_Tracker_DB.nodes_version), files, dict(FS_Tracker_DB.files_manifest)
+
+
+	def _state_records(self, nodes_version, files, files_manifest):
+		for addr, version in nodes_version.items():
+			yield RECORD_NODE_VERSION, addr, bytes([version])
+
+		nodes_files = {}
+		for name, n_packets, block_size, packets in files:
+			for addr, packets_owned in packets.items():
+				nodes_files.setdefault(addr, []).append([name, n_packets, packets_owned, block_size])
+
+		for addr, node_files in nodes_files.items():
+			for frame in Message_Protocols.encode_announcement_frames(node_files, 2):
+				yield RECORD_MESSAGE, addr, frame[4:]
+
+		for name, manifest in files_manifest.items():
+			yield RECORD_MESSAGE, ("", 0), Message_Protocols.encode_message_TCP_v2([name, manifest], True, 4)[4:]
+
+
+	def _append(self, kind, addr, body):
+		record = self._encode_record(kind, addr, body)
+		with self.file_lock:
+			self.file.write(record)
+			self.file.flush()
+
+
+	def _encode_record(self, kind, addr, body):
+		ip = addr[0].encode('utf-8')
+		payload = bytes([len(ip)]) + ip + _PORT.pack(addr[1]) + body
+		checksum = zlib.crc32(bytes([kind]) + payload)
+		return _RECORD_HEADER.pack(len(payload) + 1, checksum, kind) + payload
+
+
+	"""
+	Função que aplica na base de dados os registos de 'data' a partir de 'offset' e devolve o número de registos aplicados e a
+	posição do fim do último registo válido.
+	"""
+	def _replay(self, FS_Tracker_DB, data, offset):
+		count = 0
+		while offset + _RECORD_HEADER.size <= len(data):
+			size, checksum, kind = _RECORD_HEADER.unpack_from(data, offset)
+			end = offset + 8 + size
+			if end > len(data) or zlib.crc32(data[offset+8:end]) != checksum:
+				break
+
+			position = offset + _RECORD_HEADER.size
+			ip_size = data[position]
+			ip = str(data[position+1:position+1+ip_size], 'utf-8')
+			position += 1 + ip_size
+			addr = (ip, _PORT.unpack_from(data, position)[0])
+			body = data[position+2:end]
+
+			if kind == RECORD_MESSAGE:
+				FS_Tracker_DB.apply_message(addr, Message_Protocols.decode_request_TCP(body, 2))
+			elif kind == RECORD_REMOVE_NODE:
+				FS_Tracker_DB.remove_FS_node(addr)
+			elif kind == RECORD_NODE_VERSION:
+				FS_Tracker_DB.set_node_version(addr, body[0])
+
+			offset = end
+			count += 1
+		return count, offset
+
+
+	def _wal_path(self, generation):
+		return self.path + f"wal.{generation}.bin"